@@ -0,0 +1,153 @@
+"""
+Times the start of the Qt GUI, from launching a fresh
+interpreter to the window being shown and to the first
+pair being combined, through the easyfusion.main() entry point.
+
+	python benchmarks/bench_startup.py --repeat 5
+
+Every run is a new process, so the times include the
+interpreter and the imports, as an operator would see them.
+The GUI runs need PyQt4 and a display; without them only
+the imports done before the window shows are timed.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+sys.path.insert(0, ROOT)
+
+from fusion.fsynth import write_dataset
+
+# Imports the modules easyfusion needs before its window, without Qt,
+# then the analysis stack it loads in the background afterwards
+IMPORT_SCRIPT = """
+import json, sys, time
+launched = float(sys.argv[1])
+sys.path.insert(0, sys.argv[2])
+import fusion.fbatch, fusion.fcache, fusion.fmatcher, fusion.fprofile, fusion.fwriter
+window_imports = time.time() - launched
+pandas_loaded = 'pandas' in sys.modules
+import fusion.fanalyzer
+print(json.dumps({'window_imports': window_imports, 'pandas_before_window': pandas_loaded,
+				  'analysis_imports': time.time() - launched - window_imports}))
+"""
+
+# Runs easyfusion.main() with the event loop wrapped, so the time the
+# window is first idle is recorded and a single pair is then combined
+# through the same path as the Save & Combine button
+GUI_SCRIPT = """
+import json, sys, time
+launched = float(sys.argv[1])
+root, pcr_path, lis_path, save_directory, workers = sys.argv[2:7]
+sys.path.insert(0, root)
+from PyQt4 import QtCore, QtGui
+import easyfusion
+
+timings = {}
+
+def shown():
+	app = QtGui.QApplication.instance()
+	gui = [widget for widget in app.topLevelWidgets() if isinstance(widget, easyfusion.FusionGui)][0]
+	timings['window'] = time.time() - launched
+
+	gui.pcrFileList.addItem(pcr_path)
+	gui.lisFileList.addItem(lis_path)
+	gui.worker_count.setValue(int(workers))
+	gui.use_cache.setChecked(False)
+	QtGui.QFileDialog.getExistingDirectory = staticmethod(lambda *args: save_directory)
+	gui.run_program()
+
+pair_finished = easyfusion.FusionGui.pair_finished
+def measured_pair_finished(gui, result, done, total):
+	timings.setdefault('first_result', time.time() - launched)
+	timings.setdefault('status', result.status)
+	pair_finished(gui, result, done, total)
+easyfusion.FusionGui.pair_finished = measured_pair_finished
+
+run_finished = easyfusion.FusionGui.run_finished
+def measured_run_finished(gui, cancelled):
+	run_finished(gui, cancelled)
+	QtGui.QApplication.instance().quit()
+easyfusion.FusionGui.run_finished = measured_run_finished
+
+exec_ = QtGui.QApplication.exec_
+def measured_exec(app):
+	QtCore.QTimer.singleShot(0, shown)
+	return exec_(app)
+QtGui.QApplication.exec_ = measured_exec
+
+try:
+	easyfusion.main()
+except SystemExit:
+	pass
+print(json.dumps(timings))
+"""
+
+
+def launch(script, *args):
+
+	""" Runs the script in a new interpreter
+
+	Returns:
+		the JSON printed last by the script (dict)
+	"""
+
+	launched = time.time()
+	output = subprocess.check_output([sys.executable, '-c', script, repr(launched)] + list(args), cwd=ROOT)
+	return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def has_qt():
+
+	""" Checks if PyQt4 can be imported, without importing it here """
+
+	return subprocess.call([sys.executable, '-c', 'import PyQt4.QtGui'],
+						   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+
+
+def main(argv=None):
+
+	parser = argparse.ArgumentParser(description='Benchmark the start of the GUI')
+	parser.add_argument('--repeat', type=int, default=5,
+						help='launches per measurement, the best is kept (default: %(default)s)')
+	parser.add_argument('--specimens', type=int, default=200,
+						help='specimens of the pair combined for the first result (default: %(default)s)')
+	parser.add_argument('--workers', type=int, default=1,
+						help='worker processes of the GUI run (default: %(default)s)')
+	args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+	imports = [launch(IMPORT_SCRIPT, ROOT) for _ in range(args.repeat)]
+	print("%-22s %10.3fs" % ('imports before window', min(run['window_imports'] for run in imports)))
+	print("%-22s %10.3fs" % ('analysis imports', min(run['analysis_imports'] for run in imports)))
+	print("%-22s %11s" % ('pandas before window', 'yes' if any(run['pandas_before_window'] for run in imports) else 'no'))
+
+	if not has_qt():
+		print("PyQt4 is not installed, the window and first result were not timed")
+		return
+
+	directory = tempfile.mkdtemp(prefix='fusion-bench-')
+	try:
+		pcr_path, lis_path = write_dataset(os.path.join(directory, 'in'), 1, args.specimens)[0]
+		runs = []
+		for number in range(args.repeat):
+			save_directory = os.path.join(directory, 'out%d' % number)
+			os.makedirs(save_directory)
+			runs.append(launch(GUI_SCRIPT, ROOT, pcr_path, lis_path, save_directory, str(args.workers)))
+	finally:
+		shutil.rmtree(directory)
+
+	assert all(run.get('status') == 'combined' for run in runs), runs
+	print("%-22s %10.3fs" % ('time to window', min(run['window'] for run in runs)))
+	print("%-22s %10.3fs" % ('time to first result', min(run['first_result'] for run in runs)))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,90 @@
+"""
+Times each output format of fusion.fwriter on a frame
+shaped like the combined LIS & PCR output (78 columns,
+one row per specimen), to compare the per-pair write cost.
+
+	python benchmarks/bench_writers.py --rows 200 2000 10000
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fusion.fwriter import OUTPUT_FORMATS, write_frame
+
+
+def combined_like_frame(rows, seed=0):
+
+	""" Builds a frame with the column mix of combine_files:
+	text IDs and barcodes, numeric Ct/RFU values and RFU Range
+	columns where negatives are replaced with "-" """
+
+	random = np.random.RandomState(seed)
+	columns = {}
+
+	for number in range(38):
+		columns['Text %d' % number] = ['ID%08d' % value for value in random.randint(0, 10 ** 8, rows)]
+	for number in range(35):
+		columns['Number %d' % number] = random.uniform(0, 5000, rows)
+	for number in range(5):
+		rfu = random.randint(100, 5000, rows).astype(object)
+		rfu[random.rand(rows) < 0.7] = "-"
+		columns['RFU Range %d' % number] = rfu
+
+	frame = pd.DataFrame(columns, index=pd.Index(['SB%08d_RUN_%d' % (row, row) for row in range(rows)],
+												 name='UniqueID'))
+	return frame
+
+
+def time_format(frame, output_format, directory, repeat):
+
+	""" Best wall time in seconds of writing the frame, None when the
+	format's library is not installed """
+
+	save_to = os.path.join(directory, 'bench' + OUTPUT_FORMATS[output_format])
+	best = None
+	for _ in range(repeat):
+		started = time.time()
+		try:
+			write_frame(frame, save_to, output_format)
+		except ImportError:
+			return None
+		elapsed = time.time() - started
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+
+def main(argv=None):
+
+	parser = argparse.ArgumentParser(description='Benchmark the combined output writers')
+	parser.add_argument('--rows', type=int, nargs='+', default=[200, 2000, 10000],
+						help='specimens per pair (default: %(default)s)')
+	parser.add_argument('--repeat', type=int, default=3,
+						help='runs per measurement, the best is kept (default: %(default)s)')
+	parser.add_argument('--formats', nargs='+', default=sorted(OUTPUT_FORMATS),
+						choices=sorted(OUTPUT_FORMATS))
+	args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+	directory = tempfile.mkdtemp(prefix='fusion-bench-')
+	try:
+		print("%-8s %-12s %10s" % ('rows', 'format', 'seconds'))
+		for rows in args.rows:
+			frame = combined_like_frame(rows)
+			for output_format in args.formats:
+				elapsed = time_format(frame, output_format, directory, args.repeat)
+				print("%-8d %-12s %10s" % (rows, output_format,
+										   'n/a' if elapsed is None else '%.3f' % elapsed))
+	finally:
+		shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,108 @@
+"""
+Checks that reading the PCR file in chunks gives the
+same combined csv as reading it whole, on synthetic pairs
+with the channel layouts that cross chunk boundaries.
+
+	python benchmarks/check_chunked.py --chunk-rows 5 13 50 1000
+
+When the whole-file combine fails, the chunked one has to fail
+with the same error. The exit status is 1 when any chunk size
+gives another result than the whole file.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fusion.fanalyzer import FusionAnalysis, describe_join
+from fusion.fsynth import synthetic_pair, write_exports
+
+
+def last_specimen_without_ic(pcr):
+
+	last = pcr['Specimen Barcode'] == pcr['Specimen Barcode'].iloc[-1]
+	return pcr[~(last & (pcr['Channel'] == 'IC'))]
+
+
+def first_specimens_without_hex(pcr, specimens=4):
+
+	first = pcr['Specimen Barcode'].isin(pcr['Specimen Barcode'].unique()[:specimens])
+	return pcr[~(first & (pcr['Channel'] == 'HEX'))]
+
+
+def last_specimen_duplicated_channel(pcr):
+
+	return pd.concat([pcr, pcr[pcr['Channel'] == 'FAM'].tail(1)])
+
+
+def channel_missing_from_file(pcr):
+
+	return pcr[pcr['Channel'] != 'RED647']
+
+
+# Name -> change of the synthetic PCR rows
+CASES = [('complete', lambda pcr: pcr),
+		 ('last specimen without IC', last_specimen_without_ic),
+		 ('first specimens without HEX', first_specimens_without_hex),
+		 ('last specimen with FAM twice', last_specimen_duplicated_channel),
+		 ('RED647 missing from the file', channel_missing_from_file)]
+
+
+def combine(pcr_path, lis_path, save_to, chunk_rows):
+
+	""" Combines the pair into a csv
+
+	Returns:
+		the csv and the join summary, or the error (tuple)
+	"""
+
+	analysis = FusionAnalysis(pcr_path, lis_path, 'P 1/2/3/4', chunk_rows=chunk_rows)
+	try:
+		analysis.combine_files('Paraflu', save_to, 'csv')
+	except Exception as error:
+		return ('error', '%s: %s' % (type(error).__name__, error))
+	with open(save_to, 'rb') as combined:
+		return ('combined', combined.read(), describe_join(analysis.join_report))
+
+
+def main(argv=None):
+
+	parser = argparse.ArgumentParser(description='Check chunked combining against whole-file combining')
+	parser.add_argument('--chunk-rows', type=int, nargs='+', default=[5, 13, 50, 1000],
+						help='chunk sizes to check (default: %(default)s)')
+	parser.add_argument('--specimens', type=int, default=40,
+						help='specimens of each synthetic pair (default: %(default)s)')
+	args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+	directory = tempfile.mkdtemp(prefix='fusion-check-')
+	different = 0
+	try:
+		pcr, lis = synthetic_pair(args.specimens, curve_columns=0)
+		pcr_path = os.path.join(directory, 'pair.csv')
+		lis_path = os.path.join(directory, 'pair.lis')
+		save_to = os.path.join(directory, 'combined.csv')
+
+		for name, change in CASES:
+			write_exports(change(pcr), lis, pcr_path, lis_path)
+			whole = combine(pcr_path, lis_path, save_to, None)
+			for chunk_rows in args.chunk_rows:
+				chunked = combine(pcr_path, lis_path, save_to, chunk_rows)
+				flag = 'same'
+				if chunked != whole:
+					different += 1
+					flag = 'DIFFERENT: %s' % (chunked[1] if chunked[0] == 'error' else 'combined rows')
+				print("%-30s %6d rows  %-8s %s" % (name, chunk_rows, whole[0], flag))
+	finally:
+		shutil.rmtree(directory)
+
+	return 1 if different else 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
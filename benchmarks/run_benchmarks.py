@@ -0,0 +1,320 @@
+"""
+Benchmark suite for matching, loading, combining,
+writing and the PQ statistics, on synthetic Panther exports from fusion.fsynth.
+
+	python benchmarks/run_benchmarks.py --scale quick --save before.json
+	python benchmarks/run_benchmarks.py --scale quick --compare before.json
+
+Each measurement is keyed by its benchmark name and size, so
+a saved run can be compared against later runs. With --compare
+the exit status is 1 when any measurement is slower than the
+baseline by more than --tolerance.
+
+The memory benchmark records the peak memory of combining
+a loaded pair, and the exit status is also 1 when it is above
+--memory-ceiling megabytes per 10,000 PCR rows. It can be run
+alone, e.g. as a check in CI, without the timing benchmarks:
+
+	python benchmarks/run_benchmarks.py --only memory
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fusion.fanalyzer import FusionAnalysis
+from fusion.fbatch import ASSAY_TYPES, run_batch
+from fusion.fmatcher import match_files, scan_directories
+from fusion.fprofile import StageTimer
+from fusion.fsynth import write_dataset
+from fusion.pqanalyzer import PQAnalysis
+
+# Sizes of each benchmark per scale
+#	match - number of file pairs in the directory
+#	pipeline - PCR rows of a single pair (5 rows per specimen)
+#	batch - number of pairs of 100 specimens combined by run_batch
+#	pq - channel rows added to the PQ statistics (5 rows per specimen)
+#	memory - PCR rows of a single pair combined under tracemalloc (5 rows per specimen)
+SCALES = {'quick': {'match': [1, 10, 100],
+					'pipeline': [100, 1000, 10000],
+					'batch': [1, 10],
+					'pq': [10000, 100000],
+					'memory': [10000, 100000]},
+		  'full': {'match': [1, 10, 100, 1000],
+				   'pipeline': [100, 1000, 10000, 100000],
+				   'batch': [1, 10, 100, 1000],
+				   'pq': [10000, 100000, 1000000, 5000000],
+				   'memory': [10000, 100000, 1000000]}}
+
+# Peak memory of combined_frame on loaded files, in MB per 10,000 PCR rows.
+# Measured at about 6 MB, it was 14 MB while the combine copied whole frames.
+MEMORY_CEILING_MB = 8.0
+
+LOAD_STAGES = ['read_pcr', 'read_lis']
+WRITE_STAGES = ['write']
+
+
+def bench_match(directory, pairs, repeat):
+
+	""" Lists the directory and pairs every file """
+
+	write_dataset(directory, pairs, 1, curve_columns=0)
+
+	best = None
+	for _ in range(repeat):
+		started = time.perf_counter()
+		lis_files, pcr_files = scan_directories([directory])
+		match = match_files(lis_files, pcr_files)
+		elapsed = time.perf_counter() - started
+		best = elapsed if best is None else min(best, elapsed)
+
+	assert len(match.pairs) == pairs
+	return {'seconds': best}
+
+
+def bench_pipeline(directory, rows, output_format, repeat):
+
+	""" Loads, combines and writes a single pair, split into stages """
+
+	pcr_path, lis_path = write_dataset(directory, 1, max(rows // 5, 1))[0]
+	save_to = os.path.join(directory, 'combined.%s' % output_format)
+
+	best = None
+	for _ in range(repeat):
+		timer = StageTimer()
+		analysis = FusionAnalysis(pcr_path, lis_path, ASSAY_TYPES['Paraflu'], timer)
+		analysis.combine_files('Paraflu', save_to, output_format)
+		timer.stop()
+
+		stages = dict((stage['name'], stage['seconds']) for stage in timer.as_dicts())
+		measured = {'load': sum(stages.get(name, 0.0) for name in LOAD_STAGES),
+					'write': sum(stages.get(name, 0.0) for name in WRITE_STAGES),
+					'seconds': timer.total_seconds()}
+		measured['combine'] = measured['seconds'] - measured['load'] - measured['write']
+
+		if best is None or measured['seconds'] < best['seconds']:
+			best = measured
+
+	return best
+
+
+def bench_batch(directory, pairs, output_format, workers):
+
+	""" Matches and combines a whole directory with run_batch """
+
+	write_dataset(os.path.join(directory, 'in'), pairs, 100)
+	out = os.path.join(directory, 'out')
+	os.makedirs(out)
+
+	lis_files, pcr_files = scan_directories([os.path.join(directory, 'in')])
+
+	started = time.perf_counter()
+	results, _ = run_batch(lis_files, pcr_files, out, 'Paraflu', workers, output_format)
+	elapsed = time.perf_counter() - started
+
+	assert all(result.status == 'combined' for result in results), results
+	return {'seconds': elapsed, 'seconds_per_pair': elapsed / pairs}
+
+
+def bench_pq(directory, rows, repeat, run_rows=5000):
+
+	""" Adds combined runs to the PQ statistics of every breakdown. One
+	run is combined and repeated with a distinct Run ID up to the size """
+
+	pcr_path, lis_path = write_dataset(directory, 1, min(rows, run_rows) // 5)[0]
+	run = FusionAnalysis(pcr_path, lis_path, ASSAY_TYPES['Paraflu']).combined_frame('Paraflu')
+
+	runs = max(rows // (len(run) * 5), 1)
+	combined = pd.concat([run.assign(**{'Run ID': 'RUN%d' % number}) for number in range(runs)])
+
+	best = None
+	for _ in range(repeat):
+		started = time.perf_counter()
+		PQAnalysis().add(combined)
+		elapsed = time.perf_counter() - started
+		best = elapsed if best is None else min(best, elapsed)
+
+	return {'seconds': best, 'runs': runs}
+
+
+def bench_memory(directory, rows, repeat):
+
+	""" Peak memory of combining a loaded pair, the reads are left
+	out. The pair is combined twice from the same load, which must
+	give the same frame and leave the loaded frames as they were """
+
+	pcr_path, lis_path = write_dataset(directory, 1, max(rows // 5, 1))[0]
+	analysis = FusionAnalysis(pcr_path, lis_path, ASSAY_TYPES['Paraflu'])
+	loaded = (analysis.pcr_file.copy(), analysis.lis_file.copy())
+
+	combined = []
+	peak_bytes = None
+	best = None
+	for _ in range(max(repeat, 2)):
+		tracemalloc.start()
+		baseline = tracemalloc.get_traced_memory()[0]
+		started = time.perf_counter()
+		combined.append(analysis.combined_frame('Paraflu'))
+		elapsed = time.perf_counter() - started
+		peak = tracemalloc.get_traced_memory()[1] - baseline
+		tracemalloc.stop()
+
+		peak_bytes = peak if peak_bytes is None else max(peak_bytes, peak)
+		best = elapsed if best is None else min(best, elapsed)
+
+	pd.testing.assert_frame_equal(combined[0], combined[-1])
+	pd.testing.assert_frame_equal(loaded[0], analysis.pcr_file)
+	pd.testing.assert_frame_equal(loaded[1], analysis.lis_file)
+
+	return {'seconds': best, 'peak_bytes': peak_bytes,
+			'mb_per_10k_rows': peak_bytes / 1e6 / (len(analysis.pcr_file) / 10000.0)}
+
+
+# Benchmarks in the order they run
+BENCHMARKS = ['match', 'pipeline', 'batch', 'pq', 'memory']
+
+
+def run_benchmarks(scale, output_format, workers, repeat, only=None):
+
+	""" Runs every benchmark of the scale, or only those named in only
+
+	Returns:
+		one dict per measurement with its benchmark, size and timings (list)
+	"""
+
+	measurements = []
+	sizes = SCALES[scale]
+
+	def measure(benchmark, size, function, *args):
+		directory = tempfile.mkdtemp(prefix='fusion-bench-')
+		try:
+			measured = function(directory, size, *args)
+		finally:
+			shutil.rmtree(directory)
+		measured.update({'benchmark': benchmark, 'size': size})
+		measurements.append(measured)
+		print("%-10s %8d %10.4fs" % (benchmark, size, measured['seconds']))
+		sys.stdout.flush()
+
+	benchmarks = {'match': (bench_match, repeat),
+				  'pipeline': (bench_pipeline, output_format, repeat),
+				  'batch': (bench_batch, output_format, workers),
+				  'pq': (bench_pq, repeat),
+				  'memory': (bench_memory, repeat)}
+	for benchmark in BENCHMARKS:
+		if only and benchmark not in only:
+			continue
+		for size in sizes[benchmark]:
+			measure(benchmark, size, *benchmarks[benchmark])
+
+	return measurements
+
+
+def compare(measurements, baseline, tolerance, noise_seconds=0.01):
+
+	""" Prints the ratio of each measurement to the baseline. Slowdowns
+	smaller than noise_seconds are not counted, the small sizes run in
+	well under a millisecond.
+
+	Returns:
+		the number of measurements slower than tolerance allows (int)
+	"""
+
+	baseline_seconds = dict(((measured['benchmark'], measured['size']), measured['seconds'])
+							for measured in baseline['measurements'])
+
+	regressions = 0
+	print("%-10s %8s %10s %10s %7s" % ('benchmark', 'size', 'baseline', 'now', 'ratio'))
+	for measured in measurements:
+		key = (measured['benchmark'], measured['size'])
+		if key not in baseline_seconds:
+			continue
+		ratio = measured['seconds'] / max(baseline_seconds[key], 1e-9)
+		flag = ''
+		if ratio > tolerance and measured['seconds'] - baseline_seconds[key] > noise_seconds:
+			regressions += 1
+			flag = '  REGRESSION'
+		print("%-10s %8d %9.4fs %9.4fs %6.2fx%s" % (key[0], key[1], baseline_seconds[key],
+												   measured['seconds'], ratio, flag))
+	return regressions
+
+
+def check_memory(measurements, ceiling_mb):
+
+	""" Prints the peak memory of each memory measurement
+
+	Returns:
+		the number of measurements above the ceiling (int)
+	"""
+
+	over = 0
+	for measured in measurements:
+		if measured['benchmark'] != 'memory':
+			continue
+		flag = ''
+		if measured['mb_per_10k_rows'] > ceiling_mb:
+			over += 1
+			flag = '  ABOVE CEILING'
+		print("%-10s %8d %9.1fMB %6.2fMB per 10k rows%s" % ('memory', measured['size'], measured['peak_bytes'] / 1e6,
+															measured['mb_per_10k_rows'], flag))
+	return over
+
+
+def main(argv=None):
+
+	parser = argparse.ArgumentParser(description='Benchmark matching, loading, combining and writing')
+	parser.add_argument('--scale', default='quick', choices=sorted(SCALES),
+						help='sizes to run (default: %(default)s)')
+	parser.add_argument('--format', default='csv',
+						help='output format of the pipeline and batch benchmarks (default: %(default)s)')
+	parser.add_argument('--workers', type=int, default=1,
+						help='worker processes of the batch benchmark (default: %(default)s)')
+	parser.add_argument('--repeat', type=int, default=3,
+						help='runs of the match and pipeline benchmarks, the best is kept (default: %(default)s)')
+	parser.add_argument('--save', help='save the measurements as JSON for later comparison')
+	parser.add_argument('--compare', help='JSON of an earlier run to compare against')
+	parser.add_argument('--tolerance', type=float, default=1.25,
+						help='slowdown ratio reported as a regression (default: %(default)s)')
+	parser.add_argument('--only', nargs='+', choices=BENCHMARKS,
+						help='run only these benchmarks, e.g. "memory" to check the memory ceiling')
+	parser.add_argument('--memory-ceiling', type=float, default=MEMORY_CEILING_MB,
+						help='peak MB per 10,000 PCR rows of the memory benchmark (default: %(default)s)')
+	args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+	measurements = run_benchmarks(args.scale, args.format, args.workers, args.repeat, args.only)
+	status = 1 if check_memory(measurements, args.memory_ceiling) else 0
+
+	if args.save:
+		with open(args.save, 'w') as results_file:
+			json.dump({'environment': {'python': platform.python_version(),
+									   'pandas': pd.__version__,
+									   'numpy': np.__version__,
+									   'machine': platform.machine(),
+									   'cpus': os.cpu_count()},
+					   'scale': args.scale,
+					   'format': args.format,
+					   'measurements': measurements},
+					  results_file, indent=2)
+
+	if args.compare:
+		with open(args.compare) as baseline_file:
+			baseline = json.load(baseline_file)
+		if compare(measurements, baseline, args.tolerance):
+			status = 1
+
+	return status
+
+
+if __name__ == '__main__':
+	sys.exit(main())
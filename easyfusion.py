@@ -1,7 +1,60 @@
-import sys, os
-from fusion.fanalyzer import FusionAnalysis
-from PyQt4 import QtGui
-import pandas as pd
+import sys, os, threading
+# Only light modules are imported before the window shows, pandas and
+# fusion.fanalyzer are loaded in the background once it is up (see preload_analysis)
+from fusion.fbatch import iter_pairs
+from fusion.fcache import ResultCache
+from fusion.fmatcher import match_files
+from fusion.fprofile import format_stages, summarize_runs
+from fusion.fwriter import OUTPUT_FORMATS
+from PyQt4 import QtCore, QtGui
+
+class CombineWorker(QtCore.QObject):
+
+	""" Combines the matched pairs away from the GUI thread
+	and reports each finished pair through signals, so the
+	window keeps repainting while a run is in progress. """
+
+	# PairResult, pairs done, total pairs
+	pair_finished = QtCore.pyqtSignal(object, int, int)
+	# True when the run was cancelled before every pair was dispatched
+	finished = QtCore.pyqtSignal(bool)
+
+	def __init__(self, pairs, save_directory, assay_profile, workers, output_format, cache, profile):
+		super(CombineWorker, self).__init__()
+
+		self.pairs = pairs
+		self.save_directory = save_directory
+		self.assay_profile = assay_profile
+		self.workers = workers
+		self.output_format = output_format
+		self.cache = cache
+		self.profile = profile
+		self.cancelled = False
+
+	def cancel(self):
+		"""
+		Stops dispatching new pairs, the pairs already
+		running in a worker process are allowed to finish
+		"""
+
+		self.cancelled = True
+
+	def run(self):
+		""" Combines every pair, emitting progress as each one finishes """
+
+		results = iter_pairs(self.pairs, self.save_directory, self.assay_profile, self.workers,
+							 self.output_format, self.cache, self.profile)
+		done = 0
+
+		for result in results:
+			done += 1
+			self.pair_finished.emit(result, done, len(self.pairs))
+			if self.cancelled:
+				break
+
+		# Closing the generator cancels the pairs that have not started yet
+		results.close()
+		self.finished.emit(self.cancelled)
 
 class FusionGui(QtGui.QWidget):
 
@@ -13,6 +66,22 @@ class FusionGui(QtGui.QWidget):
 		self.pcr_files = []
 		self.lis_files = []
 
+		self.combine_thread = None
+		self.combine_worker = None
+		self.run_stages = []
+
+		# Runs once the event loop has painted the window
+		QtCore.QTimer.singleShot(0, self.preload_analysis)
+
+	def preload_analysis(self):
+		"""
+		Imports the analysis stack on a background thread, so the
+		first run does not wait for it. A run started before it is
+		done waits on the import lock, the import happens only once.
+		"""
+
+		threading.Thread(target=__import__, args=('fusion.fanalyzer',), daemon=True).start()
+
 	def initUI(self):
 
 		grid = QtGui.QGridLayout()
@@ -55,11 +124,43 @@ class FusionGui(QtGui.QWidget):
 		self.status_msg = QtGui.QTextEdit()
 		self.status_msg.setReadOnly(True)
 		self.status_msg.setStyleSheet("background-color: #EEF3F9;")
-		execute_run = QtGui.QPushButton("Save && Combine Files")
+		self.execute_run = QtGui.QPushButton("Save && Combine Files")
+		self.cancel_run = QtGui.QPushButton("Cancel")
+		self.cancel_run.setEnabled(False)
+
+		self.run_progress = QtGui.QProgressBar()
+		self.run_progress.setFormat("%v / %m pairs")
+		self.run_progress.setValue(0)
+
+		# Number of pairs combined in parallel, each in its own process
+		self.worker_count = QtGui.QSpinBox()
+		self.worker_count.setRange(1, os.cpu_count() or 1)
+		self.worker_count.setValue(self.worker_count.maximum())
+		self.worker_count.setPrefix("Workers: ")
+
+		self.output_format = QtGui.QComboBox()
+		self.output_format.addItems(sorted(OUTPUT_FORMATS))
+		self.output_format.setCurrentIndex(self.output_format.findText('xlsx'))
+
+		# Reuse the combined file of pairs that have not changed since the last run
+		self.use_cache = QtGui.QCheckBox("Reuse Unchanged Results")
+		self.use_cache.setChecked(True)
+
+		# Times each stage of every pair and shows a summary at the end of the run
+		self.show_timings = QtGui.QCheckBox("Show Stage Timings")
+
+		hboxExecute = QtGui.QHBoxLayout()
+		hboxExecute.addWidget(self.use_cache)
+		hboxExecute.addWidget(self.show_timings)
+		hboxExecute.addWidget(self.output_format)
+		hboxExecute.addWidget(self.worker_count)
+		hboxExecute.addWidget(self.execute_run, 1)
+		hboxExecute.addWidget(self.cancel_run)
 
 		vboxRun = QtGui.QVBoxLayout()
 		vboxRun.addWidget(self.status_msg)
-		vboxRun.addWidget(execute_run)
+		vboxRun.addWidget(self.run_progress)
+		vboxRun.addLayout(hboxExecute)
 
 		lisUploadBox.setLayout(vboxLISFiles)
 		pcrUploadBox.setLayout(vboxPCRFiles)
@@ -76,7 +177,8 @@ class FusionGui(QtGui.QWidget):
 		upload_pcr_button.clicked.connect(self.populate_fields)
 		clear_upload_lis_button.clicked.connect(self.clear_upload_fields)
 		clear_upload_pcr_button.clicked.connect(self.clear_upload_fields)
-		execute_run.clicked.connect(self.run_program)
+		self.execute_run.clicked.connect(self.run_program)
+		self.cancel_run.clicked.connect(self.cancel_program)
 
 		self.setGeometry(300,300,700,200)
 		self.setWindowTitle('Fusion LIS & PCR Combiner')
@@ -122,107 +224,113 @@ class FusionGui(QtGui.QWidget):
 				list_to_populate.addItem(file_name)
 
 	def run_program(self):
-		""" Executes the program """
+		""" Executes the program on a background thread """
 
-		save_directory = QtGui.QFileDialog.getExistingDirectory(self,'Select Save Directory')
+		save_directory = str(QtGui.QFileDialog.getExistingDirectory(self,'Select Save Directory'))
+		if not save_directory:
+			return
 
 		lisFileTextList = [str(self.lisFileList.item(i).text()) for i in range(self.lisFileList.count())]
 		pcrFileTextList = [str(self.pcrFileList.item(x).text()) for x in range(self.pcrFileList.count())]
 		
-		match_database = self.match_files(lisFileTextList, pcrFileTextList)
+		match = self.match_files(lisFileTextList, pcrFileTextList)
+		pairs = match.pairs
 
 		self.status_msg.clear()
 
-		for identifier, keypairs in match_database.items():
-			if ((identifier == 'missing_lis') or (identifier == 'missing_pcr')):
-				if (identifier == 'missing_lis'):
-					for lis in match_database['missing_lis']:
-						self.status_msg.insertHtml('<b>MISSING FILE</b>: The LIS file %s is missing a PCR pair.<br>' % lis)
-				if (identifier == match_database['missing_pcr']):
-					for pcr in missing_pcr:
-						self.status_msg.insertHtml('<b>MISSING FILE</b>: The PCR file %s is missing a LIS pair.<br>' % pcr)
-			else:
-				successful_run = FusionAnalysis(keypairs[0], keypairs[1], "P 1/2/3/4")
-				if successful_run.check_assay_types():
-					new_file_name = identifier + ".xlsx"
-					save_file_path = os.path.join(str(save_directory), new_file_name)
-					successful_run.combine_files("Paraflu", save_file_path)
-				else:
-					self.status_msg.insertHtml('<b>ASSAY TYPE WARNING</b>: The files %s are not of the specified assay type<br>' % keypairs)
-
-		self.status_msg.insertHtml('<b>RUN IS COMPLETE. Results saved at %s</b>' % save_directory)
-		
-
-
-	def match_files(self, list_of_LIS_files, list_of_PCR_files):
-
-		""" Main purpose of the program is to match
-		the PCR file to its appropriate LIS file. The matching 
-		is done on the worklist-ID and date.
-
-		Args:
-			list_of_LIS_files - all of the LIS files in a list (list)
-			list_of_PCR_files - all of the PCR files in a list (list)
-		Returns:
-			the unique_id as a (key) and list of [lis_file, pcr_file], also
-			notfies of missing pcr or lis files. (dict)
-		"""
-
-		# LIS FILES WITH NO PCR PAIR
-		missing_lis_files = []
-		# PCR FILES WITH NO LIS PAIR
-		missing_pcr_files = []
-		# MAIN INDEX
-		fusion_file_index = {}
+		for lis in match.missing_lis:
+			self.show_status('<b>MISSING FILE</b>: The LIS file %s is missing a PCR pair.<br>' % lis)
+		for pcr in match.missing_pcr:
+			self.show_status('<b>MISSING FILE</b>: The PCR file %s is missing a LIS pair.<br>' % pcr)
+		for name in match.unparseable:
+			self.show_status('<b>UNRECOGNIZED FILE NAME</b>: %s does not follow the file name pattern.<br>' % name)
+		for name in match.duplicates:
+			self.show_status('<b>DUPLICATE FILE</b>: %s has the same identifier as another file and was skipped.<br>' % name)
+
+		self.save_directory = save_directory
+		self.run_progress.setRange(0, max(len(pairs), 1))
+		self.run_progress.setValue(0)
+		self.execute_run.setEnabled(False)
+		self.cancel_run.setEnabled(True)
+
+		cache = ResultCache() if self.use_cache.isChecked() else None
+		profile = 'stages' if self.show_timings.isChecked() else None
+		self.run_stages = []
+
+		self.combine_thread = QtCore.QThread(self)
+		self.combine_worker = CombineWorker(pairs, save_directory, "Paraflu", self.worker_count.value(),
+											str(self.output_format.currentText()), cache, profile)
+		self.combine_worker.moveToThread(self.combine_thread)
+
+		self.combine_thread.started.connect(self.combine_worker.run)
+		self.combine_worker.pair_finished.connect(self.pair_finished)
+		self.combine_worker.finished.connect(self.run_finished)
+		self.combine_worker.finished.connect(self.combine_thread.quit)
+
+		self.combine_thread.start()
+
+	def cancel_program(self):
+		""" Stops dispatching new pairs for the current run """
+
+		if self.combine_worker is not None:
+			# Called directly, the worker thread is busy and would not process a queued signal
+			self.combine_worker.cancel()
+			self.cancel_run.setEnabled(False)
+			self.show_status('<b>CANCELLING</b>: Waiting for the pairs in progress to finish.<br>')
+
+	def pair_finished(self, result, done, total):
+		""" Reports a finished pair and advances the progress bar """
+
+		if result.status == 'combined':
+			self.show_status('<b>COMBINED</b>: %s (%.2fs)%s<br>' % (result.identifier, result.elapsed,
+																	 ' - %s' % result.message if result.message else ''))
+		elif result.status == 'wrong_assay':
+			self.show_status('<b>ASSAY TYPE WARNING</b>: The files %s are not of the specified assay type<br>' % [result.pcr_file, result.lis_file])
+		else:
+			self.show_status('<b>ERROR</b>: %s could not be combined (%s)<br>' % (result.identifier, result.message))
 
-		for pcr_files in list_of_PCR_files:
-			
+		if result.stages:
+			self.run_stages.append(result.stages)
 
-			get_only_pcr_filename = pcr_files[pcr_files.find("@DI"):]
-			partition_pcr_file = get_only_pcr_filename.split("-")
+		self.run_progress.setValue(done)
 
-			unique_id = partition_pcr_file[0].replace("@DI",'') + "_" + \
-						partition_pcr_file[3] + "_" + \
-						partition_pcr_file[4] + "_" + \
-						partition_pcr_file[5].replace('.csv','')
+	def run_finished(self, cancelled):
+		""" Restores the buttons once the worker is done """
 
-			fusion_file_index[unique_id] = [pcr_files]
+		if self.run_stages:
+			self.show_status('<b>STAGE TIMINGS</b> over %d combined pair(s):<pre>%s</pre><br>'
+							 % (len(self.run_stages), format_stages(summarize_runs(self.run_stages))))
 
-		for lis_files in list_of_LIS_files:
+		if cancelled:
+			self.show_status('<b>RUN WAS CANCELLED. Results so far saved at %s</b><br>' % self.save_directory)
+		else:
+			self.show_status('<b>RUN IS COMPLETE. Results saved at %s</b><br>' % self.save_directory)
 
-			get_only_lis_filename = lis_files[lis_files.find("@Pt2"):]
-			partition_lis_file = get_only_lis_filename.split("-")
+		self.execute_run.setEnabled(True)
+		self.cancel_run.setEnabled(False)
+		self.combine_worker = None
 
-			lis_unique_id = partition_lis_file[0].replace('@Pt2','') + "_" + \
-							partition_lis_file[3] + "_" + \
-							partition_lis_file[4] + "_" + \
-							partition_lis_file[5].replace('.lis','')
+	def closeEvent(self, event):
+		""" Lets the pairs in progress finish before the window closes """
 
-		# Checks if the LIS file is paired with an available PCR file
-			try:
-				fusion_file_index[lis_unique_id].append(lis_files)
-			except KeyError:
-				missing_lis_files.append(lis_files)
-				print("No matching PCR file found for %s" % lis_files)
+		if self.combine_worker is not None:
+			self.combine_worker.cancel()
+			self.combine_thread.wait()
+		event.accept()
 
-		# Remove PCR Keys
-		pcr_keys_to_remove = []
+	def show_status(self, html):
+		""" Appends a message to the status box and keeps it scrolled to the end """
 
-		# Checks if the PCR file is paired with a LIS file
-		for uniqueID, pairs in fusion_file_index.items():
-			if (len(pairs) < 2):
-				print("No matching LIS file found for %s" % pairs[0])
-				missing_pcr_files.append(pairs[0])
-				# Remove the unique_id from analysis
-				pcr_keys_to_remove.append(uniqueID)
+		self.status_msg.moveCursor(QtGui.QTextCursor.End)
+		self.status_msg.insertHtml(html)
+		self.status_msg.ensureCursorVisible()
 
-		for pcr_keys in pcr_keys_to_remove:
-			del fusion_file_index[pcr_keys]
+	def match_files(self, list_of_LIS_files, list_of_PCR_files):
 
-		fusion_file_index['missing_lis'] = missing_lis_files
-		fusion_file_index['missing_pcr'] = missing_pcr_files
+		""" Matches the PCR files to their LIS files,
+		see fusion.fmatcher.match_files (MatchResult) """
 
-		return fusion_file_index
+		return match_files(list_of_LIS_files, list_of_PCR_files)
 
 
 
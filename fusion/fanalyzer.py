@@ -5,9 +5,459 @@ consolidate, and perform data analysis on the
 FUSION Paraflu and Flu assays
 """
 
+import csv
+import os
+from collections import namedtuple
+
 import pandas as pd
 import numpy as np
 
+from fusion.fprofile import StageTimer
+from fusion.fwriter import ChunkedWriter, write_frame
+
+# Universal Settings - Can move to a JSON configuration later
+CHANGE_PCR_COLUMN_NAMES = True
+CHANGE_PCR_COLUMN_DICT = {'RFU Range':'Unrounded RFU Range',
+						  'LR_Ct_NonNormalized':'Unrounded Ct'}
+CHANGE_LIS_COLUMN_NAMES = True
+CHANGE_LIS_COLUMN_DICT = {'Interpretation 1':'FAM Rounded Ct',
+						  'Interpretation 2':'HEX Rounded Ct',
+						  'Interpretation 3':'ROX Rounded Ct',
+						  'Interpretation 4':'RED647 Rounded Ct',
+						  'Interpretation 5':'IC Rounded Ct',
+						  'Interpretation 6':'POS/NEG/Invalid for HPIV-1',
+						  'Interpretation 7':'POS/NEG/Invalid for HPIV-2',
+						  'Interpretation 8':'POS/NEG/Invalid for HPIV-3',
+						  'Interpretation 9':'POS/NEG/Invalid for HPIV-4',
+						  'Interpretation 10':'Valid/Invalid for IC',
+						  'OtherData 1':'FAM Rounded RFU Range (HPIV-1)',
+						  'OtherData 2':'HEX Rounded RFU Range (HPIV-2)',
+						  'OtherData 3':'IC Rounded RFU Range',
+						  'OtherData 4':'RED647 Rounded RFU Range (HPIV-4)',
+						  'OtherData 5':'ROX Rounded RFU Range (HPIV-3)',
+						 }
+PCR_COLUMNS_KEEP = ['Specimen Barcode', 'Analyte', 'Run ID',
+					'Channel', 'Unrounded RFU Range', 'EstimatedBaseline',
+					'Unrounded Ct', 'LR_TSlope_NonNormalized','Cartridge Lot #',
+					'CapAndVialTrayID','Test order #', 'FCRBarcode', 'FERBarcode',
+					'ElutionBufferRFID','ReconstitutionBufferRFID', 'OilRFID',
+					'WellID','FusionTestOrder']
+# Column -> (trim_front, trim_back) to partition the barcode numbers
+PCR_TRIM_COLUMNS = {'CapAndVialTrayID': (2, 10),
+					'FCRBarcode': (4, 11),
+					'FERBarcode': (4, 11),
+					'ElutionBufferRFID': (4, 11),
+					'ReconstitutionBufferRFID': (4, 11),
+					'OilRFID': (4, 11)}
+
+LIS_COLUMNS_KEEP = ['Specimen Barcode','Analyte','Run ID','Instrument Flags',
+					'FAM Rounded Ct', 'HEX Rounded Ct', 'ROX Rounded Ct', 'RED647 Rounded Ct',
+					'IC Rounded Ct', 'POS/NEG/Invalid for HPIV-1', 'POS/NEG/Invalid for HPIV-2',
+					'POS/NEG/Invalid for HPIV-3', 'POS/NEG/Invalid for HPIV-4',
+					'Valid/Invalid for IC','Overall_Validity', 'Serial Number', 'Sample Type', 'Sample Name',
+					'Test order #', 'FAM Rounded RFU Range (HPIV-1)', 'HEX Rounded RFU Range (HPIV-2)',
+					'IC Rounded RFU Range', 'RED647 Rounded RFU Range (HPIV-4)',
+					'ROX Rounded RFU Range (HPIV-3)'
+				   ]
+# Columns computed in combine_files rather than read from the LIS file
+LIS_COLUMNS_COMPUTED = ['Overall_Validity']
+
+# Explicit dtypes for loading. Barcodes and IDs stay as text, and the
+# low cardinality fields are categoricals (a handful of values per file).
+PCR_DTYPES = {'Specimen Barcode': object,
+			  'Analyte': 'category',
+			  'Run ID': 'category',
+			  'Channel': 'category',
+			  'CapAndVialTrayID': object,
+			  'FCRBarcode': object,
+			  'FERBarcode': object,
+			  'ElutionBufferRFID': object,
+			  'OilRFID': object,
+			  'ReconstitutionBufferRFID': object,
+			  'Test order #': object
+			  }
+LIS_DTYPES = {'Specimen Barcode': object,
+			  'Analyte': 'category',
+			  'Run ID': 'category',
+			  'Test order #': object
+			  }
+
+
+def source_columns(columns_keep, rename_columns):
+
+	""" Maps the columns kept after renaming back to
+	the column names in the file, so only those are read.
+
+	Args:
+		columns_keep - column names after renaming (list)
+		rename_columns - file column name -> new column name (dict)
+	Returns:
+		the column names to read from the file (set)
+	"""
+
+	original_names = dict((new, old) for old, new in rename_columns.items())
+	return set(original_names.get(column, column) for column in columns_keep)
+
+
+PCR_USECOLS = source_columns(PCR_COLUMNS_KEEP, CHANGE_PCR_COLUMN_DICT if CHANGE_PCR_COLUMN_NAMES else {})
+LIS_USECOLS = source_columns([column for column in LIS_COLUMNS_KEEP if column not in LIS_COLUMNS_COMPUTED],
+							 CHANGE_LIS_COLUMN_DICT if CHANGE_LIS_COLUMN_NAMES else {})
+
+# Specimen Barcode of the row closing the Panther exports
+END_OF_FILE = '[end]'
+
+# Columns identifying a specimen in both files, joined by "_" into its UniqueID
+KEY_COLUMNS = ['Specimen Barcode', 'Run ID', 'Test order #']
+
+# What did not join one to one, each as a list of UniqueIDs
+#	duplicate_keys - keys shared by more than one LIS row, each gets the same PCR channels
+#	lis_without_pcr - LIS rows without PCR rows, their PCR columns are empty
+#	pcr_without_lis - PCR specimens without a LIS row, left out of the output
+JoinReport = namedtuple('JoinReport', ['duplicate_keys', 'lis_without_pcr', 'pcr_without_lis'])
+
+# Interpretation columns, the HPIV targets first and the internal control last
+TARGET_RESULT_COLUMNS = ['POS/NEG/Invalid for HPIV-1', 'POS/NEG/Invalid for HPIV-2',
+						 'POS/NEG/Invalid for HPIV-3', 'POS/NEG/Invalid for HPIV-4']
+IC_RESULT_COLUMN = 'Valid/Invalid for IC'
+RESULT_COLUMNS = TARGET_RESULT_COLUMNS + [IC_RESULT_COLUMN]
+
+# Status flags of an interpretation, see decode_results
+RESULT_NEG = 1					# contains 'neg'
+RESULT_NEG_ANY_CASE = 2			# contains 'neg' in any case
+RESULT_INVALID = 4				# contains 'Invalid'
+RESULT_INVALID_ANY_CASE = 8		# contains 'invalid' in any case
+
+# RFU range column of each interpretation column (same order as RESULT_COLUMNS),
+# shown as "-" when the interpretation has the flag, i.e. nothing was detected
+RESULT_RFU_MASKS = [('FAM Rounded RFU Range (HPIV-1)', RESULT_NEG_ANY_CASE),
+					('HEX Rounded RFU Range (HPIV-2)', RESULT_NEG_ANY_CASE),
+					('ROX Rounded RFU Range (HPIV-3)', RESULT_NEG_ANY_CASE),
+					('RED647 Rounded RFU Range (HPIV-4)', RESULT_NEG_ANY_CASE),
+					('IC Rounded RFU Range', RESULT_INVALID_ANY_CASE)]
+
+
+# Channels of the Paraflu assay, in the order of the output columns
+CHANNELS = ['FAM', 'ROX', 'HEX', 'RED647', 'IC']
+# PCR columns kept for every channel, named '<channel>-<column>' in the output
+PCR_CHANNEL_COLUMNS = ['WellID', 'CapAndVialTrayID', 'Cartridge Lot #', 'FCRBarcode',
+					   'ElutionBufferRFID', 'ReconstitutionBufferRFID', 'OilRFID', 'FusionTestOrder',
+					   'EstimatedBaseline', 'LR_TSlope_NonNormalized', 'Unrounded RFU Range']
+
+
+def channel_columns(column):
+
+	return ['%s-%s' % (channel, column) for channel in CHANNELS]
+
+
+# Columns of the combined file, in order
+OUTPUT_COLUMNS = (['Specimen Barcode', 'Sample Type', 'Analyte', 'Run ID'] +
+				  channel_columns('WellID') +
+				  ['Test order #', 'Instrument Flags',
+				   'FAM Rounded Ct', 'FAM Rounded RFU Range (HPIV-1)',
+				   'HEX Rounded Ct', 'HEX Rounded RFU Range (HPIV-2)',
+				   'ROX Rounded Ct', 'ROX Rounded RFU Range (HPIV-3)',
+				   'RED647 Rounded Ct', 'RED647 Rounded RFU Range (HPIV-4)',
+				   'IC Rounded Ct', 'IC Rounded RFU Range'] +
+				  RESULT_COLUMNS +
+				  ['Overall_Validity', 'Serial Number'] +
+				  [name for column in PCR_CHANNEL_COLUMNS[1:] for name in channel_columns(column)])
+
+
+class ChannelLayoutError(ValueError):
+
+	""" The PCR rows of a file do not follow the channel layout of the assay """
+
+	pass
+
+
+def result_flags(value):
+
+	""" Status flags of one interpretation, e.g. 'neg' or 'Invalid'
+
+	Args:
+		value - the interpretation, missing values have no flags (str)
+	Returns:
+		the RESULT_* flags set for the value (int)
+	"""
+
+	if not isinstance(value, str):
+		return 0
+
+	lowered = value.lower()
+	flags = 0
+	if 'neg' in value:
+		flags |= RESULT_NEG
+	if 'neg' in lowered:
+		flags |= RESULT_NEG_ANY_CASE
+	if 'Invalid' in value:
+		flags |= RESULT_INVALID
+	if 'invalid' in lowered:
+		flags |= RESULT_INVALID_ANY_CASE
+	return flags
+
+
+def decode_results(frame, columns):
+
+	""" Decodes interpretation columns into a status matrix. Each
+	column is factorized once and only its distinct values (a handful
+	per file) are classified, so the strings are scanned a single time.
+
+	Args:
+		frame - the LIS data (DataFrame)
+		columns - the interpretation columns to decode (list)
+	Returns:
+		the RESULT_* flags, one row per row of the frame and
+		one column per interpretation column (numpy uint8 array)
+	"""
+
+	status = np.zeros((len(frame), len(columns)), dtype=np.uint8)
+
+	for position, column in enumerate(columns):
+		codes, uniques = pd.factorize(frame[column])
+		# The extra last entry is picked by the -1 code of missing values
+		flags = np.array([result_flags(value) for value in uniques] + [0], dtype=np.uint8)
+		status[:, position] = flags[codes]
+
+	return status
+
+
+def channel_blocks(frame, index_column, channel_column, channels, value_columns, index_labels=None,
+				   check_absent=True):
+
+	""" Long to wide conversion for a known channel layout. Every
+	row is placed into its (specimen, channel) slot of each value
+	column directly, instead of going through a general pivot.
+	Specimens missing some channels get empty cells, like a pivot.
+	Rows of channels outside the layout are left out.
+
+	Args:
+		frame - the PCR data, one row per specimen and channel (DataFrame)
+		index_column - the column identifying the specimen (str)
+		channel_column - the column holding the channel (str)
+		channels - the channels of the assay, in output order (list)
+		value_columns - the columns to spread over the channels (list)
+		index_labels - names the specimens in error messages, called with
+			an array of index values, None shows the values (function)
+		check_absent - raise when a channel is missing from every specimen. A
+			chunk of the file checks the channels of the whole file instead (bool)
+	Returns:
+		one row per specimen, with a '<channel>-<column>' column per
+		channel and value column (DataFrame)
+	Raises:
+		ChannelLayoutError - a specimen has the same channel twice, or a
+			channel is missing from the whole file
+	"""
+
+	channel_codes = pd.Categorical(frame[channel_column], categories=channels).codes
+	in_layout = channel_codes >= 0
+	if not in_layout.all():
+		frame = frame[in_layout]
+		channel_codes = channel_codes[in_layout]
+
+	row_codes, index_values = pd.factorize(frame[index_column], sort=True)
+	slots = row_codes * len(channels) + channel_codes
+
+	slot_counts = np.bincount(slots, minlength=len(index_values) * len(channels))
+	if (slot_counts > 1).any():
+		duplicated = np.unique(index_values[np.nonzero(slot_counts > 1)[0] // len(channels)])
+		if index_labels is not None:
+			duplicated = index_labels(duplicated)
+		raise ChannelLayoutError("Channel appears more than once for %d specimen(s), e.g. %s"
+								 % (len(duplicated), ', '.join(str(value) for value in duplicated[:5])))
+
+	if check_absent:
+		check_channels(slot_counts.reshape(len(index_values), len(channels)).any(axis=0), channels)
+
+	# Row of the frame for each slot, -1 for the empty slots
+	source_rows = np.full(len(index_values) * len(channels), -1, dtype=np.intp)
+	source_rows[slots] = np.arange(len(slots))
+
+	blocks = {}
+	for column in value_columns:
+		values = frame[column].values
+		# Extension arrays, e.g. the pyarrow backed strings, cannot be reshaped
+		if not pd.api.types.is_numeric_dtype(values.dtype):
+			values = np.asarray(values, dtype=object)
+		spread = pd.api.extensions.take(values, source_rows, allow_fill=True)
+		spread = spread.reshape(len(index_values), len(channels))
+		for position, channel in enumerate(channels):
+			blocks['%s-%s' % (channel, column)] = spread[:, position]
+
+	return pd.DataFrame(blocks, index=pd.Index(index_values, name=index_column))
+
+
+def check_channels(filled, channels):
+
+	""" Checks that every channel of the layout has PCR rows
+
+	Args:
+		filled - whether each channel has a row of any specimen (numpy bool array)
+		channels - the channels of the assay, in the order of filled (list)
+	Raises:
+		ChannelLayoutError - some channels have no rows while others do
+	"""
+
+	absent = [channel for position, channel in enumerate(channels) if not filled[position]]
+	if absent and filled.any():
+		raise ChannelLayoutError("Channel(s) missing from the PCR file: %s" % ', '.join(absent))
+
+
+def first_row(path, delimiter):
+
+	""" Reads the header and the first data row of an
+	export, without parsing the rest of the file
+
+	Args:
+		path - path to the PCR or LIS file (str)
+		delimiter - the field separator of the file (str)
+	Returns:
+		column name -> value of the first row, empty
+		when the file has no data rows (dict)
+	"""
+
+	with open(path, newline='', encoding='utf-8-sig') as export:
+		reader = csv.reader(export, delimiter=delimiter)
+		header = next(reader, [])
+		row = next(reader, [])
+	return dict(zip(header, row))
+
+
+def unique_ids(specimen_barcodes, run_ids, test_orders):
+
+	""" The UniqueID of each row, '<Specimen Barcode>_<Run ID>_<Test order #>',
+	naming the specimen in the output. The tables are joined on SpecimenKeys
+
+	Args:
+		specimen_barcodes - the 'Specimen Barcode' of each row (array)
+		run_ids - the 'Run ID' of each row (array or Categorical)
+		test_orders - the 'Test order #' of each row (array)
+	Returns:
+		the UniqueID of each row, missing when a part is missing (numpy object array)
+	"""
+
+	return (pd.Series(specimen_barcodes, dtype=object) + "_" +
+			pd.Series(np.asarray(run_ids, dtype=object)) + "_" +
+			pd.Series(test_orders, dtype=object)).values
+
+
+def describe_join(report):
+
+	""" One line summary of a join report, e.g. for the message of a pair
+
+	Args:
+		report - what did not join one to one (JoinReport)
+	Returns:
+		the summary, None when everything joined one to one (str)
+	"""
+
+	if report is None:
+		return None
+
+	parts = []
+	for unique_ids, description in ((report.duplicate_keys, 'key(s) on more than one LIS row'),
+									(report.lis_without_pcr, 'LIS row(s) without PCR rows'),
+									(report.pcr_without_lis, 'PCR specimen(s) without a LIS row')):
+		if unique_ids:
+			parts.append('%d %s, e.g. %s' % (len(unique_ids), description,
+											 ', '.join(str(unique_id) for unique_id in unique_ids[:3])))
+	return '; '.join(parts) or None
+
+
+class SpecimenKeys():
+
+	""" SpecimenKeys Class
+	Integer codes of the (Specimen Barcode, Run ID, Test order #)
+	key of the LIS rows. Each key column is factorized once, and the
+	codes are combined one column at a time and factorized again, so
+	they stay below the number of LIS rows. The PCR rows are given the
+	code of their LIS row, so the tables are joined on integers
+	rather than on a UniqueID string built for every row, and barcodes
+	containing "_" cannot collide.
+	"""
+
+	def __init__(self, key_columns):
+
+		"""
+		Args:
+			key_columns - the values of each key column of the LIS rows, in KEY_COLUMNS order (list of arrays)
+		"""
+
+		self.key_columns = key_columns
+		# (distinct values of the column, combined codes up to the column) of each key column
+		self.levels = []
+
+		codes = None
+		for values in key_columns:
+			# Missing values are kept as a value, they join like the UniqueID strings did
+			level_codes, uniques = pd.factorize(values, use_na_sentinel=False)
+			level = pd.Index(np.asarray(uniques, dtype=object))
+			combined = level_codes.astype(np.int64) if codes is None else codes * len(level) + level_codes
+			codes, combined_uniques = pd.factorize(combined)
+			self.levels.append((level, pd.Index(combined_uniques)))
+
+		# Key code of each LIS row, and the number of distinct keys
+		self.codes = codes
+		self.size = len(self.levels[-1][1])
+
+		# Number of LIS rows and first LIS row of each key code, every code has a row
+		self.counts = np.bincount(codes, minlength=self.size)
+		self.first_rows = np.unique(codes, return_index=True)[1]
+
+	def codes_for(self, key_columns):
+
+		""" Key codes of other rows, e.g. the PCR rows
+
+		Args:
+			key_columns - the values of each key column, in KEY_COLUMNS order (list of arrays)
+		Returns:
+			the key code of each row, -1 when no LIS row has its key (numpy int array)
+		"""
+
+		codes = None
+		for (level, combined_uniques), values in zip(self.levels, key_columns):
+			level_codes = level.get_indexer(np.asarray(values, dtype=object))
+			if codes is None:
+				combined = level_codes.astype(np.int64)
+				missing = level_codes < 0
+			else:
+				combined = codes * len(level) + level_codes
+				missing = (codes < 0) | (level_codes < 0)
+			codes = combined_uniques.get_indexer(combined)
+			codes[missing] = -1
+		return codes
+
+	def rows_for(self, codes):
+
+		""" The LIS rows with the key codes, in LIS order
+
+		Args:
+			codes - key codes without duplicates (numpy int array)
+		Returns:
+			the positions of the LIS rows (numpy int array)
+		"""
+
+		if (self.counts[codes] == 1).all():
+			return np.sort(self.first_rows[codes])
+		return np.nonzero(np.isin(self.codes, codes))[0]
+
+	def duplicated(self):
+
+		""" Key codes shared by more than one LIS row (numpy int array) """
+
+		return np.nonzero(self.counts > 1)[0]
+
+	def unique_ids(self, codes):
+
+		""" UniqueID of the key codes, see unique_ids
+
+		Returns:
+			the UniqueID of each code (list)
+		"""
+
+		rows = self.first_rows[np.asarray(codes, dtype=np.intp)]
+		return list(unique_ids(*[np.asarray(values)[rows] for values in self.key_columns]))
+
+
 class FusionAnalysis():
 
 	""" FusionAnalysis Class
@@ -17,269 +467,488 @@ class FusionAnalysis():
 
 	Features:
 		1) Combine PCR & LIS files
-		2) Statistical Analysis (future update)
-		3) PQ (Performance Qualification) (future update)
+		2) Statistical Analysis, see fusion.pqanalyzer
+		3) PQ (Performance Qualification), see fusion.pqanalyzer.PQAnalysis
 
 	"""
 
-	def __init__(self, pcr_path, lis_path, assay_type):
-
-		self.assay_type = assay_type
-
-		if (assay_type == 'P 1/2/3/4'):
-
-			self.pcr_file = pd.read_csv(pcr_path,
-										delimiter=',',
-										encoding='utf-8-sig',
-										dtype={'CapAndVialTrayID': object,
-											   'ElutionBufferRFID': object,
-											   'OilRFID': object,
-											   'ReconstitutionBufferRFID': object,
-											   'Test order #': object
-											   }
-									 	)
-
-			self.lis_file = pd.read_csv(lis_path,
-										delimiter='\t',
-										encoding='utf-8-sig',
-										dtype={'Test order #': object}
-										)
+	def __init__(self, pcr_path, lis_path, assay_type, timer=None, chunk_rows=None):
 
+		"""
+		Args:
+			pcr_path - path to the PCR file (str)
+			lis_path - path to the LIS file (str)
+			assay_type - the assay type written in the PCR 'Analyte' column (str)
+			timer - records the time, rows and memory of each stage,
+				None disables the instrumentation (StageTimer)
+			chunk_rows - read the PCR file this many rows at a time in
+				combine_files, so the memory used follows the chunk size rather
+				than the file size. None reads the whole file (int)
+		"""
 
+		self.assay_type = assay_type
+		self.pcr_path = pcr_path
+		self.lis_path = lis_path
+		self.chunk_rows = chunk_rows
+		self.timer = timer if timer is not None else StageTimer(enabled=False)
+		self.timer.start()
+
+		# The files are parsed on first use, so a pair rejected by
+		# check_assay_types never has its files parsed
+		self._pcr_file = None
+		self._lis_file = None
+
+		# What did not join one to one in the last combine (JoinReport)
+		self.join_report = None
+
+	@property
+	def pcr_file(self):
+
+		""" The PCR rows, parsed on first use (DataFrame) """
+
+		if self._pcr_file is None:
+			# Only the columns used by combine_files are parsed, the raw curve
+			# columns of the PCR export are skipped. A callable keeps a missing
+			# column from failing the read, combine_files reports it instead.
+			self._pcr_file = pd.read_csv(self.pcr_path,
+										 delimiter=',',
+										 encoding='utf-8-sig',
+										 usecols=lambda column: column in PCR_USECOLS,
+										 dtype=PCR_DTYPES
+										 )
+			self.timer.lap('read_pcr', len(self._pcr_file))
+		return self._pcr_file
+
+	@pcr_file.setter
+	def pcr_file(self, frame):
+
+		self._pcr_file = frame
+
+	@property
+	def lis_file(self):
+
+		""" The LIS rows, parsed on first use (DataFrame) """
+
+		if self._lis_file is None:
+			self._lis_file = pd.read_csv(self.lis_path,
+										 delimiter='\t',
+										 encoding='utf-8-sig',
+										 usecols=lambda column: column in LIS_USECOLS,
+										 dtype=LIS_DTYPES
+										 )
+			self.timer.lap('read_lis', len(self._lis_file))
+		return self._lis_file
+
+	@lis_file.setter
+	def lis_file(self, frame):
+
+		self._lis_file = frame
 
 	def check_assay_types(self):
 
 		""" Checks if the assay types designated
 		on the file is the same as the one that is 
-		specified """
+		specified. Only the header and the first row
+		of the PCR file are read, unless it is already parsed """
+
+		if self._pcr_file is not None:
+			analyte = self._pcr_file['Analyte'][0]
+		else:
+			analyte = first_row(self.pcr_path, ',').get('Analyte')
 
-		if (self.pcr_file['Analyte'][0] != self.assay_type):
+		if (analyte != self.assay_type):
 			return False
 		return True
 
 
-	def combine_files(self, assay_profile, save_to):
+	def combine_files(self, assay_profile, save_to, output_format=None, store=None, identifier=None):
 
 		""" Combines the PCR & LIS Files 
 		Args:
 			assay_profile - the type of assay to manipulate (str)
 			save_to - destination to save the file (str)
+			output_format - 'xlsx', 'xlsx-stream', 'csv', 'parquet' or 'feather',
+				None picks it from the extension of save_to. Only 'xlsx-stream',
+				'csv' and 'parquet' when reading the PCR file in chunks (str)
+			store - also adds the combined rows to this dataset, None
+				only saves the file (fusion.fstore.ResultStore)
+			identifier - the pair the rows are stored under, None uses
+				the name of save_to without its extension (str)
 		Returns:
 			None
 		Output:
-			Combined LIS & PCR file in *.csv format
+			Combined LIS & PCR file in the selected format
+		"""
+
+		if store is not None and identifier is None:
+			identifier = os.path.splitext(os.path.basename(save_to))[0]
+
+		if self.chunk_rows:
+			self.combine_chunks(save_to, output_format, store, identifier)
+			return
+
+		save_as = self.combined_frame(assay_profile)
+
+		# Save destination
+		self.timer.start()
+		write_frame(save_as, save_to, output_format)
+		self.timer.lap('write', len(save_as))
+
+		if store is not None:
+			store.add(identifier, save_as)
+			self.timer.lap('store', len(save_as))
+
+	def combined_frame(self, assay_profile):
+
+		""" Combines the PCR & LIS Files into a single
+		dataframe, one row per specimen. What did not join
+		is left in join_report.
+		Args:
+			assay_profile - the type of assay to manipulate (str)
+		Returns:
+			the combined LIS & PCR data indexed by UniqueID (DataFrame)
 		"""
 
-		# Universal Settings - Can move to a JSON configuration later
-		CHANGE_PCR_COLUMN_NAMES = True
-		CHANGE_PCR_COLUMN_DICT = {'RFU Range':'Unrounded RFU Range',
-								  'LR_Ct_NonNormalized':'Unrounded Ct'}
-		CHANGE_LIS_COLUMN_NAMES = True
-		CHANGE_LIS_COLUMN_DICT = {'Interpretation 1':'FAM Rounded Ct',
-                           		  'Interpretation 2':'HEX Rounded Ct',
-		                          'Interpretation 3':'ROX Rounded Ct',
-		                          'Interpretation 4':'RED647 Rounded Ct',
-		                          'Interpretation 5':'IC Rounded Ct',
-		                          'Interpretation 6':'POS/NEG/Invalid for HPIV-1',
-		                          'Interpretation 7':'POS/NEG/Invalid for HPIV-2',
-		                          'Interpretation 8':'POS/NEG/Invalid for HPIV-3',
-		                          'Interpretation 9':'POS/NEG/Invalid for HPIV-4',
-		                          'Interpretation 10':'Valid/Invalid for IC',
-		                          'OtherData 1':'FAM Rounded RFU Range (HPIV-1)',
-		                          'OtherData 2':'HEX Rounded RFU Range (HPIV-2)',
-		                          'OtherData 3':'IC Rounded RFU Range',
-		                          'OtherData 4':'RED647 Rounded RFU Range (HPIV-4)',
-		                          'OtherData 5':'ROX Rounded RFU Range (HPIV-3)',
-                          		 }
-		PCR_COLUMNS_KEEP = ['Specimen Barcode', 'Analyte', 'Run ID', 
-                            'Channel', 'Unrounded RFU Range', 'EstimatedBaseline',
-                        	'Unrounded Ct', 'LR_TSlope_NonNormalized','Cartridge Lot #',
-                         	'CapAndVialTrayID','Test order #', 'FCRBarcode', 'FERBarcode',
-                         	'ElutionBufferRFID','ReconstitutionBufferRFID', 'OilRFID',
-                         	'WellID','FusionTestOrder']
-
-		LIS_COLUMNS_KEEP = ['Specimen Barcode','Analyte','Run ID','Instrument Flags',
-		                      'FAM Rounded Ct', 'HEX Rounded Ct', 'ROX Rounded Ct', 'RED647 Rounded Ct', 
-		                      'IC Rounded Ct', 'POS/NEG/Invalid for HPIV-1', 'POS/NEG/Invalid for HPIV-2',
-		                      'POS/NEG/Invalid for HPIV-3', 'POS/NEG/Invalid for HPIV-4',
-		                      'Valid/Invalid for IC','Overall_Validity', 'Serial Number', 'Sample Type', 'Sample Name',
-		                      'Test order #', 'FAM Rounded RFU Range (HPIV-1)', 'HEX Rounded RFU Range (HPIV-2)',
-		                      'IC Rounded RFU Range', 'RED647 Rounded RFU Range (HPIV-4)', 
-		                      'ROX Rounded RFU Range (HPIV-3)'
-		                    ]
-
-		if CHANGE_PCR_COLUMN_NAMES:
-			self.pcr_file.rename(columns=CHANGE_PCR_COLUMN_DICT, inplace=True)
-		if CHANGE_LIS_COLUMN_NAMES:
-			self.lis_file.rename(columns=CHANGE_LIS_COLUMN_DICT, inplace=True)
+		if self.chunk_rows:
+			raise ValueError("The whole PCR file is not loaded when reading it in chunks, "
+							 "use combine_files instead")
+
+		self.timer.start()
 
 		# -----------> STARTING HERE IS PARAFLU SPECIFIC
 
+		# --- START LIS MODIFICATIONS
+
+		lis_file_filtered_columns, keys = self.lis_table()
+
+		# --- END LIS MODIFICATIONS
+
 		# --- START PCR MODIFICATIONS
 
-		# Partition the barcode numbers
-		self.pcr_file['CapAndVialTrayID'] = self.pcr_file['CapAndVialTrayID'].apply(lambda num: self.trimmer(num, trim_front=2, trim_back=10)) 
-		self.pcr_file['FCRBarcode'] = self.pcr_file['FCRBarcode'].apply(lambda num: self.trimmer(num, trim_front=4, trim_back=11))
-		self.pcr_file['FERBarcode'] = self.pcr_file['FERBarcode'].apply(lambda num: self.trimmer(num, trim_front=4, trim_back=11))
-		self.pcr_file['ElutionBufferRFID'] = self.pcr_file['ElutionBufferRFID'].apply(lambda num: self.trimmer(num, trim_front=4, trim_back=11))
-		self.pcr_file['ReconstitutionBufferRFID'] = self.pcr_file['ReconstitutionBufferRFID'].apply(lambda num: self.trimmer(num,trim_front=4, trim_back=11))
-		self.pcr_file['OilRFID'] = self.pcr_file['OilRFID'].apply(lambda num: self.trimmer(num, trim_front=4, trim_back=11))
+		pcr_rows, pcr_without_lis = self.matched_pcr_rows(self.pcr_file, keys)
+		wide_pcr_file = channel_blocks(pcr_rows, 'Key', 'Channel', CHANNELS, PCR_CHANNEL_COLUMNS,
+									   index_labels=keys.unique_ids)
+		self.timer.lap('pivot', len(wide_pcr_file))
 
-		pcr_file_filtered_columns = self.pcr_file[PCR_COLUMNS_KEEP]
+		# --- END PCR MODIFICATIONS
+		# --- START COMBINING
+
+		save_as, matched = self.join_tables(lis_file_filtered_columns, keys.codes, wide_pcr_file, keys.size)
+		self.join_report = JoinReport(keys.unique_ids(keys.duplicated()),
+									  list(save_as.index[~matched]), pcr_without_lis)
+
+		return save_as
+
+	def pcr_rows(self, pcr_file, keys):
+
+		""" Trims and filters the PCR rows down to what the wide
+		table needs, and gives each row the key code of its LIS
+		row. Only those columns are copied, once, and pcr_file is
+		left as it is.
+		Args:
+			pcr_file - PCR rows as read from the file, the whole file or a chunk (DataFrame)
+			keys - the keys of the LIS rows (SpecimenKeys)
+		Returns:
+			the key code, -1 for the rows without a LIS row, the channel
+			and the per channel columns, without the '[end]' row (DataFrame)
+		"""
 
-		# Add an extra column to help group the subjects. Will later to be used for combining with another dataframe.
-		pcr_file_filtered_columns = pcr_file_filtered_columns.assign(UniqueID = pcr_file_filtered_columns['Specimen Barcode'] + "_" + 
-                                                             					pcr_file_filtered_columns['Run ID'] + "_" + 
-                                                             				    pcr_file_filtered_columns['Test order #'])
+		rename = CHANGE_PCR_COLUMN_DICT if CHANGE_PCR_COLUMN_NAMES else {}
+		original_names = dict((new, old) for old, new in rename.items())
+		missing = [column for column in PCR_COLUMNS_KEEP if original_names.get(column, column) not in pcr_file.columns]
+		if missing:
+			raise KeyError("PCR columns not in the file: %s" % missing)
 
 		# Remove the '[end]' from 'Specimen Barcode', a designation for end of file that came from the automated Panther Software
-		pcr_file_filtered_columns = pcr_file_filtered_columns[~pcr_file_filtered_columns['Specimen Barcode'].str.contains('[end]')]
+		keep = (pcr_file['Specimen Barcode'] != END_OF_FILE).values
 
-		# Pivot the PCR File - the long to wide conversion
-		pivot_pcr_file = pcr_file_filtered_columns.pivot(index='UniqueID', columns='Channel')
+		def kept(column):
+			return pcr_file[original_names.get(column, column)].values[keep]
 
-		# Merge columns from multilayer to single layer headers
-		pivot_pcr_file.columns = [name[1]+"-"+name[0] for name in pivot_pcr_file.columns.values]
+		# The key code groups the rows of a specimen and joins them to its LIS row
+		rows = {'Key': keys.codes_for([kept(column) for column in KEY_COLUMNS]),
+				'Channel': kept('Channel')}
+		for column in PCR_CHANNEL_COLUMNS:
+			rows[column] = kept(column)
+		pcr_file_filtered_columns = pd.DataFrame(rows, copy=False)
+		self.timer.lap('pcr_filter', len(pcr_file_filtered_columns))
 
-		# --- END PCR MODIFICATIONS
+		# Partition the barcode numbers, of the columns the wide table keeps
+		trim_columns = dict((column, trim) for column, trim in PCR_TRIM_COLUMNS.items() if column in rows)
+		for column, trimmed in self.trimmed_columns(pcr_file_filtered_columns, trim_columns).items():
+			pcr_file_filtered_columns[column] = trimmed
+		self.timer.lap('trim', len(pcr_file_filtered_columns))
 
-		# --- START LIS MODIFICATIONS
+		return pcr_file_filtered_columns
+
+	def matched_pcr_rows(self, pcr_file, keys):
+
+		""" The PCR rows of the specimens in the LIS file, see pcr_rows
+
+		Returns:
+			the PCR rows with a LIS row (DataFrame) and the UniqueID
+			of each specimen without a LIS row (list)
+		"""
+
+		rows = self.pcr_rows(pcr_file, keys)
+
+		unmatched = rows['Key'].values < 0
+		if not unmatched.any():
+			return rows, []
+
+		key_values = pcr_file[KEY_COLUMNS].values[(pcr_file['Specimen Barcode'] != END_OF_FILE).values][unmatched]
+		pcr_without_lis = list(pd.unique(unique_ids(key_values[:, 0], key_values[:, 1], key_values[:, 2])))
+		return rows[~unmatched], pcr_without_lis
+
+	def lis_table(self):
+
+		""" Works out the validity, masks the RFU ranges of the
+		negative results and indexes the LIS rows by UniqueID.
+		Each kept column is copied once and the loaded LIS
+		rows are left as they are, so they can be combined again.
+		Returns:
+			the kept LIS columns indexed by UniqueID (DataFrame) and
+			the key codes of its rows (SpecimenKeys)
+		"""
+
+		lis_file = self.lis_file
+		rename = CHANGE_LIS_COLUMN_DICT if CHANGE_LIS_COLUMN_NAMES else {}
+		original_names = dict((new, old) for old, new in rename.items())
 
 		# Remove the '[end]' from 'Specimen Barcode', a designation for end of file that came from the automated Panther Software
-		self.lis_file = self.lis_file[~self.lis_file['Specimen Barcode'].str.contains('[end]')]
-
-		# Check for overall validity
-		self.lis_file['Overall_Validity'] = "Valid"
-		self.lis_file['Overall_Validity'][(
-		                                (self.lis_file['POS/NEG/Invalid for HPIV-1']).str.contains('neg') &
-		                                (self.lis_file['POS/NEG/Invalid for HPIV-2']).str.contains('neg') &
-		                                (self.lis_file['POS/NEG/Invalid for HPIV-3']).str.contains('neg') &
-		                                (self.lis_file['POS/NEG/Invalid for HPIV-4']).str.contains('neg') &
-		                                (self.lis_file['Valid/Invalid for IC']).str.contains('Invalid')
-		                             ) |
-		                                (self.lis_file['POS/NEG/Invalid for HPIV-1']).str.contains('Invalid') |
-		                                (self.lis_file['POS/NEG/Invalid for HPIV-2']).str.contains('Invalid') |
-		                                (self.lis_file['POS/NEG/Invalid for HPIV-3']).str.contains('Invalid') |
-		                                (self.lis_file['POS/NEG/Invalid for HPIV-4']).str.contains('Invalid')] = "Invalid"
-
-		# Filter Columns
-		lis_file_filtered_columns = self.lis_file[LIS_COLUMNS_KEEP]
-
-		# Now let's give the table a unique id like we did for the PCR data so we can re-combine them!  
-		# Add an extra column to help group the subjects. Will later to be used for combining with another dataframe.
-		lis_file_filtered_columns = lis_file_filtered_columns.assign(UniqueID = lis_file_filtered_columns['Specimen Barcode'] + "_" + 
-		                                                            			lis_file_filtered_columns['Run ID'] + "_" + 
-		                                                             			lis_file_filtered_columns['Test order #'])
-		lis_file_filtered_columns = lis_file_filtered_columns.set_index(['UniqueID'])
+		keep = (lis_file['Specimen Barcode'] != END_OF_FILE).values
 
-		# --- END LIS MODIFICATIONS
-		# --- START COMBINING
+		lis_columns = {}
+		for column in LIS_COLUMNS_KEEP:
+			if column not in LIS_COLUMNS_COMPUTED:
+				lis_columns[column] = lis_file[original_names.get(column, column)].values[keep]
+		lis_columns = pd.DataFrame(lis_columns, copy=False)
+
+		# Decode the interpretations once, the validity and the RFU masking are both read from the status
+		status = decode_results(lis_columns, RESULT_COLUMNS)
+		targets = status[:, :len(TARGET_RESULT_COLUMNS)]
+		control = status[:, len(TARGET_RESULT_COLUMNS)]
 
-		# Combine Files on Unique Key
-		pcr_and_lis = lis_file_filtered_columns.join(pivot_pcr_file)
+		# Check for overall validity - every target negative with an invalid IC, or any target invalid
+		invalid = ((np.all(targets & RESULT_NEG, axis=1) & ((control & RESULT_INVALID) > 0)) |
+				   np.any(targets & RESULT_INVALID, axis=1))
+		lis_columns['Overall_Validity'] = np.where(invalid, "Invalid", "Valid").astype(object)
 
 		# Logic calls to see if a positive hit was found, if not, mark the RFU Range channel with a "-".
-		pcr_and_lis.loc[pcr_and_lis['POS/NEG/Invalid for HPIV-1'].str.contains("neg", case=False), 'FAM Rounded RFU Range (HPIV-1)'] = "-"
-		pcr_and_lis.loc[pcr_and_lis['POS/NEG/Invalid for HPIV-2'].str.contains("neg", case=False), 'HEX Rounded RFU Range (HPIV-2)'] = "-"
-		pcr_and_lis.loc[pcr_and_lis['POS/NEG/Invalid for HPIV-3'].str.contains("neg", case=False), 'ROX Rounded RFU Range (HPIV-3)'] = "-"
-		pcr_and_lis.loc[pcr_and_lis['POS/NEG/Invalid for HPIV-4'].str.contains("neg", case=False), 'RED647 Rounded RFU Range (HPIV-4)'] = "-"
-		pcr_and_lis.loc[pcr_and_lis['Valid/Invalid for IC'].str.contains("Invalid", case=False), 'IC Rounded RFU Range'] = "-"
-
-		# Consolidate these columns since they more or less have the same information per channel
-		pcr_and_lis.loc[:,'WellID'] = pcr_and_lis['FAM-WellID']
-		pcr_and_lis.loc[:,'CapAndVialTrayID'] = pcr_and_lis['FAM-CapAndVialTrayID']
-		pcr_and_lis.loc[:,'Cartridge Lot #'] = pcr_and_lis['FAM-Cartridge Lot #']
-		pcr_and_lis.loc[:,'FCRBarcode'] = pcr_and_lis['FAM-FCRBarcode']
-		pcr_and_lis.loc[:,'FERBarcode'] = pcr_and_lis['FAM-FERBarcode']
-		pcr_and_lis.loc[:,'ElutionBufferRFID'] = pcr_and_lis['FAM-ElutionBufferRFID']
-		pcr_and_lis.loc[:,'ReconstitutionBufferRFID'] = pcr_and_lis['FAM-ReconstitutionBufferRFID']
-		pcr_and_lis.loc[:,'OilRFID'] = pcr_and_lis['FAM-OilRFID']
-		pcr_and_lis.loc[:,'FusionTestOrder'] = pcr_and_lis['FAM-FusionTestOrder']
-
-		# Final columns to keep
-		try:
-			save_as = pcr_and_lis[['Specimen Barcode', 
-			             'Sample Type', 'Analyte', 
-			             'Run ID', 
-			             'FAM-WellID', 
-			             'ROX-WellID',
-			             'HEX-WellID',
-			             'RED647-WellID', 
-			             'IC-WellID',
-			             'Test order #', 
-			             'Instrument Flags',
-			             'FAM Rounded Ct',
-			             'FAM Rounded RFU Range (HPIV-1)',
-			             'HEX Rounded Ct',
-			             'HEX Rounded RFU Range (HPIV-2)',
-			             'ROX Rounded Ct',
-			             'ROX Rounded RFU Range (HPIV-3)',
-			             'RED647 Rounded Ct',
-			             'RED647 Rounded RFU Range (HPIV-4)',
-			             'IC Rounded Ct',
-			             'IC Rounded RFU Range',
-			             'POS/NEG/Invalid for HPIV-1',
-			             'POS/NEG/Invalid for HPIV-2',
-			             'POS/NEG/Invalid for HPIV-3',
-			             'POS/NEG/Invalid for HPIV-4',
-			             'Valid/Invalid for IC',
-			             'Overall_Validity',
-			             'Serial Number',
-			             'FAM-CapAndVialTrayID',
-			             'ROX-CapAndVialTrayID',
-			             'HEX-CapAndVialTrayID',
-			             'RED647-CapAndVialTrayID',
-			             'IC-CapAndVialTrayID',
-			             'FAM-Cartridge Lot #',
-			             'ROX-Cartridge Lot #',
-			             'HEX-Cartridge Lot #',
-			             'RED647-Cartridge Lot #',
-			             'IC-Cartridge Lot #',
-			             'FAM-FCRBarcode',
-			             'ROX-FCRBarcode',
-			             'HEX-FCRBarcode',
-			             'RED647-FCRBarcode',
-			             'IC-FCRBarcode',
-			             'FAM-ElutionBufferRFID',
-			             'ROX-ElutionBufferRFID',
-			             'HEX-ElutionBufferRFID',
-			             'RED647-ElutionBufferRFID',
-			             'IC-ElutionBufferRFID',
-			             'FAM-ReconstitutionBufferRFID',
-			             'ROX-ReconstitutionBufferRFID',
-			             'HEX-ReconstitutionBufferRFID',
-			             'RED647-ReconstitutionBufferRFID',
-			             'IC-ReconstitutionBufferRFID',
-			             'FAM-OilRFID',
-			             'ROX-OilRFID',
-			             'HEX-OilRFID',
-			             'RED647-OilRFID',
-			             'IC-OilRFID',
-			             'FAM-FusionTestOrder',
-			             'ROX-FusionTestOrder',
-			             'HEX-FusionTestOrder',
-			             'RED647-FusionTestOrder',
-			             'IC-FusionTestOrder',
-			             'FAM-EstimatedBaseline',
-			             'ROX-EstimatedBaseline',
-			             'HEX-EstimatedBaseline',
-			             'RED647-EstimatedBaseline',
-			             'IC-EstimatedBaseline',
-			             'FAM-LR_TSlope_NonNormalized',
-			             'ROX-LR_TSlope_NonNormalized',
-			             'HEX-LR_TSlope_NonNormalized',
-			             'RED647-LR_TSlope_NonNormalized',
-			             'IC-LR_TSlope_NonNormalized',
-			             'FAM-Unrounded RFU Range',
-			             'ROX-Unrounded RFU Range',
-			             'HEX-Unrounded RFU Range',
-			             'RED647-Unrounded RFU Range',
-			             'IC-Unrounded RFU Range']]
-		except KeyError:
-			print("Error:", pcr_and_lis)
+		for position, (rfu_column, flag) in enumerate(RESULT_RFU_MASKS):
+			masked = (status[:, position] & flag) > 0
+			if masked.any():
+				lis_columns[rfu_column] = lis_columns[rfu_column].astype(object).where(~masked, "-")
+		self.timer.lap('validity', len(lis_columns))
+
+		# The joins use the integer key codes, the readable UniqueID is only built for the output.
+		# The columns are not reordered here, join_tables picks them by name
+		keys = SpecimenKeys([lis_columns[column].values for column in KEY_COLUMNS])
+		lis_columns.index = pd.Index(unique_ids(*[lis_columns[column].values for column in KEY_COLUMNS]),
+									 name='UniqueID')
+		self.timer.lap('lis_filter', len(lis_columns))
+
+		return lis_columns, keys
+
+	def join_tables(self, lis_table, lis_codes, wide_pcr, key_count):
+
+		""" Joins the PCR channels onto the LIS rows, a left
+		join on the key codes, building each output column once
+		and in the output order
+		Args:
+			lis_table - LIS rows as returned by lis_table (DataFrame)
+			lis_codes - the key code of each LIS row (numpy int array)
+			wide_pcr - one row per key code as returned by channel_blocks (DataFrame)
+			key_count - the number of key codes (int)
+		Returns:
+			the combined LIS & PCR data indexed by UniqueID (DataFrame)
+			and which of its rows have PCR rows (numpy bool array)
+		"""
 
-		# Save destination
-		save_as.to_excel(save_to)
+		# Row of wide_pcr for each key code, then for each LIS row, -1 without PCR rows
+		pcr_row_of_key = np.full(key_count, -1, dtype=np.intp)
+		pcr_row_of_key[wide_pcr.index.values.astype(np.intp)] = np.arange(len(wide_pcr))
+		pcr_positions = pcr_row_of_key[lis_codes]
+		self.timer.lap('join', len(lis_table))
+
+		save_as = {}
+		for column in OUTPUT_COLUMNS:
+			if column in lis_table.columns:
+				save_as[column] = lis_table[column].values
+			elif column in wide_pcr.columns:
+				save_as[column] = pd.api.extensions.take(wide_pcr[column].values, pcr_positions, allow_fill=True)
+			else:
+				raise KeyError("Combined column not in the LIS or PCR rows: %s" % column)
+
+		save_as = pd.DataFrame(save_as, index=lis_table.index, copy=False)
+		self.timer.lap('consolidate', len(save_as))
+
+		return save_as, pcr_positions >= 0
+
+	def iter_wide_pcr(self, keys, pcr_without_lis):
+
+		""" Reads the PCR file chunk_rows rows at a time and
+		yields the specimens of each chunk in wide form. The rows
+		of the last specimen of a chunk may continue in the next
+		chunk, so they are held back until the next chunk is read.
+		Args:
+			keys - the keys of the LIS rows (SpecimenKeys)
+			pcr_without_lis - collects the UniqueID of the PCR specimens without a LIS row (list)
+		Yields:
+			one row per key code, see channel_blocks (DataFrame)
+		Raises:
+			ChannelLayoutError - see channel_blocks, a channel missing from the
+				whole file is only raised once every chunk has been read
+		"""
+
+		reader = pd.read_csv(self.pcr_path,
+							 delimiter=',',
+							 encoding='utf-8-sig',
+							 usecols=lambda column: column in PCR_USECOLS,
+							 dtype=PCR_DTYPES,
+							 chunksize=self.chunk_rows
+							 )
+
+		held_back = None
+		# Channels with rows in any chunk, a chunk can miss a channel the file has
+		filled = np.zeros(len(CHANNELS), dtype=bool)
+
+		for chunk in reader:
+			# The '[end]' row makes every numeric column of the whole file float, so the
+			# integer columns of the chunks without it are too and every chunk writes 5 as 5.0
+			integers = [column for column in chunk.columns if pd.api.types.is_integer_dtype(chunk[column].dtype)]
+			if integers:
+				chunk = chunk.astype(dict((column, np.float64) for column in integers))
+			self.timer.lap('read_pcr', len(chunk))
+			rows, unmatched = self.matched_pcr_rows(chunk, keys)
+			pcr_without_lis.extend(unmatched)
+			if rows.empty:
+				continue
+			filled |= pd.Index(CHANNELS).isin(rows['Channel'])
+			if held_back is not None:
+				rows = pd.concat([held_back, rows])
+
+			key_codes = rows['Key'].values
+			last_specimen = key_codes == key_codes[-1]
+			held_back = rows[last_specimen]
+
+			if not last_specimen.all():
+				wide_pcr_file = channel_blocks(rows[~last_specimen], 'Key', 'Channel', CHANNELS, PCR_CHANNEL_COLUMNS,
+											   index_labels=keys.unique_ids, check_absent=False)
+				self.timer.lap('pivot', len(wide_pcr_file))
+				yield wide_pcr_file
+
+		if held_back is not None:
+			wide_pcr_file = channel_blocks(held_back, 'Key', 'Channel', CHANNELS, PCR_CHANNEL_COLUMNS,
+										   index_labels=keys.unique_ids, check_absent=False)
+			self.timer.lap('pivot', len(wide_pcr_file))
+			yield wide_pcr_file
+
+		check_channels(filled, CHANNELS)
+
+	def combine_chunks(self, save_to, output_format=None, store=None, identifier=None):
+
+		""" Combines the PCR file a chunk at a time against the
+		indexed LIS rows, appending each combined chunk to the
+		output. The rows follow the order of the PCR file, and the
+		LIS rows without PCR rows come last.
+		Args:
+			save_to - destination to save the file (str)
+			output_format - one of fusion.fwriter.CHUNKED_FORMATS,
+				None picks it from the extension of save_to (str)
+			store - also appends each combined chunk to this dataset (fusion.fstore.ResultStore)
+			identifier - the pair the rows are stored under (str)
+		Returns:
+			None
+		Raises:
+			ChannelLayoutError - the rows of a specimen are not next to each other
+		"""
+
+		self.timer.start()
+
+		lis_file_filtered_columns, keys = self.lis_table()
+		written = np.zeros(len(lis_file_filtered_columns), dtype=bool)
+		pcr_without_lis = []
+		empty_pcr = pd.DataFrame(columns=['%s-%s' % (channel, column) for column in PCR_CHANNEL_COLUMNS
+										  for channel in CHANNELS], index=pd.Index([], dtype=np.intp))
+
+		if store is not None:
+			store.remove(identifier)
+
+		with ChunkedWriter(save_to, output_format) as writer:
+			for wide_pcr_file in self.iter_wide_pcr(keys, pcr_without_lis):
+				positions = keys.rows_for(wide_pcr_file.index.values)
+				if written[positions].any():
+					raise ChannelLayoutError("The PCR rows of a specimen are split over the file, "
+											 "it cannot be combined in chunks")
+				written[positions] = True
+
+				save_as, _ = self.join_tables(lis_file_filtered_columns.iloc[positions], keys.codes[positions],
+											  wide_pcr_file, keys.size)
+				self.timer.start()
+				writer.append(save_as)
+				self.timer.lap('write', len(save_as))
+				if store is not None:
+					store.append(identifier, save_as)
+					self.timer.lap('store', len(save_as))
+
+			save_as, _ = self.join_tables(lis_file_filtered_columns[~written], keys.codes[~written],
+										  empty_pcr, keys.size)
+			self.timer.start()
+			writer.append(save_as)
+			self.timer.lap('write', len(save_as))
+			if store is not None:
+				store.append(identifier, save_as)
+				self.timer.lap('store', len(save_as))
+
+		# A specimen without a LIS row can span two chunks
+		self.join_report = JoinReport(keys.unique_ids(keys.duplicated()), list(save_as.index),
+									  list(pd.unique(np.asarray(pcr_without_lis, dtype=object))))
+
+	def trim_columns(self, frame, trim_columns, nan_as_string=True):
+
+		"""
+		Column level version of the trimmer. Each column is
+		factorized and only its distinct values (a handful of lots
+		per file) are converted and sliced, instead of calling the
+		trimmer once per row.
+
+		Args:
+			frame - the dataframe holding the columns to trim (DataFrame)
+			trim_columns - column name -> (trim_front, trim_back) (dict)
+			nan_as_string - like the trimmer, turn missing values into the 'nan'
+				string before trimming, otherwise they stay missing (bool)
+		Returns:
+			a copy of the frame with the trimmed columns (DataFrame)
+		"""
+
+		return frame.assign(**self.trimmed_columns(frame, trim_columns, nan_as_string))
+
+	def trimmed_columns(self, frame, trim_columns, nan_as_string=True):
+
+		""" The trimmed values of the columns, see trim_columns,
+		without copying the rest of the frame
+
+		Returns:
+			column name -> trimmed values (dict of numpy arrays)
+		"""
+
+		trimmed = {}
+		for column, (trim_front, trim_back) in trim_columns.items():
+			# Missing values are kept as uniques, so None and NaN convert like in the trimmer
+			codes, uniques = pd.factorize(frame[column], use_na_sentinel=False)
+			uniques = np.asarray(uniques, dtype=object)
+
+			# Same conversion as str(number) in the trimmer, so NaN becomes 'nan'
+			as_strings = pd.Series([str(value) for value in uniques], dtype=object)
+			sliced = as_strings.str.slice(trim_front, -trim_back if trim_back > 0 else None).values
+
+			if not nan_as_string:
+				sliced[pd.isnull(uniques)] = np.nan
+
+			trimmed[column] = sliced[codes]
+
+		return trimmed
 
 	def trimmer(self, number, trim_front=0, trim_back=0):
 
@@ -0,0 +1,326 @@
+"""
+Fbatch --
+Runs the LIS & PCR combining over whole
+directories without the Qt GUI, so that it can
+be scheduled from cron or run inside a container.
+"""
+
+import glob
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from fusion.fmatcher import LIS_GRAMMAR, PCR_GRAMMAR, match_files
+from fusion.fprofile import StageTimer, profiled
+from fusion.fwriter import OUTPUT_FORMATS, write_frame
+
+# pandas and fusion.fanalyzer are imported by the functions that combine,
+# so the GUI and the command line start without loading them
+
+# Assay profile (as shown in the GUI) -> assay type written in the PCR 'Analyte' column
+ASSAY_TYPES = {'Paraflu': 'P 1/2/3/4'}
+
+# Column holding the pair identifier in a concatenated dataset
+SOURCE_COLUMN = 'Source'
+
+# Outcome of combining one PCR & LIS pair
+#	status - 'combined', 'wrong_assay' or 'error' (str)
+#	output - the saved file, or the combined frame from frame_pair
+#	elapsed - wall time spent on the pair in seconds (float)
+#	stages - per stage timings when profiled, see fusion.fprofile (list of dict)
+PairResult = namedtuple('PairResult', ['identifier', 'pcr_file', 'lis_file',
+									   'status', 'output', 'message', 'elapsed', 'stages'],
+						defaults=(None,))
+
+
+def collect_files(sources, extension):
+
+	""" Expands directories and glob patterns into
+	a sorted list of files with the given extension.
+
+	Args:
+		sources - directories, glob patterns or file paths (list)
+		extension - the file extension to keep, e.g. '.csv' (str)
+	Returns:
+		the matching file paths without duplicates (list)
+	"""
+
+	found = set()
+
+	for source in sources:
+		if os.path.isdir(source):
+			for entry in os.scandir(source):
+				if entry.name.lower().endswith(extension) and entry.is_file():
+					found.add(entry.path)
+		else:
+			for candidate in glob.glob(source):
+				if candidate.lower().endswith(extension) and os.path.isfile(candidate):
+					found.add(candidate)
+
+	return sorted(found)
+
+
+def combine_pair(identifier, pcr_path, lis_path, save_directory, assay_profile='Paraflu',
+				 output_format='xlsx', cache=None, profile=None, profile_dir=None, chunk_rows=None,
+				 store=None):
+
+	""" Combines a single PCR & LIS pair and saves
+	the result as <identifier> with the extension of the format
+
+	Args:
+		identifier - the matched unique id of the pair (str)
+		pcr_path - path to the PCR file (str)
+		lis_path - path to the LIS file (str)
+		save_directory - directory to save the combined file (str)
+		assay_profile - the assay profile to combine with (str)
+		output_format - one of fusion.fwriter.OUTPUT_FORMATS (str)
+		cache - reuses the combined file of an unchanged pair, None always combines (ResultCache)
+		profile - None, 'stages' to time each stage of FusionAnalysis, or
+			'memory' to also record the peak memory of each stage (str)
+		profile_dir - saves <identifier>.stages.json and a cProfile
+			<identifier>.prof of the pair in this directory (str)
+		chunk_rows - read the PCR file this many rows at a time, None reads it whole (int)
+		store - also adds the combined rows to this dataset under the identifier.
+			The cache is only used for pairs the store already has (ResultStore)
+	Returns:
+		the outcome of the pair (PairResult)
+	"""
+
+	from fusion.fanalyzer import FusionAnalysis, describe_join
+
+	started = time.time()
+	save_file_path = os.path.join(save_directory, identifier + OUTPUT_FORMATS[output_format])
+
+	timer = None
+	if profile or profile_dir:
+		timer = StageTimer(trace_memory=(profile == 'memory'))
+
+	try:
+		# Only reads the first row of the PCR file, a pair of another assay is not parsed or hashed
+		analysis = FusionAnalysis(pcr_path, lis_path, ASSAY_TYPES[assay_profile], timer, chunk_rows)
+		if not analysis.check_assay_types():
+			return PairResult(identifier, pcr_path, lis_path, 'wrong_assay', None,
+							  'The files are not of the specified assay type',
+							  time.time() - started)
+
+		if cache is not None:
+			cache_key = cache.key_for(pcr_path, lis_path, assay_profile, output_format, bool(chunk_rows))
+			if (store is None or store.contains(identifier)) and cache.fetch(cache_key, save_file_path):
+				return PairResult(identifier, pcr_path, lis_path, 'combined', save_file_path,
+								  'Unchanged, reused the cached result', time.time() - started)
+
+		with profiled(os.path.join(profile_dir, identifier + '.prof') if profile_dir else None):
+			analysis.combine_files(assay_profile, save_file_path, output_format, store, identifier)
+
+		if cache is not None:
+			cache.store(cache_key, save_file_path)
+	except Exception as error:
+		return PairResult(identifier, pcr_path, lis_path, 'error', None,
+						  '%s: %s' % (type(error).__name__, error), time.time() - started)
+	finally:
+		if timer is not None:
+			timer.stop()
+
+	stages = None
+	if timer is not None:
+		stages = timer.as_dicts()
+		if profile_dir:
+			timer.dump_json(os.path.join(profile_dir, identifier + '.stages.json'),
+							identifier=identifier, pcr_file=pcr_path, lis_file=lis_path)
+
+	# Names what did not join one to one, e.g. LIS rows without PCR rows
+	return PairResult(identifier, pcr_path, lis_path, 'combined', save_file_path,
+					  describe_join(analysis.join_report), time.time() - started, stages)
+
+
+def frame_pair(identifier, pcr_path, lis_path, assay_profile='Paraflu'):
+
+	""" Combines a single PCR & LIS pair in memory, with
+	the identifier of the pair in a leading Source column
+
+	Args:
+		identifier - the matched unique id of the pair (str)
+		pcr_path - path to the PCR file (str)
+		lis_path - path to the LIS file (str)
+		assay_profile - the assay profile to combine with (str)
+	Returns:
+		the outcome of the pair, its output is the combined frame (PairResult)
+	"""
+
+	from fusion.fanalyzer import FusionAnalysis, describe_join
+
+	started = time.time()
+
+	try:
+		analysis = FusionAnalysis(pcr_path, lis_path, ASSAY_TYPES[assay_profile])
+		if not analysis.check_assay_types():
+			return PairResult(identifier, pcr_path, lis_path, 'wrong_assay', None,
+							  'The files are not of the specified assay type',
+							  time.time() - started)
+
+		combined = analysis.combined_frame(assay_profile)
+		combined.insert(0, SOURCE_COLUMN, identifier)
+	except Exception as error:
+		return PairResult(identifier, pcr_path, lis_path, 'error', None,
+						  '%s: %s' % (type(error).__name__, error), time.time() - started)
+
+	return PairResult(identifier, pcr_path, lis_path, 'combined', combined,
+					  describe_join(analysis.join_report), time.time() - started)
+
+
+def iter_pairs(pairs, save_directory, assay_profile='Paraflu', workers=1, output_format='xlsx',
+			   cache=None, profile=None, profile_dir=None, chunk_rows=None, store=None):
+
+	""" Combines every pair, sending each one to a
+	worker process when more than one worker is requested.
+	Results are yielded as soon as each pair finishes, so the
+	order follows completion rather than the order of pairs.
+
+	Only a couple of pairs per worker are submitted at a time,
+	so a caller that stops iterating stops new pairs from
+	being dispatched.
+
+	Args:
+		pairs - (identifier, pcr_path, lis_path) of each pair (list)
+		save_directory - directory to save the combined files (str)
+		assay_profile - the assay profile to combine with (str)
+		workers - number of worker processes, None or 0 uses every CPU (int)
+		output_format - one of fusion.fwriter.OUTPUT_FORMATS (str)
+		cache - reuses the combined file of an unchanged pair, None always combines (ResultCache)
+		profile - None, 'stages' or 'memory', see combine_pair (str)
+		profile_dir - directory for the JSON trace and cProfile of each pair (str)
+		chunk_rows - read the PCR files this many rows at a time, None reads them whole (int)
+		store - also adds the combined rows of every pair to this dataset (ResultStore)
+	Yields:
+		the outcome of each pair (PairResult)
+	"""
+
+	return iter_tasks(combine_pair, pairs, workers,
+					  (save_directory, assay_profile, output_format, cache, profile, profile_dir, chunk_rows, store))
+
+
+def iter_tasks(task, pairs, workers, task_args=()):
+
+	""" Runs the task on every pair, see iter_pairs
+
+	Args:
+		task - called as task(identifier, pcr_path, lis_path, *task_args),
+			must be a module level function returning a PairResult (function)
+		pairs - (identifier, pcr_path, lis_path) of each pair (list)
+		workers - number of worker processes, None or 0 uses every CPU (int)
+		task_args - the remaining arguments of the task (tuple)
+	Yields:
+		the outcome of each pair (PairResult)
+	"""
+
+	if not workers:
+		workers = os.cpu_count() or 1
+
+	if workers == 1:
+		for identifier, pcr_path, lis_path in pairs:
+			yield task(identifier, pcr_path, lis_path, *task_args)
+		return
+
+	pending = iter(pairs)
+	in_flight = {}
+
+	with ProcessPoolExecutor(max_workers=workers) as executor:
+
+		def submit_next():
+			for pair in pending:
+				future = executor.submit(task, pair[0], pair[1], pair[2], *task_args)
+				in_flight[future] = (pair, time.time())
+				return
+
+		for _ in range(workers * 2):
+			submit_next()
+
+		try:
+			while in_flight:
+				done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+				for future in done:
+					(identifier, pcr_path, lis_path), submitted = in_flight.pop(future)
+					try:
+						result = future.result()
+					except Exception as error:
+						# The worker itself died (e.g. killed for memory), the task never returned
+						result = PairResult(identifier, pcr_path, lis_path, 'error', None,
+											'%s: %s' % (type(error).__name__, error),
+											time.time() - submitted)
+					yield result
+					submit_next()
+		finally:
+			for future in in_flight:
+				future.cancel()
+
+
+def combine_concatenated(pairs, save_to, assay_profile='Paraflu', workers=1, output_format=None):
+
+	""" Combines many pairs into a single dataset, each row
+	tagged with the identifier of its pair in the Source column.
+	The frames are concatenated once, in identifier order, and
+	written once.
+
+	Args:
+		pairs - (identifier, pcr_path, lis_path) of each pair (list)
+		save_to - destination of the combined dataset (str)
+		assay_profile - the assay profile to combine with (str)
+		workers - number of worker processes, None or 0 uses every CPU (int)
+		output_format - one of fusion.fwriter.OUTPUT_FORMATS, None picks
+			it from the extension of save_to (str)
+	Returns:
+		the outcome of every pair in identifier order (list of PairResult)
+	"""
+
+	import pandas as pd
+
+	results = []
+	frames = {}
+
+	for result in iter_tasks(frame_pair, pairs, workers, (assay_profile,)):
+		if result.status == 'combined':
+			frames[result.identifier] = result.output
+			result = result._replace(output=save_to)
+		results.append(result)
+
+	if frames:
+		combined = pd.concat([frames[identifier] for identifier in sorted(frames)])
+		write_frame(combined, save_to, output_format)
+
+	return sorted(results, key=lambda result: result.identifier)
+
+
+def run_batch(lis_files, pcr_files, save_directory, assay_profile='Paraflu', workers=1,
+			  output_format='xlsx', cache=None, pcr_grammar=PCR_GRAMMAR, lis_grammar=LIS_GRAMMAR,
+			  profile=None, profile_dir=None, chunk_rows=None, store=None):
+
+	""" Matches the LIS files to the PCR files and
+	combines every complete pair.
+
+	Args:
+		lis_files - all of the LIS files (list)
+		pcr_files - all of the PCR files (list)
+		save_directory - directory to save the combined files (str)
+		assay_profile - the assay profile to combine with (str)
+		workers - number of worker processes, None or 0 uses every CPU (int)
+		output_format - one of fusion.fwriter.OUTPUT_FORMATS (str)
+		cache - reuses the combined file of an unchanged pair, None always combines (ResultCache)
+		pcr_grammar - grammar of the PCR file names (FileNameGrammar)
+		lis_grammar - grammar of the LIS file names (FileNameGrammar)
+		profile - None, 'stages' or 'memory', see combine_pair (str)
+		profile_dir - directory for the JSON trace and cProfile of each pair (str)
+		chunk_rows - read the PCR files this many rows at a time, None reads them whole (int)
+		store - also adds the combined rows of every pair to this dataset (ResultStore)
+	Returns:
+		the outcome of every pair in identifier order (list of PairResult)
+		and the matching, including the files that could not be paired (MatchResult)
+	"""
+
+	match = match_files(lis_files, pcr_files, pcr_grammar, lis_grammar)
+
+	results = sorted(iter_pairs(match.pairs, save_directory, assay_profile, workers,
+								output_format, cache, profile, profile_dir, chunk_rows, store),
+					 key=lambda result: result.identifier)
+
+	return results, match
@@ -0,0 +1,192 @@
+"""
+Fcache --
+On-disk cache of combined files, keyed by the content
+of the PCR & LIS pair, so re-running over a folder only
+combines the pairs that changed.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+DEFAULT_CACHE_DIRECTORY = os.path.join(os.path.expanduser('~'), '.fusiongui', 'cache')
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+# Modules whose source decides the content of a combined file
+_CODE_MODULES = ['fanalyzer.py', 'fwriter.py']
+_code_version = None
+
+
+def code_version():
+
+	""" Fingerprint of the combining code, so cached files
+	are not reused after the analysis changes
+
+	Returns:
+		hex digest of the module sources (str)
+	"""
+
+	global _code_version
+
+	if _code_version is None:
+		digest = hashlib.sha256()
+		package_directory = os.path.dirname(os.path.abspath(__file__))
+		for module in _CODE_MODULES:
+			with open(os.path.join(package_directory, module), 'rb') as source:
+				digest.update(source.read())
+		_code_version = digest.hexdigest()
+
+	return _code_version
+
+
+class ResultCache():
+
+	""" ResultCache Class
+	Stores one combined file per key in a directory. The
+	least recently used files are removed once the directory
+	grows past max_bytes. A file's modification time records
+	its last use, so no separate index has to be kept in sync
+	between worker processes.
+	"""
+
+	def __init__(self, directory=DEFAULT_CACHE_DIRECTORY, max_bytes=DEFAULT_MAX_BYTES, link=False):
+
+		"""
+		Args:
+			directory - where the cached files are kept (str)
+			max_bytes - size limit of the directory (int)
+			link - hard link cached files into place instead of copying them.
+				Faster, but editing the output then edits the cached file (bool)
+		"""
+
+		self.directory = directory
+		self.max_bytes = max_bytes
+		self.link = link
+
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+
+	def key_for(self, pcr_path, lis_path, assay_profile, output_format, chunked=False):
+
+		""" Hashes everything that decides the combined file
+
+		Args:
+			pcr_path - path to the PCR file (str)
+			lis_path - path to the LIS file (str)
+			assay_profile - the assay profile to combine with (str)
+			output_format - the output format of the combined file (str)
+			chunked - the PCR file is read in chunks, which orders the rows differently (bool)
+		Returns:
+			the cache key (str)
+		"""
+
+		digest = hashlib.sha256()
+		digest.update(('%s|%s|%s|' % (code_version(), assay_profile, output_format)).encode('utf-8'))
+		if chunked:
+			digest.update(b'chunked|')
+
+		for path in (pcr_path, lis_path):
+			with open(path, 'rb') as source:
+				for block in iter(lambda: source.read(1024 * 1024), b''):
+					digest.update(block)
+			# Keeps the boundary between the two files in the key
+			digest.update(b'|')
+
+		return digest.hexdigest()
+
+	def path_for(self, key, extension):
+
+		""" Location of the cached file for the key """
+
+		return os.path.join(self.directory, key + extension)
+
+	def fetch(self, key, save_to):
+
+		""" Places the cached file for the key at save_to
+
+		Args:
+			key - the cache key (str)
+			save_to - destination of the combined file (str)
+		Returns:
+			True if the file was cached, otherwise False (bool)
+		"""
+
+		cached = self.path_for(key, os.path.splitext(save_to)[1])
+
+		try:
+			# Marks the entry as recently used
+			os.utime(cached, None)
+			if os.path.exists(save_to):
+				os.remove(save_to)
+			if self.link:
+				try:
+					os.link(cached, save_to)
+					return True
+				except OSError:
+					# Different file system, fall back to a copy
+					pass
+			shutil.copyfile(cached, save_to)
+		except (IOError, OSError):
+			# Missing, or evicted by another process in the meantime
+			return False
+
+		return True
+
+	def store(self, key, saved_file):
+
+		""" Adds a combined file to the cache
+
+		Args:
+			key - the cache key (str)
+			saved_file - the combined file to keep (str)
+		Returns:
+			None
+		"""
+
+		cached = self.path_for(key, os.path.splitext(saved_file)[1])
+
+		# Copy under a temporary name so other processes never see a partial file
+		handle, temporary = tempfile.mkstemp(dir=self.directory, prefix='.incoming-')
+		os.close(handle)
+		try:
+			shutil.copyfile(saved_file, temporary)
+			os.replace(temporary, cached)
+		except BaseException:
+			if os.path.exists(temporary):
+				os.remove(temporary)
+			raise
+
+		self.evict()
+
+	def evict(self):
+
+		""" Removes the least recently used files until
+		the cache fits in max_bytes
+
+		Returns:
+			None
+		"""
+
+		entries = []
+		total_bytes = 0
+
+		for name in os.listdir(self.directory):
+			if name.startswith('.'):
+				continue
+			path = os.path.join(self.directory, name)
+			try:
+				status = os.stat(path)
+			except OSError:
+				continue
+			entries.append((status.st_mtime, status.st_size, path))
+			total_bytes += status.st_size
+
+		for _, size, path in sorted(entries):
+			if total_bytes <= self.max_bytes:
+				break
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+			total_bytes -= size
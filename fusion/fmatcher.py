@@ -0,0 +1,246 @@
+"""
+Fmatcher --
+Pairs the PCR files exported by the Panther
+with their LIS files so that each pair can be
+combined by FusionAnalysis.
+"""
+
+import os
+import re
+from collections import namedtuple
+
+# Result of matching
+#	pairs - (identifier, pcr_file, lis_file) sorted by identifier (list)
+#	missing_lis - LIS files with no PCR pair (list)
+#	missing_pcr - PCR files with no LIS pair (list)
+#	unparseable - files whose name does not follow the grammar (list)
+#	duplicates - files with the same identifier as an earlier file of the same kind (list)
+MatchResult = namedtuple('MatchResult', ['pairs', 'missing_lis', 'missing_pcr',
+										 'unparseable', 'duplicates'])
+
+
+class FileNameGrammar():
+
+	""" FileNameGrammar Class
+	Describes how the identifier of a pair is read from a
+	file name. The pattern is searched in the file name without
+	its extension, and the identifier is its groups joined
+	by the separator, in order.
+	"""
+
+	def __init__(self, pattern, extension, separator='_'):
+
+		"""
+		Args:
+			pattern - regular expression with one group per identifier part (str)
+			extension - the extension of the files, e.g. '.csv' (str)
+			separator - joins the groups into the identifier (str)
+		"""
+
+		self.pattern = re.compile(pattern)
+		self.extension = extension.lower()
+		self.separator = separator
+
+	def identifier(self, file_path):
+
+		""" Reads the identifier of the pair from the file name
+
+		Args:
+			file_path - path or name of the file (str)
+		Returns:
+			the identifier, or None when the name does not follow the grammar (str)
+		"""
+
+		file_name = os.path.basename(file_path)
+		stem, extension = os.path.splitext(file_name)
+		if extension.lower() != self.extension:
+			return None
+
+		match = self.pattern.search(stem)
+		if match is None:
+			return None
+		return self.separator.join(match.groups())
+
+
+# Panther exports: @DI<worklist>-<x>-<x>-<a>-<b>-<c>.csv and @Pt2<worklist>-<x>-<x>-<a>-<b>-<c>.lis,
+# paired on <worklist>_<a>_<b>_<c>
+PCR_GRAMMAR = FileNameGrammar(r'@DI([^-]+)-[^-]*-[^-]*-([^-]+)-([^-]+)-([^-]+)', '.csv')
+LIS_GRAMMAR = FileNameGrammar(r'@Pt2([^-]+)-[^-]*-[^-]*-([^-]+)-([^-]+)-([^-]+)', '.lis')
+
+
+def scan_directories(directories, pcr_grammar=PCR_GRAMMAR, lis_grammar=LIS_GRAMMAR):
+
+	""" Lists the PCR and LIS files of the directories,
+	reading each directory listing once
+
+	Args:
+		directories - directories to list, not recursive (list)
+		pcr_grammar - grammar of the PCR file names (FileNameGrammar)
+		lis_grammar - grammar of the LIS file names (FileNameGrammar)
+	Returns:
+		the LIS files (list) and the PCR files (list)
+	"""
+
+	lis_files = []
+	pcr_files = []
+
+	for directory in directories:
+		for entry in os.scandir(directory):
+			extension = os.path.splitext(entry.name)[1].lower()
+			if extension == lis_grammar.extension and entry.is_file():
+				lis_files.append(entry.path)
+			elif extension == pcr_grammar.extension and entry.is_file():
+				pcr_files.append(entry.path)
+
+	return lis_files, pcr_files
+
+
+def match_files(list_of_LIS_files, list_of_PCR_files, pcr_grammar=PCR_GRAMMAR, lis_grammar=LIS_GRAMMAR):
+
+	""" Main purpose of the program is to match
+	the PCR file to its appropriate LIS file. The matching
+	is done on the worklist-ID and date. The PCR files are
+	indexed by identifier once, then each LIS file is a
+	single lookup.
+
+	Args:
+		list_of_LIS_files - all of the LIS files in a list (list)
+		list_of_PCR_files - all of the PCR files in a list (list)
+		pcr_grammar - grammar of the PCR file names (FileNameGrammar)
+		lis_grammar - grammar of the LIS file names (FileNameGrammar)
+	Returns:
+		the pairs and the files that could not be paired (MatchResult)
+	"""
+
+	unparseable = []
+	duplicates = []
+
+	# MAIN INDEX - identifier -> PCR file
+	pcr_index = {}
+
+	for pcr_file in list_of_PCR_files:
+		unique_id = pcr_grammar.identifier(pcr_file)
+		if unique_id is None:
+			unparseable.append(pcr_file)
+		elif unique_id in pcr_index:
+			duplicates.append(pcr_file)
+		else:
+			pcr_index[unique_id] = pcr_file
+
+	pairs = {}
+	missing_lis = []
+
+	for lis_file in list_of_LIS_files:
+		unique_id = lis_grammar.identifier(lis_file)
+		if unique_id is None:
+			unparseable.append(lis_file)
+		elif unique_id in pairs:
+			duplicates.append(lis_file)
+		elif unique_id in pcr_index:
+			pairs[unique_id] = (unique_id, pcr_index[unique_id], lis_file)
+		else:
+			missing_lis.append(lis_file)
+
+	missing_pcr = [pcr_file for unique_id, pcr_file in pcr_index.items() if unique_id not in pairs]
+
+	return MatchResult([pairs[unique_id] for unique_id in sorted(pairs)],
+					   sorted(missing_lis), sorted(missing_pcr),
+					   unparseable, duplicates)
+
+
+class PairIndex():
+
+	""" PairIndex Class
+	Incremental version of match_files for files that arrive
+	one at a time. Each file is indexed by the identifier its
+	grammar reads from the name, and adding the second half of
+	a pair returns the completed pair straight away.
+	"""
+
+	def __init__(self, pcr_grammar=PCR_GRAMMAR, lis_grammar=LIS_GRAMMAR):
+
+		"""
+		Args:
+			pcr_grammar - grammar of the PCR file names (FileNameGrammar)
+			lis_grammar - grammar of the LIS file names (FileNameGrammar)
+		"""
+
+		self.pcr_grammar = pcr_grammar
+		self.lis_grammar = lis_grammar
+		# identifier -> file
+		self.pcr_files = {}
+		self.lis_files = {}
+
+	def identify(self, file_path):
+
+		""" Reads the kind and identifier of a file
+
+		Args:
+			file_path - path or name of the file (str)
+		Returns:
+			'pcr' or 'lis' and the identifier, or (None, None) when the
+			name follows neither grammar (str, str)
+		"""
+
+		unique_id = self.pcr_grammar.identifier(file_path)
+		if unique_id is not None:
+			return 'pcr', unique_id
+		unique_id = self.lis_grammar.identifier(file_path)
+		if unique_id is not None:
+			return 'lis', unique_id
+		return None, None
+
+	def add(self, file_path):
+
+		""" Indexes a file. A file with the identifier of an
+		earlier file of the same kind replaces it.
+
+		Args:
+			file_path - path to the PCR or LIS file (str)
+		Returns:
+			(identifier, pcr_file, lis_file) when both halves are
+			indexed, otherwise None (tuple)
+		"""
+
+		kind, unique_id = self.identify(file_path)
+		if kind is None:
+			return None
+
+		if kind == 'pcr':
+			self.pcr_files[unique_id] = file_path
+		else:
+			self.lis_files[unique_id] = file_path
+
+		if unique_id in self.pcr_files and unique_id in self.lis_files:
+			return (unique_id, self.pcr_files[unique_id], self.lis_files[unique_id])
+		return None
+
+	def remove(self, file_path):
+
+		""" Drops a file that was deleted or moved away
+
+		Args:
+			file_path - path to the PCR or LIS file (str)
+		Returns:
+			None
+		"""
+
+		kind, unique_id = self.identify(file_path)
+		files = self.pcr_files if kind == 'pcr' else self.lis_files
+		if kind is not None and files.get(unique_id) == file_path:
+			del files[unique_id]
+
+	def unmatched(self):
+
+		""" The halves still waiting for their pair
+
+		Returns:
+			the LIS files with no PCR pair (list)
+			and the PCR files with no LIS pair (list)
+		"""
+
+		missing_lis = [lis_file for unique_id, lis_file in self.lis_files.items()
+					   if unique_id not in self.pcr_files]
+		missing_pcr = [pcr_file for unique_id, pcr_file in self.pcr_files.items()
+					   if unique_id not in self.lis_files]
+		return sorted(missing_lis), sorted(missing_pcr)
@@ -0,0 +1,230 @@
+"""
+Fprofile --
+Lightweight, opt-in timing of the stages of a
+FusionAnalysis run: wall time, row count and,
+when asked for, peak memory of each stage.
+"""
+
+import cProfile
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class StageRecord():
+
+	""" StageRecord Class
+	Measurements of one stage.
+	"""
+
+	def __init__(self, name):
+
+		self.name = name
+		self.seconds = 0.0
+		self.rows = None
+		self.peak_bytes = None
+
+	def as_dict(self):
+
+		return {'name': self.name,
+				'seconds': self.seconds,
+				'rows': self.rows,
+				'peak_bytes': self.peak_bytes}
+
+
+class StageTimer():
+
+	""" StageTimer Class
+	Records the stages of a run in order. Each lap closes
+	the stage that started at the previous lap (or at start),
+	so the code being timed does not need to be restructured.
+	A disabled timer keeps nothing, so FusionAnalysis can
+	always call it at no real cost.
+
+	Usage:
+		timer = StageTimer()
+		timer.start()
+		pivot = frame.pivot(...)
+		timer.lap('pivot', rows=len(pivot))
+		timer.stop()
+		print(timer.summary())
+	"""
+
+	def __init__(self, enabled=True, trace_memory=False):
+
+		"""
+		Args:
+			enabled - record the stages (bool)
+			trace_memory - also record the peak Python and numpy memory of
+				each stage with tracemalloc, which slows the run down (bool)
+		"""
+
+		self.enabled = enabled
+		self.trace_memory = trace_memory
+		self.stages = []
+
+		self._lap_started = None
+		self._memory_baseline = 0
+		self._started_tracing = False
+
+	def start(self):
+
+		""" Starts (or restarts) the clock of the next stage """
+
+		if not self.enabled:
+			return
+
+		if self.trace_memory:
+			if not tracemalloc.is_tracing():
+				tracemalloc.start()
+				self._started_tracing = True
+			tracemalloc.reset_peak()
+			self._memory_baseline = tracemalloc.get_traced_memory()[0]
+
+		self._lap_started = time.perf_counter()
+
+	def lap(self, name, rows=None):
+
+		""" Records the stage since the last lap or start
+
+		Args:
+			name - name of the stage (str)
+			rows - number of rows the stage produced (int)
+		Returns:
+			None
+		"""
+
+		if not self.enabled:
+			return
+
+		if self._lap_started is None:
+			self.start()
+
+		record = StageRecord(name)
+		record.seconds = time.perf_counter() - self._lap_started
+		record.rows = rows
+		if self.trace_memory:
+			record.peak_bytes = max(tracemalloc.get_traced_memory()[1] - self._memory_baseline, 0)
+		self.stages.append(record)
+
+		self.start()
+
+	def stop(self):
+
+		""" Ends the run, and memory tracing if this timer started it """
+
+		self._lap_started = None
+		if self._started_tracing:
+			tracemalloc.stop()
+			self._started_tracing = False
+
+	def total_seconds(self):
+
+		return sum(record.seconds for record in self.stages)
+
+	def as_dicts(self):
+
+		""" The recorded stages in order (list of dict) """
+
+		return [record.as_dict() for record in self.stages]
+
+	def summary(self):
+
+		""" One line per stage, for printing
+
+		Returns:
+			the summary table (str)
+		"""
+
+		return format_stages(self.as_dicts())
+
+	def dump_json(self, save_to, **extra):
+
+		""" Saves the stages as a JSON trace
+
+		Args:
+			save_to - destination of the trace (str)
+			extra - other values to store alongside the stages
+		Returns:
+			None
+		"""
+
+		trace = dict(extra)
+		trace['stages'] = self.as_dicts()
+		trace['total_seconds'] = self.total_seconds()
+
+		with open(save_to, 'w') as trace_file:
+			json.dump(trace, trace_file, indent=2)
+
+
+def format_stages(stages):
+
+	""" Formats stage dictionaries as a table
+
+	Args:
+		stages - stages as returned by StageTimer.as_dicts (list of dict)
+	Returns:
+		the table (str)
+	"""
+
+	lines = ['%-14s %9s %10s %12s' % ('stage', 'seconds', 'rows', 'peak MB')]
+	for stage in stages:
+		lines.append('%-14s %9.3f %10s %12s' % (
+			stage['name'], stage['seconds'],
+			'' if stage['rows'] is None else stage['rows'],
+			'' if stage['peak_bytes'] is None else '%.1f' % (stage['peak_bytes'] / 1024.0 ** 2)))
+	return '\n'.join(lines)
+
+
+def summarize_runs(runs):
+
+	""" Adds up the stages of many runs, e.g. every pair of a batch
+
+	Args:
+		runs - the stages of each run, as returned by StageTimer.as_dicts (list of list)
+	Returns:
+		the stages in first seen order, with seconds and rows summed and
+		the largest peak memory (list of dict)
+	"""
+
+	totals = {}
+	order = []
+
+	for stages in runs:
+		for stage in stages:
+			if stage['name'] not in totals:
+				totals[stage['name']] = {'name': stage['name'], 'seconds': 0.0,
+										 'rows': None, 'peak_bytes': None}
+				order.append(stage['name'])
+			total = totals[stage['name']]
+			total['seconds'] += stage['seconds']
+			if stage['rows'] is not None:
+				total['rows'] = (total['rows'] or 0) + stage['rows']
+			if stage['peak_bytes'] is not None:
+				total['peak_bytes'] = max(total['peak_bytes'] or 0, stage['peak_bytes'])
+
+	return [totals[name] for name in order]
+
+
+@contextmanager
+def profiled(save_to):
+
+	""" Runs the with block under cProfile and saves the
+	statistics for pstats / snakeviz
+
+	Args:
+		save_to - destination of the profile, None disables profiling (str)
+	"""
+
+	if save_to is None:
+		yield
+		return
+
+	profiler = cProfile.Profile()
+	profiler.enable()
+	try:
+		yield
+	finally:
+		profiler.disable()
+		profiler.dump_stats(save_to)
@@ -0,0 +1,464 @@
+"""
+Fqueue --
+Keeps the matched pairs of an archive as a work list
+in a directory on a shared filesystem, so several hosts
+can combine it together. A pair is claimed with a lock
+file, its combined file is moved into place once complete
+and its outcome is recorded, so the pairs of a crashed host
+are picked up again and a rerun only combines what is left.
+"""
+
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from fusion.fbatch import PairResult, combine_pair
+from fusion.fwriter import OUTPUT_FORMATS, share_file
+
+WORK_FILE_NAME = 'work.json'
+REPORT_FILE_NAME = 'report.json'
+CLAIMS_DIRECTORY = 'claims'
+RESULTS_DIRECTORY = 'results'
+STAGING_DIRECTORY = '.staging'
+
+# Seconds without a heartbeat after which the claim of a pair is taken over.
+# Hosts compare their own clock with the file server's, so keep it generous.
+DEFAULT_STALE_SECONDS = 600.0
+
+
+def node_name():
+
+	""" Name of this worker in claims and results, '<host>-<pid>' """
+
+	return '%s-%d' % (socket.gethostname(), os.getpid())
+
+
+def remove_dead_staging(staging_root):
+
+	""" Removes the staging directories that workers of this host
+	left behind when they died, with any partial files in them
+
+	Args:
+		staging_root - the staging directory of the save directory (str)
+	Returns:
+		None
+	"""
+
+	prefix = '%s-' % socket.gethostname()
+
+	try:
+		names = os.listdir(staging_root)
+	except OSError:
+		return
+
+	for name in names:
+		pid = name[len(prefix):]
+		if not name.startswith(prefix) or not pid.isdigit():
+			continue
+		try:
+			os.kill(int(pid), 0)
+		except ProcessLookupError:
+			shutil.rmtree(os.path.join(staging_root, name), ignore_errors=True)
+		except OSError:
+			# Running, under another user
+			pass
+
+
+def write_json(path, content):
+
+	""" Writes JSON under a temporary name and moves it into
+	place, so other hosts never read a partial file. It can be
+	read by the other users, like a file created normally """
+
+	handle, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.incoming-')
+	try:
+		with os.fdopen(handle, 'w') as json_file:
+			json.dump(content, json_file, indent=1)
+		share_file(temporary)
+		os.replace(temporary, path)
+	except BaseException:
+		if os.path.exists(temporary):
+			os.remove(temporary)
+		raise
+
+
+def read_json(path):
+
+	""" The content of a JSON file, None when it is missing.
+	Other errors, e.g. a file this user cannot read, are raised """
+
+	try:
+		with open(path) as json_file:
+			return json.load(json_file)
+	except FileNotFoundError:
+		return None
+
+
+@contextmanager
+def heartbeat(path, interval):
+
+	""" Touches the file every interval seconds on a background
+	thread while the block runs
+
+	Args:
+		path - the file to touch (str)
+		interval - seconds between touches (float)
+	"""
+
+	stopped = threading.Event()
+
+	def beat():
+		while not stopped.wait(interval):
+			try:
+				os.utime(path, None)
+			except OSError:
+				pass
+
+	thread = threading.Thread(target=beat, daemon=True)
+	thread.start()
+	try:
+		yield
+	finally:
+		stopped.set()
+		thread.join()
+
+
+def create_queue(directory, match, save_directory, assay_profile='Paraflu', output_format='xlsx',
+				 chunk_rows=None):
+
+	""" Writes the work list of a matching. An existing work list is
+	kept as it is, so creating the queue again resumes it.
+
+	Args:
+		directory - the queue directory, on a filesystem every host can reach (str)
+		match - the pairs and the files that could not be paired, see match_files (MatchResult)
+		save_directory - directory to save the combined files, reachable by every host (str)
+		assay_profile - the assay profile to combine with (str)
+		output_format - one of fusion.fwriter.OUTPUT_FORMATS (str)
+		chunk_rows - read the PCR files this many rows at a time, None reads them whole (int)
+	Returns:
+		the queue (WorkQueue)
+	"""
+
+	for subdirectory in (directory, os.path.join(directory, CLAIMS_DIRECTORY),
+						 os.path.join(directory, RESULTS_DIRECTORY)):
+		if not os.path.isdir(subdirectory):
+			os.makedirs(subdirectory, exist_ok=True)
+
+	work_file = os.path.join(directory, WORK_FILE_NAME)
+	if not os.path.exists(work_file):
+		write_json(work_file, {'settings': {'save_directory': os.path.abspath(save_directory),
+											'assay_profile': assay_profile,
+											'output_format': output_format,
+											'chunk_rows': chunk_rows},
+							   'pairs': [list(pair) for pair in match.pairs],
+							   'missing_lis': match.missing_lis,
+							   'missing_pcr': match.missing_pcr,
+							   'unparseable': match.unparseable,
+							   'duplicates': match.duplicates})
+
+	return WorkQueue(directory)
+
+
+class WorkQueue():
+
+	""" WorkQueue Class
+	Hands out the pairs of the work list to any number of
+	workers, on one host or many. A worker claims a pair by
+	creating its lock file, which only one worker can do, and
+	touches the lock file while it combines. A claim that has
+	not been touched for stale_seconds belongs to a worker
+	that died, and is taken over by the next worker to see it.
+
+	The combined file is written under a staging directory
+	next to the output and moved into place complete, then the
+	outcome is recorded in results/<identifier>.json. Pairs
+	with a recorded outcome are never handed out again.
+
+	Usage:
+		queue = create_queue('/shared/queue', match, '/shared/combined')
+		queue.work()					# on every host
+		print(queue.report())
+	"""
+
+	def __init__(self, directory, stale_seconds=DEFAULT_STALE_SECONDS):
+
+		"""
+		Args:
+			directory - the queue directory, see create_queue (str)
+			stale_seconds - age of an untouched claim that is taken over (float)
+		"""
+
+		self.directory = directory
+		self.stale_seconds = stale_seconds
+
+		work = read_json(os.path.join(directory, WORK_FILE_NAME))
+		if work is None:
+			raise ValueError("%s has no work list, create the queue first" % directory)
+
+		self.settings = work['settings']
+		self.pairs = [tuple(pair) for pair in work['pairs']]
+		self.missing_lis = work['missing_lis']
+		self.missing_pcr = work['missing_pcr']
+		self.unparseable = work['unparseable']
+		self.duplicates = work['duplicates']
+
+	def claim_path(self, identifier):
+
+		return os.path.join(self.directory, CLAIMS_DIRECTORY, identifier + '.claim')
+
+	def result_path(self, identifier):
+
+		return os.path.join(self.directory, RESULTS_DIRECTORY, identifier + '.json')
+
+	def claim(self, identifier, node=None):
+
+		""" Claims a pair for this worker
+
+		Args:
+			identifier - the matched unique id of the pair (str)
+			node - name of the worker, None uses node_name (str)
+		Returns:
+			True if the pair is now claimed by this worker (bool)
+		"""
+
+		claim_path = self.claim_path(identifier)
+
+		for _ in range(2):
+			try:
+				# Only one worker can create the file, also over NFS
+				handle = os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+			except FileExistsError:
+				if not self.take_over(claim_path):
+					return False
+				continue
+
+			with os.fdopen(handle, 'w') as claim_file:
+				claim_file.write('%s %f\n' % (node or node_name(), time.time()))
+
+			if os.path.exists(self.result_path(identifier)):
+				# Recorded by another worker since the pair was picked
+				self.release(identifier)
+				return False
+			return True
+
+		return False
+
+	def take_over(self, claim_path):
+
+		""" Removes a stale claim. The claim is renamed first, so
+		when several workers find it stale only one removes it. At
+		worst a pair is combined twice, its output is replaced whole.
+
+		Returns:
+			True if the stale claim was removed by this worker (bool)
+		"""
+
+		try:
+			if time.time() - os.stat(claim_path).st_mtime < self.stale_seconds:
+				return False
+			expired = '%s.expired-%s' % (claim_path, node_name())
+			os.rename(claim_path, expired)
+		except OSError:
+			# Released or taken over by another worker in the meantime
+			return False
+
+		if time.time() - os.stat(expired).st_mtime < self.stale_seconds:
+			# Another worker took it over and claimed it again since the check, put it back
+			try:
+				os.link(expired, claim_path)
+			except OSError:
+				pass
+			os.remove(expired)
+			return False
+
+		os.remove(expired)
+		return True
+
+	def release(self, identifier):
+
+		""" Gives up the claim of a pair """
+
+		try:
+			os.remove(self.claim_path(identifier))
+		except OSError:
+			pass
+
+	def recorded(self):
+
+		""" The identifiers with a recorded outcome (set) """
+
+		names = os.listdir(os.path.join(self.directory, RESULTS_DIRECTORY))
+		return set(name[:-len('.json')] for name in names if name.endswith('.json') and not name.startswith('.'))
+
+	def outcomes(self):
+
+		""" The recorded outcome of every pair that has one
+
+		Returns:
+			identifier -> outcome (dict of PairResult) and
+			identifier -> worker that recorded it (dict of str)
+		"""
+
+		outcomes = {}
+		nodes = {}
+		for identifier in self.recorded():
+			fields = read_json(self.result_path(identifier))
+			if fields is not None:
+				nodes[identifier] = fields.pop('node', None)
+				outcomes[identifier] = PairResult(**fields)
+		return outcomes, nodes
+
+	def record(self, result, node=None):
+
+		""" Records the outcome of a pair and releases its claim
+
+		Args:
+			result - the outcome of the pair, its stages are not kept (PairResult)
+			node - name of the worker, None uses node_name (str)
+		Returns:
+			None
+		"""
+
+		fields = result._replace(stages=None)._asdict()
+		fields['node'] = node or node_name()
+		write_json(self.result_path(result.identifier), fields)
+		self.release(result.identifier)
+
+	def retry_failed(self):
+
+		""" Forgets the outcome of the pairs that failed, so
+		they are handed out again
+
+		Returns:
+			the identifiers of the pairs to retry (list)
+		"""
+
+		retried = []
+		for identifier, result in sorted(self.outcomes()[0].items()):
+			if result.status == 'error':
+				try:
+					os.remove(self.result_path(identifier))
+				except OSError:
+					continue
+				retried.append(identifier)
+		return retried
+
+	def work(self, cache=None, should_stop=None, on_result=None):
+
+		""" Claims and combines pairs until none are left. The
+		outcomes are listed once and the pairs walked in order, rather
+		than listing them again for every pair. The pairs other workers
+		held are walked again, as their workers may have died, until a
+		walk claims nothing.
+
+		Args:
+			cache - reuses the combined file of an unchanged pair, None always combines (ResultCache)
+			should_stop - checked before each pair, None works until the list is done (function)
+			on_result - called with the outcome of each pair combined here (function)
+		Returns:
+			the number of pairs combined by this worker (int)
+		"""
+
+		node = node_name()
+		settings = self.settings
+		save_directory = settings['save_directory']
+		staging_root = os.path.join(save_directory, STAGING_DIRECTORY)
+		staging = os.path.join(staging_root, node)
+		remove_dead_staging(staging_root)
+		if not os.path.isdir(staging):
+			os.makedirs(staging)
+
+		combined = 0
+		recorded = self.recorded()
+		pending = [pair for pair in self.pairs if pair[0] not in recorded]
+
+		try:
+			while pending:
+				# Pairs claimed by other workers in this walk
+				skipped = []
+				for identifier, pcr_path, lis_path in pending:
+					if should_stop is not None and should_stop():
+						return combined
+					# Also fails when another worker recorded the pair since the outcomes were listed
+					if not self.claim(identifier, node):
+						skipped.append((identifier, pcr_path, lis_path))
+						continue
+
+					# Touched while combining, so other workers do not take the claim over as stale
+					with heartbeat(self.claim_path(identifier), self.stale_seconds / 4.0):
+						result = combine_pair(identifier, pcr_path, lis_path, staging, settings['assay_profile'],
+											  settings['output_format'], cache, chunk_rows=settings['chunk_rows'])
+						if result.status == 'combined':
+							# Only complete files ever appear under the final name
+							saved = os.path.join(save_directory, identifier + OUTPUT_FORMATS[settings['output_format']])
+							os.replace(result.output, saved)
+							result = result._replace(output=saved)
+
+					self.record(result, node)
+					combined += 1
+					if on_result is not None:
+						on_result(result)
+
+				if len(skipped) == len(pending):
+					break
+				recorded = self.recorded()
+				pending = [pair for pair in skipped if pair[0] not in recorded]
+		finally:
+			shutil.rmtree(staging, ignore_errors=True)
+			try:
+				# Only removed once the last worker is done with it
+				os.rmdir(staging_root)
+			except OSError:
+				pass
+
+		return combined
+
+	def report(self):
+
+		""" The state of the whole work list, from the outcomes recorded by every worker
+
+		Returns:
+			the identifiers of the combined, wrong assay, claimed and
+			pending pairs, the message and worker of every failed pair
+			and the files that could not be paired (dict)
+		"""
+
+		outcomes, nodes = self.outcomes()
+		claims = set(name[:-len('.claim')] for name in os.listdir(os.path.join(self.directory, CLAIMS_DIRECTORY))
+					 if name.endswith('.claim'))
+
+		report = {'pairs': len(self.pairs), 'combined': [], 'wrong_assay': [], 'failed': {},
+				  'in_progress': [], 'pending': []}
+		for identifier, _, _ in self.pairs:
+			result = outcomes.get(identifier)
+			if result is None:
+				report['in_progress' if identifier in claims else 'pending'].append(identifier)
+			elif result.status == 'combined':
+				report['combined'].append(identifier)
+			elif result.status == 'wrong_assay':
+				report['wrong_assay'].append(identifier)
+			else:
+				report['failed'][identifier] = {'message': result.message, 'node': nodes[identifier]}
+
+		report.update({'missing_lis': self.missing_lis, 'missing_pcr': self.missing_pcr,
+					   'unparseable': self.unparseable, 'duplicates': self.duplicates})
+		return report
+
+	def write_report(self):
+
+		""" Saves the report as report.json in the queue directory
+
+		Returns:
+			the report, see report (dict)
+		"""
+
+		report = self.report()
+		write_json(os.path.join(self.directory, REPORT_FILE_NAME), report)
+		return report
+
@@ -0,0 +1,317 @@
+"""
+Fstore --
+Keeps every combined frame in one Parquet dataset,
+partitioned by run date and instrument, with a SQLite
+index from specimen barcode, run ID and test order to
+the partition file and row, so a specimen can be looked
+up across years of runs without opening each result.
+"""
+
+import os
+import re
+import sqlite3
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from fusion.fwriter import columnar_frame, share_file
+
+DEFAULT_STORE_DIRECTORY = os.path.join(os.path.expanduser('~'), '.fusiongui', 'store')
+INDEX_FILE_NAME = 'index.sqlite'
+UNKNOWN_PARTITION = 'unknown'
+# Rows per row group of the partition files, lookup only reads the groups holding its rows
+PART_ROW_GROUP_ROWS = 4096
+
+# Combined columns kept in the index, in the order of the index columns
+INDEX_COLUMNS = ['Specimen Barcode', 'Run ID', 'Test order #']
+INSTRUMENT_COLUMN = 'Serial Number'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+	specimen_barcode TEXT,
+	run_id TEXT,
+	test_order TEXT,
+	identifier TEXT NOT NULL,
+	part TEXT NOT NULL,
+	row INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS records_specimen_barcode ON records (specimen_barcode);
+CREATE INDEX IF NOT EXISTS records_run_id ON records (run_id);
+CREATE INDEX IF NOT EXISTS records_test_order ON records (test_order);
+CREATE INDEX IF NOT EXISTS records_identifier ON records (identifier);
+"""
+
+_DATE = re.compile(r'(?<!\d)(20\d{2})(0[1-9]|1[0-2])(0[1-9]|[12]\d|3[01])(?!\d)')
+
+
+def run_date_of(identifier):
+
+	""" Reads the run date from the identifier of a pair, e.g.
+	'100_20160810_103000_01' is from 2016-08-10
+
+	Args:
+		identifier - the matched unique id of the pair (str)
+	Returns:
+		the date as YYYY-MM-DD, or 'unknown' without a date (str)
+	"""
+
+	match = _DATE.search(identifier)
+	if match is None:
+		return UNKNOWN_PARTITION
+	return '-'.join(match.groups())
+
+
+def partition_value(value):
+
+	""" Text of a value in a partition directory name """
+
+	if value is None or (isinstance(value, float) and value != value):
+		return UNKNOWN_PARTITION
+	if isinstance(value, float) and value.is_integer():
+		value = int(value)
+	return re.sub(r'[^A-Za-z0-9._-]', '_', str(value)) or UNKNOWN_PARTITION
+
+
+def index_values(values):
+
+	""" Text of the values of an index column, missing values stay None """
+
+	return [None if pd.isnull(value) else str(value) for value in values]
+
+
+class ResultStore():
+
+	""" ResultStore Class
+	Adds the combined frame of each pair to a Parquet dataset
+	laid out as run_date=<date>/instrument=<serial>/<identifier>-<n>.parquet
+	and records every row in the SQLite index. Adding a pair
+	again replaces its earlier rows. Only the directory is
+	pickled, so a store can be handed to worker processes like
+	ResultCache; SQLite locking keeps their writes apart.
+
+	Usage:
+		store = ResultStore('/data/store')
+		store.add('100_20160810_103000_01', combined_frame)
+		records = store.lookup(specimen_barcode='SB1000000001')
+	"""
+
+	def __init__(self, directory=DEFAULT_STORE_DIRECTORY):
+
+		"""
+		Args:
+			directory - where the dataset and its index are kept (str)
+		"""
+
+		self.directory = directory
+		self._connection = None
+
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+
+	def __getstate__(self):
+
+		return {'directory': self.directory}
+
+	def __setstate__(self, state):
+
+		self.directory = state['directory']
+		self._connection = None
+
+	def connection(self):
+
+		""" The connection to the index, opened on first use """
+
+		if self._connection is None:
+			self._connection = sqlite3.connect(os.path.join(self.directory, INDEX_FILE_NAME), timeout=60)
+			self._connection.executescript(_SCHEMA)
+		return self._connection
+
+	def remove(self, identifier):
+
+		""" Drops the rows of a pair from the dataset and the index
+
+		Args:
+			identifier - the matched unique id of the pair (str)
+		Returns:
+			None
+		"""
+
+		connection = self.connection()
+		with connection:
+			parts = [part for (part,) in connection.execute(
+				'SELECT DISTINCT part FROM records WHERE identifier = ?', (identifier,))]
+			connection.execute('DELETE FROM records WHERE identifier = ?', (identifier,))
+
+		for part in parts:
+			try:
+				os.remove(os.path.join(self.directory, part))
+			except OSError:
+				pass
+
+	def contains(self, identifier):
+
+		""" Checks if the rows of a pair are stored """
+
+		return self.connection().execute('SELECT 1 FROM records WHERE identifier = ? LIMIT 1',
+										 (identifier,)).fetchone() is not None
+
+	def add(self, identifier, frame):
+
+		""" Replaces the rows of a pair with the combined frame
+
+		Args:
+			identifier - the matched unique id of the pair (str)
+			frame - the combined LIS & PCR data indexed by UniqueID (DataFrame)
+		Returns:
+			None
+		"""
+
+		self.remove(identifier)
+		self.append(identifier, frame)
+
+	def append(self, identifier, frame):
+
+		""" Adds more rows of a pair, e.g. the chunks of a
+		chunked combine, after a remove
+
+		Args:
+			identifier - the matched unique id of the pair (str)
+			frame - the combined LIS & PCR data indexed by UniqueID (DataFrame)
+		Returns:
+			None
+		"""
+
+		if frame.empty:
+			return
+
+		run_date = 'run_date=%s' % partition_value(run_date_of(identifier))
+		if INSTRUMENT_COLUMN in frame.columns:
+			instruments = frame[INSTRUMENT_COLUMN].map(partition_value).values
+		else:
+			instruments = np.full(len(frame), UNKNOWN_PARTITION, dtype=object)
+
+		records = []
+
+		for instrument in sorted(set(instruments)):
+			rows = frame[instruments == instrument]
+			part = self._write_part(os.path.join(run_date, 'instrument=%s' % instrument), identifier, rows)
+			records.extend(zip(*[index_values(rows[column].values) for column in INDEX_COLUMNS] +
+							   [[identifier] * len(rows), [part] * len(rows), range(len(rows))]))
+
+		connection = self.connection()
+		with connection:
+			connection.executemany('INSERT INTO records (specimen_barcode, run_id, test_order, '
+								   'identifier, part, row) VALUES (?, ?, ?, ?, ?, ?)', records)
+
+	def _write_part(self, partition, identifier, frame):
+
+		""" Writes one Parquet file of the partition under a free name
+
+		Returns:
+			the path of the file relative to the store directory (str)
+		"""
+
+		directory = os.path.join(self.directory, partition)
+		if not os.path.isdir(directory):
+			os.makedirs(directory, exist_ok=True)
+
+		# Parquet files are only ever seen complete, under their final name
+		handle, temporary = tempfile.mkstemp(dir=directory, prefix='.incoming-')
+		os.close(handle)
+		try:
+			columnar_frame(frame).reset_index().to_parquet(temporary, index=False,
+														   row_group_size=PART_ROW_GROUP_ROWS)
+			share_file(temporary)
+			number = 0
+			while True:
+				name = '%s-%d.parquet' % (partition_value(identifier), number)
+				try:
+					# Fails when the name is taken, e.g. by another chunk
+					os.link(temporary, os.path.join(directory, name))
+					break
+				except FileExistsError:
+					number += 1
+		finally:
+			os.remove(temporary)
+
+		return os.path.join(partition, name)
+
+	def locate(self, specimen_barcode=None, run_id=None, test_order=None):
+
+		""" Looks up where records are stored, from the index only
+
+		Args:
+			specimen_barcode - the 'Specimen Barcode' to find (str)
+			run_id - the 'Run ID' to find (str)
+			test_order - the 'Test order #' to find (str)
+		Returns:
+			one row per record with the index columns, the identifier of
+			its pair, and the partition file and row holding it (DataFrame)
+		"""
+
+		conditions = []
+		arguments = []
+		for column, value in (('specimen_barcode', specimen_barcode), ('run_id', run_id),
+							  ('test_order', test_order)):
+			if value is not None:
+				conditions.append('%s = ?' % column)
+				arguments.append(str(value))
+		if not conditions:
+			raise ValueError("Give a specimen barcode, run ID or test order to look up")
+
+		query = ('SELECT specimen_barcode, run_id, test_order, identifier, part, row FROM records '
+				 'WHERE %s ORDER BY part, row' % ' AND '.join(conditions))
+		located = pd.read_sql_query(query, self.connection(), params=arguments)
+		located.columns = INDEX_COLUMNS + ['identifier', 'part', 'row']
+		return located
+
+	def lookup(self, specimen_barcode=None, run_id=None, test_order=None, columns=None):
+
+		""" Reads the combined records matching every given value.
+		Only the row groups of the partition files holding them are read
+
+		Args:
+			specimen_barcode - the 'Specimen Barcode' to find (str)
+			run_id - the 'Run ID' to find (str)
+			test_order - the 'Test order #' to find (str)
+			columns - combined columns to read, None reads them all (list)
+		Returns:
+			the matching combined rows indexed by UniqueID, with the
+			identifier of their pair in the Source column (DataFrame)
+		"""
+
+		import pyarrow.parquet as pq
+
+		located = self.locate(specimen_barcode, run_id, test_order)
+
+		frames = []
+		for part, rows in located.groupby('part', sort=False):
+			read_columns = None if columns is None else ['UniqueID'] + list(columns)
+			part_file = pq.ParquetFile(os.path.join(self.directory, part))
+			group_rows = np.array([part_file.metadata.row_group(group).num_rows
+								   for group in range(part_file.num_row_groups)], dtype=np.int64)
+			group_starts = np.cumsum(group_rows) - group_rows
+
+			# Row group of each record, and its row among the groups read
+			row_numbers = rows['row'].values.astype(np.int64)
+			row_groups = np.searchsorted(group_starts, row_numbers, side='right') - 1
+			groups = np.unique(row_groups)
+			read_starts = np.cumsum(group_rows[groups]) - group_rows[groups]
+			read_rows = row_numbers - group_starts[row_groups] + read_starts[np.searchsorted(groups, row_groups)]
+
+			table = part_file.read_row_groups(groups.tolist(), columns=read_columns)
+			found = table.take(read_rows).to_pandas()
+			found.insert(0, 'Source', rows['identifier'].values)
+			frames.append(found)
+
+		if not frames:
+			return pd.DataFrame(columns=['Source'] + (list(columns) if columns is not None else []),
+								index=pd.Index([], name='UniqueID'))
+		return pd.concat(frames, ignore_index=True).set_index('UniqueID')
+
+	def close(self):
+
+		if self._connection is not None:
+			self._connection.close()
+			self._connection = None
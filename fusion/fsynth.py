@@ -0,0 +1,190 @@
+"""
+Fsynth --
+Writes synthetic Panther PCR & LIS exports, so that
+FusionAnalysis and the file matching can be measured
+and tried out without real instrument data.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+CHANNELS = ['FAM', 'HEX', 'ROX', 'RED647', 'IC']
+# Target detected on each HPIV channel, IC is the internal control
+CHANNEL_TARGETS = ['HPIV-1', 'HPIV-2', 'HPIV-3', 'HPIV-4']
+
+
+def pcr_file_name(worklist, date='20160810', time='103000', sequence=1):
+
+	return '@DI%s-PANTHER-PCR-%s-%s-%02d.csv' % (worklist, date, time, sequence)
+
+
+def lis_file_name(worklist, date='20160810', time='103000', sequence=1):
+
+	return '@Pt2%s-PANTHER-LIS-%s-%s-%02d.lis' % (worklist, date, time, sequence)
+
+
+def _barcodes(random, prefix, count, digits):
+
+	""" Random fixed-width numeric barcodes with a text prefix """
+
+	numbers = random.randint(0, 10 ** min(digits, 18), count)
+	return np.array(['%s%0*d' % (prefix, digits, number) for number in numbers], dtype=object)
+
+
+def synthetic_pair(specimens, worklist='100', assay_type='P 1/2/3/4', seed=0,
+				   positivity=0.2, invalid_rate=0.02, curve_columns=20):
+
+	""" Builds the PCR & LIS frames of one run
+
+	Args:
+		specimens - number of specimens, the PCR file has 5 rows per specimen (int)
+		worklist - worklist ID, also used for the run ID (str)
+		assay_type - value of the 'Analyte' column (str)
+		seed - seed of the random values (int)
+		positivity - share of positive results per target (float)
+		invalid_rate - share of invalid internal control results (float)
+		curve_columns - number of raw amplification curve columns in the PCR file,
+			which FusionAnalysis never reads (int)
+	Returns:
+		the PCR frame and the LIS frame, without the '[end]'
+		row that write_pair adds (DataFrame, DataFrame)
+	"""
+
+	random = np.random.RandomState(seed)
+	run_id = 'RUN%s' % worklist
+
+	specimen_barcodes = np.array(['SB%s%07d' % (worklist, number) for number in range(specimens)], dtype=object)
+	test_orders = np.array(['%d' % (1000000 + number) for number in range(specimens)], dtype=object)
+
+	# Results per specimen and target
+	positive = random.rand(specimens, len(CHANNEL_TARGETS)) < positivity
+	ic_invalid = random.rand(specimens) < invalid_rate
+	ct = np.where(positive, random.uniform(15, 38, positive.shape), np.nan)
+	ic_ct = np.where(ic_invalid, np.nan, random.uniform(25, 32, specimens))
+	rfu = np.where(positive, random.randint(1500, 9000, positive.shape), random.randint(0, 300, positive.shape))
+	ic_rfu = np.where(ic_invalid, random.randint(0, 300, specimens), random.randint(1500, 6000, specimens))
+
+	# --- PCR, one row per specimen and channel
+	rows = specimens * len(CHANNELS)
+	cartridge_lots = np.array(['%06d' % lot for lot in random.randint(100000, 100010, specimens)], dtype=object)
+
+	pcr = pd.DataFrame({
+		'Specimen Barcode': np.repeat(specimen_barcodes, len(CHANNELS)),
+		'Analyte': assay_type,
+		'Run ID': run_id,
+		'Channel': np.tile(CHANNELS, specimens),
+		'RFU Range': np.column_stack([rfu, ic_rfu]).ravel(),
+		'EstimatedBaseline': random.uniform(50, 250, rows).round(3),
+		'LR_Ct_NonNormalized': np.column_stack([ct, ic_ct]).ravel().round(4),
+		'LR_TSlope_NonNormalized': random.uniform(0.1, 1.5, rows).round(5),
+		'Cartridge Lot #': np.repeat(cartridge_lots, len(CHANNELS)),
+		'CapAndVialTrayID': np.repeat(_barcodes(random, '', specimens, 20), len(CHANNELS)),
+		'Test order #': np.repeat(test_orders, len(CHANNELS)),
+		'FCRBarcode': np.repeat(_barcodes(random, 'FCR', specimens, 18), len(CHANNELS)),
+		'FERBarcode': np.repeat(_barcodes(random, 'FER', specimens, 18), len(CHANNELS)),
+		'ElutionBufferRFID': np.repeat(_barcodes(random, 'EB', specimens, 19), len(CHANNELS)),
+		'ReconstitutionBufferRFID': np.repeat(_barcodes(random, 'RB', specimens, 19), len(CHANNELS)),
+		'OilRFID': np.repeat(_barcodes(random, 'OI', specimens, 19), len(CHANNELS)),
+		'WellID': np.arange(rows) % 96 + 1,
+		'FusionTestOrder': np.repeat(np.arange(specimens) + 1, len(CHANNELS)),
+	})
+	for number in range(curve_columns):
+		pcr['Cycle %d' % (number + 1)] = random.uniform(0, 9000, rows).round(2)
+
+	# --- LIS, one row per specimen
+	results = np.where(positive, 'POS', 'neg').astype(object)
+	results[ic_invalid, :] = 'Invalid'
+
+	lis = pd.DataFrame({
+		'Specimen Barcode': specimen_barcodes,
+		'Analyte': assay_type,
+		'Run ID': run_id,
+		'Instrument Flags': np.where(random.rand(specimens) < 0.01, 'F1', ''),
+	})
+	for number in range(len(CHANNEL_TARGETS)):
+		lis['Interpretation %d' % (number + 1)] = pd.Series(ct[:, number]).round(1).values
+	lis['Interpretation 5'] = pd.Series(ic_ct).round(1).values
+	for number in range(len(CHANNEL_TARGETS)):
+		lis['Interpretation %d' % (number + 6)] = results[:, number]
+	lis['Interpretation 10'] = np.where(ic_invalid, 'Invalid', 'Valid')
+	# OtherData 1-5 are the FAM, HEX, IC, RED647 and ROX rounded RFU ranges
+	lis['OtherData 1'] = rfu[:, 0]
+	lis['OtherData 2'] = rfu[:, 1]
+	lis['OtherData 3'] = ic_rfu
+	lis['OtherData 4'] = rfu[:, 3]
+	lis['OtherData 5'] = rfu[:, 2]
+	lis['Serial Number'] = '2090%s' % worklist[-4:]
+	lis['Sample Type'] = 'Specimen'
+	lis['Sample Name'] = np.array(['Sample %d' % number for number in range(specimens)], dtype=object)
+	lis['Test order #'] = test_orders
+
+	return pcr, lis
+
+
+def write_pair(directory, specimens, worklist='100', seed=0, **options):
+
+	""" Writes the PCR (comma separated) and LIS (tab separated)
+	files of one run, named like the Panther exports
+
+	Args:
+		directory - where to write the files (str)
+		specimens - number of specimens (int)
+		worklist - worklist ID (str)
+		seed - seed of the random values (int)
+		options - passed on to synthetic_pair
+	Returns:
+		the PCR file path and the LIS file path (str, str)
+	"""
+
+	pcr, lis = synthetic_pair(specimens, worklist, seed=seed, **options)
+
+	pcr_path = os.path.join(directory, pcr_file_name(worklist))
+	lis_path = os.path.join(directory, lis_file_name(worklist))
+	write_exports(pcr, lis, pcr_path, lis_path)
+
+	return pcr_path, lis_path
+
+
+def write_exports(pcr, lis, pcr_path, lis_path):
+
+	""" Writes PCR & LIS frames like the Panther exports, e.g.
+	those of synthetic_pair after changing some of their rows
+
+	Args:
+		pcr - the PCR rows (DataFrame)
+		lis - the LIS rows (DataFrame)
+		pcr_path - where to write the PCR file (str)
+		lis_path - where to write the LIS file (str)
+	Returns:
+		None
+	"""
+
+	for frame, path, separator in ((pcr, pcr_path, ','), (lis, lis_path, '\t')):
+		frame.to_csv(path, sep=separator, index=False)
+		# The Panther software closes both exports with an '[end]' row
+		with open(path, 'a') as export:
+			export.write('[end]' + separator * (len(frame.columns) - 1) + '\n')
+
+
+def write_dataset(directory, pairs, specimens, first_worklist=100, seed=0, **options):
+
+	""" Writes many runs into one directory
+
+	Args:
+		directory - where to write the files, created if missing (str)
+		pairs - number of PCR & LIS pairs (int)
+		specimens - number of specimens per pair (int)
+		first_worklist - worklist ID of the first pair, the others follow (int)
+		seed - seed of the first pair, the others follow (int)
+		options - passed on to synthetic_pair
+	Returns:
+		(pcr_path, lis_path) of every pair (list)
+	"""
+
+	if not os.path.isdir(directory):
+		os.makedirs(directory)
+
+	return [write_pair(directory, specimens, str(first_worklist + number), seed + number, **options)
+			for number in range(pairs)]
@@ -0,0 +1,385 @@
+"""
+Fwatch --
+Long running service that watches the folders the
+instruments export to, pairs the PCR and LIS files
+as they arrive and combines each pair as soon as its
+second half is completely written.
+"""
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from fusion.fanalyzer import END_OF_FILE
+from fusion.fbatch import PairResult, combine_pair
+from fusion.fmatcher import LIS_GRAMMAR, PCR_GRAMMAR, PairIndex
+
+try:
+	import inotify_simple
+except ImportError:
+	inotify_simple = None
+
+# Seconds a file without the '[end]' row must stay unchanged to count as written
+DEFAULT_SETTLE_SECONDS = 5.0
+DEFAULT_POLL_SECONDS = 1.0
+
+
+def file_signature(file_path):
+
+	""" Size and modification time of a file, None when it is gone """
+
+	try:
+		status = os.stat(file_path)
+	except OSError:
+		return None
+	return (status.st_size, status.st_mtime)
+
+
+def has_end_row(file_path, tail_bytes=512):
+
+	""" Checks for the '[end]' row the Panther software
+	writes last, without reading the rest of the file
+
+	Args:
+		file_path - path to the PCR or LIS file (str)
+		tail_bytes - how much of the end of the file to read (int)
+	Returns:
+		True if the last row is the '[end]' row (bool)
+	"""
+
+	try:
+		with open(file_path, 'rb') as export:
+			export.seek(0, os.SEEK_END)
+			export.seek(max(export.tell() - tail_bytes, 0))
+			tail = export.read()
+	except (IOError, OSError):
+		return False
+
+	lines = tail.rstrip().splitlines()
+	return bool(lines) and lines[-1].startswith(END_OF_FILE.encode('utf-8'))
+
+
+class PollingSource():
+
+	""" PollingSource Class
+	Finds new, changed and removed files by listing the
+	directories and comparing the size and modification
+	time of each file with the previous listing.
+	"""
+
+	def __init__(self, directories):
+
+		self.directories = list(directories)
+		# path -> signature of the previous listing
+		self.seen = {}
+		self.listed = False
+
+	def wait(self, timeout):
+
+		""" Waits for the timeout, then lists the directories. The
+		first call reports every file already in the directories.
+
+		Args:
+			timeout - seconds to wait (float)
+		Returns:
+			the new or changed files (list) and the removed files (list)
+		"""
+
+		if self.listed:
+			time.sleep(timeout)
+		self.listed = True
+
+		listed = {}
+		for directory in self.directories:
+			try:
+				entries = list(os.scandir(directory))
+			except OSError:
+				continue
+			for entry in entries:
+				try:
+					if entry.is_file():
+						status = entry.stat()
+						listed[entry.path] = (status.st_size, status.st_mtime)
+				except OSError:
+					continue
+
+		changed = [path for path, signature in listed.items() if self.seen.get(path) != signature]
+		removed = [path for path in self.seen if path not in listed]
+		self.seen = listed
+
+		return changed, removed
+
+	def close(self):
+
+		pass
+
+
+class InotifySource():
+
+	""" InotifySource Class
+	Reports the files of the directories from inotify
+	events, so a new file is seen as soon as it is written
+	instead of at the next listing. Needs inotify_simple (Linux).
+	"""
+
+	def __init__(self, directories):
+
+		self.inotify = inotify_simple.INotify()
+		flags = inotify_simple.flags
+		watch_flags = (flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE | flags.MOVED_TO |
+					   flags.DELETE | flags.MOVED_FROM)
+		self.removal_flags = flags.DELETE | flags.MOVED_FROM
+
+		# watch descriptor -> directory
+		self.directories = {}
+		for directory in directories:
+			self.directories[self.inotify.add_watch(directory, watch_flags)] = directory
+
+		self.listed = False
+
+	def wait(self, timeout):
+
+		""" Waits up to the timeout for events. The first
+		call reports every file already in the directories.
+
+		Args:
+			timeout - seconds to wait (float)
+		Returns:
+			the new or changed files (list) and the removed files (list)
+		"""
+
+		if not self.listed:
+			self.listed = True
+			changed = []
+			for directory in self.directories.values():
+				changed.extend(entry.path for entry in os.scandir(directory) if entry.is_file())
+			return changed, []
+
+		changed = set()
+		removed = set()
+		for event in self.inotify.read(timeout=int(timeout * 1000)):
+			if event.wd not in self.directories or not event.name:
+				continue
+			path = os.path.join(self.directories[event.wd], event.name)
+			if event.mask & self.removal_flags:
+				changed.discard(path)
+				removed.add(path)
+			else:
+				removed.discard(path)
+				changed.add(path)
+
+		return sorted(changed), sorted(removed)
+
+	def close(self):
+
+		self.inotify.close()
+
+
+def watch_source(directories, use_inotify=True):
+
+	""" Picks inotify when it is available, otherwise polling
+
+	Args:
+		directories - directories to watch, not recursive (list)
+		use_inotify - False always polls, e.g. for network shares
+			where inotify does not see remote writes (bool)
+	Returns:
+		the source of file changes (InotifySource or PollingSource)
+	"""
+
+	if use_inotify and inotify_simple is not None:
+		try:
+			return InotifySource(directories)
+		except OSError:
+			# e.g. the limit of inotify watches is reached
+			pass
+	return PollingSource(directories)
+
+
+class FolderWatcher():
+
+	""" FolderWatcher Class
+	Keeps an index of the PCR and LIS halves seen in the
+	watched directories and combines each pair once both
+	halves are completely written. A half counts as written
+	when it ends with the '[end]' row, or when it has not
+	changed for settle_seconds. A half that is rewritten
+	later is combined again with its pair.
+
+	Usage:
+		watcher = FolderWatcher(['/data/pcr', '/data/lis'], '/data/combined')
+		watcher.run(on_result=print)
+	"""
+
+	def __init__(self, directories, save_directory, assay_profile='Paraflu', output_format='xlsx',
+				 cache=None, workers=1, pcr_grammar=PCR_GRAMMAR, lis_grammar=LIS_GRAMMAR,
+				 settle_seconds=DEFAULT_SETTLE_SECONDS, poll_seconds=DEFAULT_POLL_SECONDS,
+				 use_inotify=True):
+
+		"""
+		Args:
+			directories - directories to watch, not recursive (list)
+			save_directory - directory to save the combined files (str)
+			assay_profile - the assay profile to combine with (str)
+			output_format - one of fusion.fwriter.OUTPUT_FORMATS (str)
+			cache - reuses the combined file of an unchanged pair, None always combines (ResultCache)
+			workers - number of worker processes, 1 combines in the watching process (int)
+			pcr_grammar - grammar of the PCR file names (FileNameGrammar)
+			lis_grammar - grammar of the LIS file names (FileNameGrammar)
+			settle_seconds - how long a file without the '[end]' row must stay unchanged (float)
+			poll_seconds - longest wait between two checks of the directories (float)
+			use_inotify - use inotify events when inotify_simple is installed (bool)
+		"""
+
+		self.save_directory = save_directory
+		self.assay_profile = assay_profile
+		self.output_format = output_format
+		self.cache = cache
+		self.workers = workers
+		self.settle_seconds = settle_seconds
+		self.poll_seconds = poll_seconds
+
+		self.index = PairIndex(pcr_grammar, lis_grammar)
+		self.source = watch_source(directories, use_inotify)
+
+		# Files seen but not yet completely written
+		self.pending = set()
+		# path -> signature of the file when it was indexed
+		self.indexed = {}
+
+		self.executor = None
+		# future -> (identifier, pcr_file, lis_file, submitted)
+		self.in_flight = {}
+
+	def poll(self, timeout=None):
+
+		""" Waits for file changes, indexes the files that are
+		completely written and combines the pairs they complete
+
+		Args:
+			timeout - seconds to wait for changes, None uses poll_seconds (float)
+		Returns:
+			the outcome of every pair that finished (list of PairResult)
+		"""
+
+		changed, removed = self.source.wait(self.poll_seconds if timeout is None else timeout)
+
+		for path in removed:
+			self.pending.discard(path)
+			self.indexed.pop(path, None)
+			self.index.remove(path)
+
+		for path in changed:
+			if self.index.identify(path)[0] is not None:
+				self.pending.add(path)
+
+		results = []
+		now = time.time()
+
+		for path in sorted(self.pending):
+			signature = file_signature(path)
+			if signature is None:
+				self.pending.discard(path)
+				continue
+			if signature[0] == 0 or not (has_end_row(path) or now - signature[1] >= self.settle_seconds):
+				continue
+
+			self.pending.discard(path)
+			if self.indexed.get(path) == signature:
+				# Touched but not changed since it was combined
+				continue
+			self.indexed[path] = signature
+
+			pair = self.index.add(path)
+			if pair is not None:
+				result = self.submit(pair)
+				if result is not None:
+					results.append(result)
+
+		results.extend(self.collect())
+		return results
+
+	def submit(self, pair):
+
+		""" Combines a completed pair, in a worker process when
+		there is more than one worker
+
+		Args:
+			pair - (identifier, pcr_file, lis_file) (tuple)
+		Returns:
+			the outcome of the pair when it was combined here,
+			None when it was sent to a worker (PairResult)
+		"""
+
+		identifier, pcr_path, lis_path = pair
+		task_args = (self.save_directory, self.assay_profile, self.output_format, self.cache)
+
+		if self.workers == 1:
+			return combine_pair(identifier, pcr_path, lis_path, *task_args)
+
+		if self.executor is None:
+			self.executor = ProcessPoolExecutor(max_workers=self.workers or None)
+		future = self.executor.submit(combine_pair, identifier, pcr_path, lis_path, *task_args)
+		self.in_flight[future] = (identifier, pcr_path, lis_path, time.time())
+		return None
+
+	def collect(self):
+
+		""" The outcome of the pairs the workers have finished
+
+		Returns:
+			the finished pairs (list of PairResult)
+		"""
+
+		results = []
+
+		for future in [future for future in self.in_flight if future.done()]:
+			identifier, pcr_path, lis_path, submitted = self.in_flight.pop(future)
+			try:
+				results.append(future.result())
+			except Exception as error:
+				# The worker itself died (e.g. killed for memory), the task never returned
+				results.append(PairResult(identifier, pcr_path, lis_path, 'error', None,
+										  '%s: %s' % (type(error).__name__, error),
+										  time.time() - submitted))
+
+		return results
+
+	def run(self, on_result=None, should_stop=None):
+
+		""" Watches until should_stop returns True
+
+		Args:
+			on_result - called with the outcome of each finished pair (function)
+			should_stop - checked between polls, None watches forever (function)
+		Returns:
+			None
+		"""
+
+		try:
+			while should_stop is None or not should_stop():
+				# Check again soon while files are settling or pairs are combining
+				timeout = min(self.poll_seconds, 0.25) if (self.pending or self.in_flight) else None
+				for result in self.poll(timeout):
+					if on_result is not None:
+						on_result(result)
+		finally:
+			for result in self.close():
+				if on_result is not None:
+					on_result(result)
+
+	def close(self):
+
+		""" Stops watching, waiting for the pairs still combining
+
+		Returns:
+			the outcome of the pairs that were still combining (list of PairResult)
+		"""
+
+		self.source.close()
+		if self.executor is None:
+			return []
+
+		self.executor.shutdown(wait=True)
+		self.executor = None
+		return self.collect()
@@ -0,0 +1,256 @@
+"""
+Fwriter --
+Writes the combined LIS & PCR dataframe in one of
+several output formats. The Excel workbook is the
+default; the other formats are much faster for
+wide frames and can be read back by pandas.
+"""
+
+import os
+
+# Output format -> file extension
+OUTPUT_FORMATS = {'xlsx': '.xlsx',
+				  'xlsx-stream': '.xlsx',
+				  'csv': '.csv',
+				  'parquet': '.parquet',
+				  'feather': '.feather'}
+# Output formats that ChunkedWriter can append to
+CHUNKED_FORMATS = ['csv', 'xlsx-stream', 'parquet']
+
+# The umask of the process, read once since reading it means setting it
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def share_file(path):
+
+	""" Gives a file made by tempfile.mkstemp, which only its owner
+	can read, the mode of a file created normally, so other users of
+	a shared directory can read it once it is moved into place
+
+	Args:
+		path - the file (str)
+	Returns:
+		None
+	"""
+
+	os.chmod(path, 0o666 & ~_UMASK)
+
+
+def output_format_for(save_to):
+
+	""" Picks the output format from the file extension,
+	an unknown extension falls back to the Excel workbook.
+
+	Args:
+		save_to - destination of the file (str)
+	Returns:
+		the output format (str)
+	"""
+
+	extension = os.path.splitext(save_to)[1].lower()
+	for output_format, format_extension in sorted(OUTPUT_FORMATS.items()):
+		if format_extension == extension:
+			return output_format
+	return 'xlsx'
+
+
+def write_frame(frame, save_to, output_format=None):
+
+	""" Saves the frame, index included, in the requested format
+
+	Args:
+		frame - the combined LIS & PCR data (DataFrame)
+		save_to - destination of the file (str)
+		output_format - one of OUTPUT_FORMATS, None picks it from the extension (str)
+	Returns:
+		None
+	"""
+
+	if output_format is None:
+		output_format = output_format_for(save_to)
+
+	if output_format == 'xlsx':
+		frame.to_excel(save_to)
+	elif output_format == 'xlsx-stream':
+		write_xlsx_stream(frame, save_to)
+	elif output_format == 'csv':
+		frame.to_csv(save_to)
+	elif output_format == 'parquet':
+		columnar_frame(frame).to_parquet(save_to)
+	elif output_format == 'feather':
+		# Feather only stores a default index
+		columnar_frame(frame).reset_index().to_feather(save_to)
+	else:
+		raise ValueError("Unknown output format %s, expected one of %s"
+						 % (output_format, ', '.join(sorted(OUTPUT_FORMATS))))
+
+
+def columnar_frame(frame):
+
+	""" Columnar formats need a single type per column. The
+	RFU Range columns mix numbers with the "-" placeholder, so
+	any text column is written as strings with missing values kept.
+
+	Args:
+		frame - the combined LIS & PCR data (DataFrame)
+	Returns:
+		a frame that parquet and feather can store (DataFrame)
+	"""
+
+	converted = {}
+	for column in frame.columns:
+		if frame[column].dtype == object:
+			values = frame[column]
+			converted[column] = values.astype(str).where(values.notnull(), None)
+
+	if not converted:
+		return frame
+	return frame.assign(**converted)
+
+
+def write_xlsx_stream(frame, save_to):
+
+	""" Writes the workbook one row at a time without
+	building it in memory first. Uses xlsxwriter in constant
+	memory mode, or openpyxl in write-only mode when xlsxwriter
+	is not installed. The layout matches DataFrame.to_excel: the
+	index in the first column followed by the frame columns.
+
+	Args:
+		frame - the combined LIS & PCR data (DataFrame)
+		save_to - destination of the file (str)
+	Returns:
+		None
+	"""
+
+	with ChunkedWriter(save_to, 'xlsx-stream') as writer:
+		writer.append(frame)
+
+
+class ChunkedWriter():
+
+	""" ChunkedWriter Class
+	Writes a frame that arrives in chunks with the same
+	columns, so the whole frame never has to be in memory.
+	Only the CHUNKED_FORMATS can be appended to.
+
+	Usage:
+		with ChunkedWriter(save_to, 'csv') as writer:
+			for chunk in chunks:
+				writer.append(chunk)
+	"""
+
+	def __init__(self, save_to, output_format=None):
+
+		"""
+		Args:
+			save_to - destination of the file (str)
+			output_format - one of CHUNKED_FORMATS, None picks it from the extension (str)
+		"""
+
+		if output_format is None:
+			output_format = output_format_for(save_to)
+		if output_format not in CHUNKED_FORMATS:
+			raise ValueError("The %s output format cannot be written in chunks, use one of %s"
+							 % (output_format, ', '.join(CHUNKED_FORMATS)))
+
+		self.save_to = save_to
+		self.output_format = output_format
+		self.rows = 0
+
+		self._book = None
+		self._sheet = None
+		self._sheet_rows = 0
+		self._xlsxwriter = False
+		self._parquet = None
+
+	def append(self, frame):
+
+		""" Writes the rows of the frame after the earlier chunks
+
+		Args:
+			frame - the next rows, with the columns of the first chunk (DataFrame)
+		Returns:
+			None
+		"""
+
+		first = self._book is None and self._parquet is None and self.rows == 0
+
+		if self.output_format == 'csv':
+			frame.to_csv(self.save_to, mode='w' if first else 'a', header=first)
+		elif self.output_format == 'xlsx-stream':
+			if first:
+				self._open_workbook([frame.index.name or ''] + [str(column) for column in frame.columns])
+			for row in frame.itertuples(index=True, name=None):
+				# NaN cells are left blank like to_excel does
+				self._write_row([None if (value is None or (isinstance(value, float) and value != value))
+								 else value for value in row])
+		else:
+			import pyarrow as pa
+			import pyarrow.parquet as pq
+
+			table = pa.Table.from_pandas(columnar_frame(frame))
+			if self._parquet is None:
+				# The types of later chunks may differ: a column all missing in this
+				# chunk can hold text later, and integers become floats with a gap
+				schema = table.schema
+				for position, field in enumerate(schema):
+					if pa.types.is_null(field.type):
+						schema = schema.set(position, field.with_type(pa.string()))
+					elif pa.types.is_integer(field.type):
+						schema = schema.set(position, field.with_type(pa.float64()))
+				self._parquet = pq.ParquetWriter(self.save_to, schema)
+			table = table.cast(self._parquet.schema)
+			self._parquet.write_table(table)
+
+		self.rows += len(frame)
+
+	def _open_workbook(self, header):
+
+		try:
+			import xlsxwriter
+		except ImportError:
+			xlsxwriter = None
+
+		self._xlsxwriter = xlsxwriter is not None
+		if self._xlsxwriter:
+			self._book = xlsxwriter.Workbook(self.save_to, {'constant_memory': True})
+			self._sheet = self._book.add_worksheet('Sheet1')
+		else:
+			import openpyxl
+
+			self._book = openpyxl.Workbook(write_only=True)
+			self._sheet = self._book.create_sheet('Sheet1')
+
+		self._write_row(header)
+
+	def _write_row(self, row):
+
+		if self._xlsxwriter:
+			self._sheet.write_row(self._sheet_rows, 0, row)
+		else:
+			self._sheet.append(row)
+		self._sheet_rows += 1
+
+	def close(self):
+
+		""" Finishes the file """
+
+		if self._book is not None:
+			if self._xlsxwriter:
+				self._book.close()
+			else:
+				self._book.save(self.save_to)
+			self._book = None
+		if self._parquet is not None:
+			self._parquet.close()
+			self._parquet = None
+
+	def __enter__(self):
+
+		return self
+
+	def __exit__(self, *exc_info):
+
+		self.close()
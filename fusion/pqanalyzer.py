@@ -0,0 +1,303 @@
+"""
+Pqanalyzer --
+Performance Qualification statistics over the
+combined LIS & PCR data of many runs: Ct and RFU
+mean, SD and CV per channel, positivity and invalid
+rates, broken down by cartridge lot, instrument,
+reagent RFID and run.
+"""
+
+import numpy as np
+import pandas as pd
+
+from fusion.fanalyzer import (CHANNELS, IC_RESULT_COLUMN, RESULT_INVALID_ANY_CASE, RESULT_NEG_ANY_CASE,
+							  TARGET_RESULT_COLUMNS, decode_results)
+
+# Channel -> (Ct column, RFU column, interpretation column) of the combined file
+PQ_CHANNEL_COLUMNS = {'FAM': ('FAM Rounded Ct', 'FAM-Unrounded RFU Range', TARGET_RESULT_COLUMNS[0]),
+					  'HEX': ('HEX Rounded Ct', 'HEX-Unrounded RFU Range', TARGET_RESULT_COLUMNS[1]),
+					  'ROX': ('ROX Rounded Ct', 'ROX-Unrounded RFU Range', TARGET_RESULT_COLUMNS[2]),
+					  'RED647': ('RED647 Rounded Ct', 'RED647-Unrounded RFU Range', TARGET_RESULT_COLUMNS[3]),
+					  'IC': ('IC Rounded Ct', 'IC-Unrounded RFU Range', IC_RESULT_COLUMN)}
+
+# Breakdown -> column of the combined file. The PCR columns are
+# kept per channel, i.e. read from '<channel>-<column>'.
+OVERALL = 'Overall'
+PQ_BREAKDOWNS = {OVERALL: None,
+				 'Cartridge Lot #': 'Cartridge Lot #',
+				 'Serial Number': 'Serial Number',
+				 'ElutionBufferRFID': 'ElutionBufferRFID',
+				 'ReconstitutionBufferRFID': 'ReconstitutionBufferRFID',
+				 'OilRFID': 'OilRFID',
+				 'Run ID': 'Run ID'}
+PQ_CHANNEL_BREAKDOWNS = ['Cartridge Lot #', 'ElutionBufferRFID', 'ReconstitutionBufferRFID', 'OilRFID']
+
+# Running totals kept per group, enough to merge batches of runs
+#	<value>_n - number of measured values
+#	<value>_sum - sum of the values
+#	<value>_m2 - sum of squared differences from the group mean
+MEASURED_VALUES = ['Ct', 'RFU']
+COUNT_COLUMNS = ['Results', 'Positive', 'Invalid', 'Overall Invalid']
+MOMENT_COLUMNS = COUNT_COLUMNS + ['%s_%s' % (value, moment) for value in MEASURED_VALUES
+								  for moment in ('n', 'sum', 'm2')]
+
+
+def channel_rows(combined):
+
+	""" Wide to long conversion of the combined data, one
+	row per specimen and channel with its Ct, RFU, result flags
+	and the columns of every breakdown. Built column by column
+	with numpy, the values of each channel are stacked in turn.
+	The breakdown columns are factorized into categoricals so
+	grouping works on integer codes.
+
+	Args:
+		combined - combined LIS & PCR data of one or many runs (DataFrame)
+	Returns:
+		the channel rows, with categorical Channel and breakdown columns (DataFrame)
+	"""
+
+	specimens = len(combined)
+	status = decode_results(combined, [PQ_CHANNEL_COLUMNS[channel][2] for channel in CHANNELS])
+	# A result is detected when it is present and neither negative nor invalid
+	answered = np.column_stack([combined[PQ_CHANNEL_COLUMNS[channel][2]].notnull().values
+								for channel in CHANNELS])
+	positive = answered & ((status & (RESULT_NEG_ANY_CASE | RESULT_INVALID_ANY_CASE)) == 0)
+	invalid = (status & RESULT_INVALID_ANY_CASE) > 0
+	overall_invalid = (combined['Overall_Validity'] == 'Invalid').values
+
+	def stacked(columns):
+		return np.concatenate([pd.to_numeric(combined[column], errors='coerce').values.astype(float)
+							   for column in columns])
+
+	rows = {'Channel': pd.Categorical.from_codes(np.repeat(np.arange(len(CHANNELS)), specimens),
+												 categories=CHANNELS),
+			'Ct': stacked([PQ_CHANNEL_COLUMNS[channel][0] for channel in CHANNELS]),
+			'RFU': stacked([PQ_CHANNEL_COLUMNS[channel][1] for channel in CHANNELS]),
+			'Positive': positive.ravel(order='F'),
+			'Invalid': invalid.ravel(order='F'),
+			'Overall Invalid': np.tile(overall_invalid, len(CHANNELS))}
+
+	for breakdown, column in PQ_BREAKDOWNS.items():
+		if column is None:
+			continue
+		if breakdown in PQ_CHANNEL_BREAKDOWNS:
+			codes, uniques = pd.factorize(np.concatenate([combined['%s-%s' % (channel, column)].values.astype(object)
+														  for channel in CHANNELS]), sort=True)
+		else:
+			# Same value on every channel, factorized once per specimen
+			codes, uniques = pd.factorize(combined[column].values.astype(object), sort=True)
+			codes = np.tile(codes, len(CHANNELS))
+		rows[breakdown] = pd.Categorical.from_codes(codes, categories=uniques)
+
+	return pd.DataFrame(rows)
+
+
+def group_moments(rows, breakdown):
+
+	""" Running totals of the channel rows, grouped by the
+	breakdown and the channel. Every (breakdown value, channel)
+	pair gets an integer slot and each total is one np.bincount.
+
+	Args:
+		rows - the channel rows, see channel_rows (DataFrame)
+		breakdown - one of PQ_BREAKDOWNS (str)
+	Returns:
+		MOMENT_COLUMNS indexed by (breakdown value, Channel), missing
+		breakdown values are kept as a group of their own (DataFrame)
+	"""
+
+	channel_codes = rows['Channel'].cat.codes.values.astype(np.intp)
+
+	if PQ_BREAKDOWNS[breakdown] is None:
+		key_values = np.array([OVERALL], dtype=object)
+		key_codes = np.zeros(len(rows), dtype=np.intp)
+	else:
+		keys = rows[breakdown].cat
+		# The missing values (code -1) take the slot after the last category
+		key_values = np.append(keys.categories.values.astype(object), np.nan)
+		key_codes = keys.codes.values.astype(np.intp)
+		key_codes[key_codes < 0] = len(key_values) - 1
+
+	slots = key_codes * len(CHANNELS) + channel_codes
+	size = len(key_values) * len(CHANNELS)
+
+	totals = {'Results': np.bincount(slots, minlength=size)}
+	for column in ['Positive', 'Invalid', 'Overall Invalid']:
+		totals[column] = np.bincount(slots, weights=rows[column].values, minlength=size).astype(np.int64)
+
+	for value in MEASURED_VALUES:
+		values = rows[value].values
+		measured = ~np.isnan(values)
+		counts = np.bincount(slots[measured], minlength=size)
+		sums = np.bincount(slots[measured], weights=values[measured], minlength=size)
+		# Second pass around the group mean, steadier than the sum of squares
+		means = sums / np.maximum(counts, 1)
+		deviations = values[measured] - means[slots[measured]]
+		totals['%s_n' % value] = counts
+		totals['%s_sum' % value] = sums
+		totals['%s_m2' % value] = np.bincount(slots[measured], weights=deviations * deviations, minlength=size)
+
+	used = np.nonzero(totals['Results'])[0]
+	index = pd.MultiIndex.from_arrays([key_values[used // len(CHANNELS)],
+									   pd.Categorical.from_codes(used % len(CHANNELS), categories=CHANNELS)],
+									  names=[breakdown, 'Channel'])
+
+	return pd.DataFrame(dict((column, totals[column][used]) for column in MOMENT_COLUMNS), index=index)
+
+
+def merge_moments(parts):
+
+	""" Merges the running totals of several batches, the
+	pairwise update of Chan et al. applied to all groups at once
+
+	Args:
+		parts - running totals as returned by group_moments (list of DataFrame)
+	Returns:
+		the merged running totals (DataFrame)
+	"""
+
+	parts = [part for part in parts if part is not None]
+	if len(parts) == 1:
+		return parts[0]
+
+	stacked = pd.concat(parts)
+	levels = list(range(stacked.index.nlevels))
+	merged = stacked.groupby(level=levels, observed=True, sort=True, dropna=False).sum()
+
+	for value in MEASURED_VALUES:
+		counts = stacked['%s_n' % value]
+		part_mean = stacked['%s_sum' % value] / counts.where(counts > 0)
+		merged_counts = merged['%s_n' % value]
+		merged_mean = (merged['%s_sum' % value] / merged_counts.where(merged_counts > 0)).reindex(stacked.index)
+		spread = (counts * (part_mean - merged_mean.values) ** 2).fillna(0.0)
+		merged['%s_m2' % value] += spread.groupby(level=levels, observed=True, sort=True, dropna=False).sum()
+
+	return merged[MOMENT_COLUMNS]
+
+
+def moment_statistics(moments):
+
+	""" Turns running totals into the PQ statistics
+
+	Args:
+		moments - running totals as returned by group_moments (DataFrame)
+	Returns:
+		per group: number of results, Ct and RFU N, mean, SD (sample)
+		and CV %, positivity, invalid and overall invalid rates (DataFrame)
+	"""
+
+	statistics = pd.DataFrame(index=moments.index)
+	statistics['Results'] = moments['Results']
+
+	for value in MEASURED_VALUES:
+		counts = moments['%s_n' % value].astype(float)
+		mean = moments['%s_sum' % value] / counts.where(counts > 0)
+		sd = np.sqrt(moments['%s_m2' % value] / (counts - 1).where(counts > 1))
+		statistics['%s N' % value] = moments['%s_n' % value]
+		statistics['%s Mean' % value] = mean
+		statistics['%s SD' % value] = sd
+		statistics['%s CV %%' % value] = 100.0 * sd / mean.where(mean != 0)
+
+	results = moments['Results'].astype(float).where(moments['Results'] > 0)
+	statistics['Positivity Rate'] = moments['Positive'] / results
+	statistics['Invalid Rate'] = moments['Invalid'] / results
+	statistics['Overall Invalid Rate'] = moments['Overall Invalid'] / results
+
+	return statistics
+
+
+class PQAnalysis():
+
+	""" PQAnalysis Class
+	Accumulates the PQ statistics of combined LIS & PCR
+	data. Each call to add folds a batch of runs into running
+	totals per group, so new runs can be added as they arrive
+	without going over the earlier ones again.
+
+	Usage:
+		pq = PQAnalysis()
+		pq.add(combined_frame)
+		by_lot = pq.statistics('Cartridge Lot #')
+	"""
+
+	def __init__(self, breakdowns=None):
+
+		"""
+		Args:
+			breakdowns - the PQ_BREAKDOWNS to accumulate, None keeps them all (list)
+		"""
+
+		self.breakdowns = list(PQ_BREAKDOWNS) if breakdowns is None else list(breakdowns)
+		unknown = [breakdown for breakdown in self.breakdowns if breakdown not in PQ_BREAKDOWNS]
+		if unknown:
+			raise ValueError("Unknown breakdown(s) %s, expected some of %s"
+							 % (', '.join(unknown), ', '.join(PQ_BREAKDOWNS)))
+
+		self.moments = dict((breakdown, None) for breakdown in self.breakdowns)
+
+	def add(self, combined):
+
+		""" Adds the runs of a combined frame
+
+		Args:
+			combined - combined LIS & PCR data, e.g. from
+				FusionAnalysis.combined_frame or the concatenated mode (DataFrame)
+		Returns:
+			None
+		"""
+
+		rows = channel_rows(combined)
+		for breakdown in self.breakdowns:
+			self.moments[breakdown] = merge_moments([self.moments[breakdown], group_moments(rows, breakdown)])
+
+	def merge(self, other):
+
+		""" Adds the runs accumulated by another PQAnalysis, e.g. one per worker
+
+		Args:
+			other - accumulated over different runs (PQAnalysis)
+		Returns:
+			None
+		"""
+
+		for breakdown in self.breakdowns:
+			if other.moments.get(breakdown) is not None:
+				self.moments[breakdown] = merge_moments([self.moments[breakdown], other.moments[breakdown]])
+
+	def statistics(self, breakdown=OVERALL):
+
+		""" The statistics of every group of the breakdown
+
+		Args:
+			breakdown - one of the accumulated breakdowns (str)
+		Returns:
+			one row per (breakdown value, Channel), see moment_statistics (DataFrame)
+		"""
+
+		if self.moments[breakdown] is None:
+			raise ValueError("No runs have been added")
+		return moment_statistics(self.moments[breakdown])
+
+	def save(self, save_to):
+
+		""" Saves the running totals, so the next batch of
+		runs can be added in a later session """
+
+		pd.to_pickle(self.moments, save_to)
+
+	@classmethod
+	def load(cls, load_from):
+
+		""" Restores running totals saved with save
+
+		Args:
+			load_from - file written by save (str)
+		Returns:
+			the accumulated analysis (PQAnalysis)
+		"""
+
+		moments = pd.read_pickle(load_from)
+		analysis = cls(list(moments))
+		analysis.moments = moments
+		return analysis
@@ -0,0 +1,154 @@
+"""
+Command line entry point for combining LIS & PCR
+files without the GUI.
+
+	python fusionbatch.py --pcr /data/pcr --lis "/data/lis/*.lis" --out /data/combined
+
+With --concat every pair goes into one dataset instead of a file per pair:
+
+	python fusionbatch.py --pcr /data/pcr --lis /data/lis --out /data/combined --concat week32.parquet
+
+Exit status is 0 when every file was paired and combined,
+1 when files are missing a pair, have an unrecognized name
+or a pair failed to combine.
+"""
+
+import argparse
+import os
+import sys
+
+from fusion.fbatch import ASSAY_TYPES, collect_files, combine_concatenated, run_batch
+from fusion.fcache import DEFAULT_CACHE_DIRECTORY, DEFAULT_MAX_BYTES, ResultCache
+from fusion.fmatcher import LIS_GRAMMAR, PCR_GRAMMAR, FileNameGrammar, match_files
+from fusion.fprofile import format_stages, summarize_runs
+from fusion.fwriter import CHUNKED_FORMATS, OUTPUT_FORMATS
+
+
+def parse_args(argv):
+
+	parser = argparse.ArgumentParser(description='Fusion LIS & PCR Combiner (batch mode)')
+	parser.add_argument('--pcr', nargs='+', required=True,
+						help='PCR directories, globs or *.csv files')
+	parser.add_argument('--lis', nargs='+', required=True,
+						help='LIS directories, globs or *.lis files')
+	parser.add_argument('--out', required=True,
+						help='directory to save the combined files')
+	parser.add_argument('--assay', default='Paraflu', choices=sorted(ASSAY_TYPES),
+						help='assay profile to combine with (default: %(default)s)')
+	parser.add_argument('--format', choices=sorted(OUTPUT_FORMATS),
+						help='output file format (default: xlsx)')
+	parser.add_argument('--concat', metavar='FILE_NAME',
+						help='combine every pair into this single file in --out, tagged with a Source '
+							 'column, instead of one file per pair. The format follows the extension '
+							 'unless --format is given. The cache is not used, and --chunk-rows, '
+							 '--store and --profile cannot be combined with it')
+	parser.add_argument('--workers', type=int, default=1,
+						help='number of pairs to combine in parallel, 0 uses every CPU (default: %(default)s)')
+	parser.add_argument('--chunk-rows', type=int,
+						help='read each PCR file this many rows at a time to bound the memory used, '
+							 'with the xlsx-stream, csv or parquet format')
+	parser.add_argument('--store', metavar='DIRECTORY',
+						help='also add the combined rows of every pair to the Parquet dataset and '
+							 'specimen index kept in this directory')
+	parser.add_argument('--pcr-pattern', default=PCR_GRAMMAR.pattern.pattern,
+						help='regular expression reading the pair identifier from PCR file names, '
+							 'its groups are joined with "_" (default: %(default)s)')
+	parser.add_argument('--lis-pattern', default=LIS_GRAMMAR.pattern.pattern,
+						help='regular expression reading the pair identifier from LIS file names '
+							 '(default: %(default)s)')
+	parser.add_argument('--profile', choices=['stages', 'memory'],
+						help='time each stage of every pair and print a summary, '
+							 '"memory" also records the peak memory of each stage')
+	parser.add_argument('--profile-dir',
+						help='save a JSON stage trace and a cProfile of every pair in this directory')
+	parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIRECTORY,
+						help='cache of combined files for unchanged pairs (default: %(default)s)')
+	parser.add_argument('--cache-size', type=int, default=DEFAULT_MAX_BYTES // 1024 ** 2,
+						help='cache size limit in MB, least recently used files are removed (default: %(default)s)')
+	parser.add_argument('--no-cache', action='store_true',
+						help='combine every pair even if it is unchanged')
+	return parser.parse_args(argv)
+
+
+def main(argv=None):
+
+	args = parse_args(sys.argv[1:] if argv is None else argv)
+
+	if args.concat:
+		# combine_concatenated keeps every pair in memory and writes the dataset once
+		ignored = [flag for flag, value in (('--chunk-rows', args.chunk_rows), ('--store', args.store),
+											('--profile', args.profile), ('--profile-dir', args.profile_dir))
+				   if value]
+		if ignored:
+			print("ERROR: %s cannot be used with --concat" % ', '.join(ignored))
+			return 2
+
+	if args.chunk_rows and (args.format or 'xlsx') not in CHUNKED_FORMATS:
+		print("ERROR: --chunk-rows needs one of the %s formats" % ', '.join(CHUNKED_FORMATS))
+		return 2
+
+	pcr_files = collect_files(args.pcr, PCR_GRAMMAR.extension)
+	lis_files = collect_files(args.lis, LIS_GRAMMAR.extension)
+
+	if not os.path.isdir(args.out):
+		os.makedirs(args.out)
+
+	cache = None
+	if not (args.no_cache or args.concat):
+		cache = ResultCache(args.cache_dir, args.cache_size * 1024 ** 2)
+
+	pcr_grammar = FileNameGrammar(args.pcr_pattern, PCR_GRAMMAR.extension)
+	lis_grammar = FileNameGrammar(args.lis_pattern, LIS_GRAMMAR.extension)
+
+	store = None
+	if args.store:
+		# Loads pandas and pyarrow, so only when the store is used
+		from fusion.fstore import ResultStore
+		store = ResultStore(args.store)
+
+	if args.concat:
+		match = match_files(lis_files, pcr_files, pcr_grammar, lis_grammar)
+		results = combine_concatenated(match.pairs, os.path.join(args.out, args.concat),
+									   args.assay, args.workers, args.format)
+	else:
+		if args.profile_dir and not os.path.isdir(args.profile_dir):
+			os.makedirs(args.profile_dir)
+		results, match = run_batch(lis_files, pcr_files, args.out, args.assay, args.workers,
+								   args.format or 'xlsx', cache, pcr_grammar, lis_grammar,
+								   args.profile, args.profile_dir, args.chunk_rows, store)
+
+	for lis in match.missing_lis:
+		print("MISSING FILE: The LIS file %s is missing a PCR pair." % lis)
+	for pcr in match.missing_pcr:
+		print("MISSING FILE: The PCR file %s is missing a LIS pair." % pcr)
+	for name in match.unparseable:
+		print("UNRECOGNIZED FILE NAME: %s does not follow the file name pattern." % name)
+	for name in match.duplicates:
+		print("DUPLICATE FILE: %s has the same identifier as another file and was skipped." % name)
+
+	failures = 0
+	for result in results:
+		if result.status == 'combined':
+			print("COMBINED: %s -> %s (%.2fs)%s" % (result.identifier, result.output, result.elapsed,
+												  ' [%s]' % result.message if result.message else ''))
+		elif result.status == 'wrong_assay':
+			print("ASSAY TYPE WARNING: The files %s are not of the specified assay type"
+				  % [result.pcr_file, result.lis_file])
+		else:
+			failures += 1
+			print("ERROR: %s failed: %s" % (result.identifier, result.message))
+
+	profiled_runs = [result.stages for result in results if result.stages]
+	if profiled_runs:
+		print("STAGE TIMINGS over %d combined pair(s):" % len(profiled_runs))
+		print(format_stages(summarize_runs(profiled_runs)))
+
+	print("RUN IS COMPLETE. %d pair(s) processed, results saved at %s" % (len(results), args.out))
+
+	if match.missing_lis or match.missing_pcr or match.unparseable or match.duplicates or failures:
+		return 1
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
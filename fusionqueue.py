@@ -0,0 +1,183 @@
+"""
+Command line entry point for combining an archive on
+several hosts at once, through a work queue kept on a
+filesystem they share. Create the queue once:
+
+	python fusionqueue.py create --queue /shared/queue --pcr /archive/pcr --lis /archive/lis --out /shared/combined
+
+then start workers on every host, as many as each can take:
+
+	python fusionqueue.py work --queue /shared/queue --workers 8
+
+and once they are done, or at any time in between:
+
+	python fusionqueue.py report --queue /shared/queue
+
+A worker that is stopped or crashes leaves its pair claimed
+until the claim goes stale, after which any worker picks it up.
+Running work again resumes the pairs without an outcome.
+
+Exit status of work and report is 0 when every file was paired
+and combined, 1 when files are missing a pair, have an unrecognized
+name, a pair failed to combine or pairs are still left.
+"""
+
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from fusion.fbatch import ASSAY_TYPES, collect_files
+from fusion.fcache import DEFAULT_CACHE_DIRECTORY, DEFAULT_MAX_BYTES, ResultCache
+from fusion.fmatcher import LIS_GRAMMAR, PCR_GRAMMAR, FileNameGrammar, match_files
+from fusion.fqueue import DEFAULT_STALE_SECONDS, WorkQueue, create_queue
+from fusion.fwriter import CHUNKED_FORMATS, OUTPUT_FORMATS
+
+
+def parse_args(argv):
+
+	parser = argparse.ArgumentParser(description='Fusion LIS & PCR Combiner (shared work queue)')
+	commands = parser.add_subparsers(dest='command')
+	commands.required = True
+
+	create = commands.add_parser('create', help='match the files and write the work list of the queue')
+	create.add_argument('--queue', required=True,
+						help='queue directory, on a filesystem every host can reach')
+	create.add_argument('--pcr', nargs='+', required=True,
+						help='PCR directories, globs or *.csv files')
+	create.add_argument('--lis', nargs='+', required=True,
+						help='LIS directories, globs or *.lis files')
+	create.add_argument('--out', required=True,
+						help='directory to save the combined files, reachable by every host')
+	create.add_argument('--assay', default='Paraflu', choices=sorted(ASSAY_TYPES),
+						help='assay profile to combine with (default: %(default)s)')
+	create.add_argument('--format', default='xlsx', choices=sorted(OUTPUT_FORMATS),
+						help='output file format (default: %(default)s)')
+	create.add_argument('--chunk-rows', type=int,
+						help='read each PCR file this many rows at a time to bound the memory used, '
+							 'with the xlsx-stream, csv or parquet format')
+	create.add_argument('--pcr-pattern', default=PCR_GRAMMAR.pattern.pattern,
+						help='regular expression reading the pair identifier from PCR file names '
+							 '(default: %(default)s)')
+	create.add_argument('--lis-pattern', default=LIS_GRAMMAR.pattern.pattern,
+						help='regular expression reading the pair identifier from LIS file names '
+							 '(default: %(default)s)')
+
+	work = commands.add_parser('work', help='combine pairs of the queue until none are left')
+	work.add_argument('--queue', required=True, help='queue directory')
+	work.add_argument('--workers', type=int, default=1,
+					  help='worker processes on this host, 0 uses every CPU (default: %(default)s)')
+	work.add_argument('--stale', type=float, default=DEFAULT_STALE_SECONDS,
+					  help='seconds after which the claim of a worker that stopped is taken over, '
+						   'use the same value on every host (default: %(default)s)')
+	work.add_argument('--retry-failed', action='store_true',
+					  help='combine the pairs that failed before again')
+	work.add_argument('--cache-dir', default=DEFAULT_CACHE_DIRECTORY,
+					  help='cache of combined files for unchanged pairs (default: %(default)s)')
+	work.add_argument('--cache-size', type=int, default=DEFAULT_MAX_BYTES // 1024 ** 2,
+					  help='cache size limit in MB, least recently used files are removed (default: %(default)s)')
+	work.add_argument('--no-cache', action='store_true',
+					  help='combine every pair even if it is unchanged')
+
+	report = commands.add_parser('report', help='print the state of the queue and save it as report.json')
+	report.add_argument('--queue', required=True, help='queue directory')
+
+	return parser.parse_args(argv)
+
+
+def work_queue(directory, stale_seconds, cache):
+
+	""" Works on the queue in a worker process
+
+	Returns:
+		the number of pairs combined by the worker (int)
+	"""
+
+	def report_result(result):
+		if result.status == 'combined':
+			print("COMBINED: %s -> %s (%.2fs)%s" % (result.identifier, result.output, result.elapsed,
+												  ' [%s]' % result.message if result.message else ''))
+		elif result.status == 'wrong_assay':
+			print("ASSAY TYPE WARNING: The files %s are not of the specified assay type"
+				  % [result.pcr_file, result.lis_file])
+		else:
+			print("ERROR: %s failed: %s" % (result.identifier, result.message))
+		sys.stdout.flush()
+
+	return WorkQueue(directory, stale_seconds).work(cache, on_result=report_result)
+
+
+def print_report(report):
+
+	""" Prints the report of a queue
+
+	Returns:
+		True when every file was paired and combined (bool)
+	"""
+
+	for lis in report['missing_lis']:
+		print("MISSING FILE: The LIS file %s is missing a PCR pair." % lis)
+	for pcr in report['missing_pcr']:
+		print("MISSING FILE: The PCR file %s is missing a LIS pair." % pcr)
+	for name in report['unparseable']:
+		print("UNRECOGNIZED FILE NAME: %s does not follow the file name pattern." % name)
+	for name in report['duplicates']:
+		print("DUPLICATE FILE: %s has the same identifier as another file and was skipped." % name)
+	for identifier in report['wrong_assay']:
+		print("ASSAY TYPE WARNING: The pair %s is not of the specified assay type" % identifier)
+	for identifier, failure in sorted(report['failed'].items()):
+		print("ERROR: %s failed on %s: %s" % (identifier, failure['node'], failure['message']))
+
+	print("QUEUE: %d pair(s), %d combined, %d wrong assay, %d failed, %d in progress, %d pending"
+		  % (report['pairs'], len(report['combined']), len(report['wrong_assay']), len(report['failed']),
+			 len(report['in_progress']), len(report['pending'])))
+
+	return not (report['missing_lis'] or report['missing_pcr'] or report['unparseable'] or
+				report['duplicates'] or report['failed'] or report['in_progress'] or report['pending'])
+
+
+def main(argv=None):
+
+	args = parse_args(sys.argv[1:] if argv is None else argv)
+
+	if args.command == 'create':
+		if args.chunk_rows and args.format not in CHUNKED_FORMATS:
+			print("ERROR: --chunk-rows needs one of the %s formats" % ', '.join(CHUNKED_FORMATS))
+			return 2
+
+		if not os.path.isdir(args.out):
+			os.makedirs(args.out)
+
+		match = match_files(collect_files(args.lis, LIS_GRAMMAR.extension),
+							collect_files(args.pcr, PCR_GRAMMAR.extension),
+							FileNameGrammar(args.pcr_pattern, PCR_GRAMMAR.extension),
+							FileNameGrammar(args.lis_pattern, LIS_GRAMMAR.extension))
+		queue = create_queue(args.queue, match, args.out, args.assay, args.format, args.chunk_rows)
+		print("QUEUE CREATED: %d pair(s) in %s, results saved at %s"
+			  % (len(queue.pairs), args.queue, queue.settings['save_directory']))
+		return 0
+
+	queue = WorkQueue(args.queue)
+
+	if args.command == 'work':
+		if args.retry_failed:
+			for identifier in queue.retry_failed():
+				print("RETRY: %s" % identifier)
+
+		cache = None
+		if not args.no_cache:
+			cache = ResultCache(args.cache_dir, args.cache_size * 1024 ** 2)
+
+		workers = args.workers or os.cpu_count() or 1
+		if workers == 1:
+			work_queue(args.queue, args.stale, cache)
+		else:
+			with ProcessPoolExecutor(max_workers=workers) as executor:
+				for future in [executor.submit(work_queue, args.queue, args.stale, cache) for _ in range(workers)]:
+					future.result()
+
+	return 0 if print_report(queue.write_report()) else 1
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,113 @@
+"""
+Command line entry point for the watch-folder service. It
+combines every PCR & LIS pair as soon as both halves have
+been written to the watched directories.
+
+	python fusionwatch.py --watch /data/pcr /data/lis --out /data/combined
+
+Runs until interrupted (Ctrl+C or SIGTERM). Pairs already in
+the directories at start up are combined first, the cache keeps
+unchanged pairs from being combined again after a restart.
+"""
+
+import argparse
+import os
+import signal
+import sys
+import threading
+
+from fusion.fbatch import ASSAY_TYPES
+from fusion.fcache import DEFAULT_CACHE_DIRECTORY, DEFAULT_MAX_BYTES, ResultCache
+from fusion.fmatcher import LIS_GRAMMAR, PCR_GRAMMAR, FileNameGrammar
+from fusion.fwatch import DEFAULT_POLL_SECONDS, DEFAULT_SETTLE_SECONDS, FolderWatcher
+from fusion.fwriter import OUTPUT_FORMATS
+
+
+def parse_args(argv):
+
+	parser = argparse.ArgumentParser(description='Fusion LIS & PCR Combiner (watch-folder service)')
+	parser.add_argument('--watch', nargs='+', required=True,
+						help='directories the PCR and LIS files are exported to')
+	parser.add_argument('--out', required=True,
+						help='directory to save the combined files')
+	parser.add_argument('--assay', default='Paraflu', choices=sorted(ASSAY_TYPES),
+						help='assay profile to combine with (default: %(default)s)')
+	parser.add_argument('--format', default='xlsx', choices=sorted(OUTPUT_FORMATS),
+						help='output file format (default: %(default)s)')
+	parser.add_argument('--workers', type=int, default=1,
+						help='number of pairs to combine in parallel, 0 uses every CPU (default: %(default)s)')
+	parser.add_argument('--pcr-pattern', default=PCR_GRAMMAR.pattern.pattern,
+						help='regular expression reading the pair identifier from PCR file names '
+							 '(default: %(default)s)')
+	parser.add_argument('--lis-pattern', default=LIS_GRAMMAR.pattern.pattern,
+						help='regular expression reading the pair identifier from LIS file names '
+							 '(default: %(default)s)')
+	parser.add_argument('--settle', type=float, default=DEFAULT_SETTLE_SECONDS,
+						help='seconds a file without the [end] row must stay unchanged before it '
+							 'is combined (default: %(default)s)')
+	parser.add_argument('--poll', type=float, default=DEFAULT_POLL_SECONDS,
+						help='seconds between checks of the directories (default: %(default)s)')
+	parser.add_argument('--no-inotify', action='store_true',
+						help='list the directories instead of using inotify, e.g. on network shares')
+	parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIRECTORY,
+						help='cache of combined files for unchanged pairs (default: %(default)s)')
+	parser.add_argument('--cache-size', type=int, default=DEFAULT_MAX_BYTES // 1024 ** 2,
+						help='cache size limit in MB, least recently used files are removed (default: %(default)s)')
+	parser.add_argument('--no-cache', action='store_true',
+						help='combine every pair even if it is unchanged')
+	return parser.parse_args(argv)
+
+
+def report(result):
+
+	if result.status == 'combined':
+		print("COMBINED: %s -> %s (%.2fs)%s" % (result.identifier, result.output, result.elapsed,
+											  ' [%s]' % result.message if result.message else ''))
+	elif result.status == 'wrong_assay':
+		print("ASSAY TYPE WARNING: The files %s are not of the specified assay type"
+			  % [result.pcr_file, result.lis_file])
+	else:
+		print("ERROR: %s failed: %s" % (result.identifier, result.message))
+	sys.stdout.flush()
+
+
+def main(argv=None):
+
+	args = parse_args(sys.argv[1:] if argv is None else argv)
+
+	if not os.path.isdir(args.out):
+		os.makedirs(args.out)
+
+	cache = None
+	if not args.no_cache:
+		cache = ResultCache(args.cache_dir, args.cache_size * 1024 ** 2)
+
+	watcher = FolderWatcher(args.watch, args.out, args.assay, args.format, cache, args.workers,
+							FileNameGrammar(args.pcr_pattern, PCR_GRAMMAR.extension),
+							FileNameGrammar(args.lis_pattern, LIS_GRAMMAR.extension),
+							args.settle, args.poll, not args.no_inotify)
+
+	stop = threading.Event()
+	signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+	print("WATCHING: %s with %s, results saved at %s"
+		  % (', '.join(args.watch), type(watcher.source).__name__, args.out))
+	sys.stdout.flush()
+
+	try:
+		watcher.run(report, stop.is_set)
+	except KeyboardInterrupt:
+		pass
+
+	missing_lis, missing_pcr = watcher.index.unmatched()
+	for lis in missing_lis:
+		print("MISSING FILE: The LIS file %s is missing a PCR pair." % lis)
+	for pcr in missing_pcr:
+		print("MISSING FILE: The PCR file %s is missing a LIS pair." % pcr)
+	print("STOPPED WATCHING.")
+
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())